@@ -0,0 +1,8 @@
+import os
+import sys
+
+# Modules of the common lambda layer are importable from /opt/python when deployed
+sys.path.insert(
+    0,
+    os.path.join(os.path.dirname(__file__), "..", "lambdas", "common_layer", "python"),
+)
@@ -0,0 +1,246 @@
+""" Cold start (import time) budgets of the lambdas
+
+Imports the handler module of each lambda in a fresh interpreter with
+-X importtime, and reports the time to import it (median of --repeat runs), the
+time of the whole process (interpreter start up included) and its heaviest
+imports. Exits with a non-zero status when an import fails or takes longer than
+its budget (benchmarks/cold_start_budgets.json, in milliseconds).
+
+    $ cd bmh_admin_portal_backend
+    $ python -m benchmarks.cold_start
+    $ python -m benchmarks.cold_start --lambda workspaces_api_resource --top 20
+
+The results can be saved and compared, e.g. before and after a change:
+
+    $ python -m benchmarks.cold_start --output before.json
+    $ python -m benchmarks.cold_start --compare before.json
+"""
+
+import argparse
+import json
+import os
+import statistics
+import subprocess
+import sys
+import time
+
+BACKEND_DIR = os.path.abspath(os.path.join(os.path.dirname(__file__), ".."))
+REPOSITORY_DIR = os.path.dirname(BACKEND_DIR)
+COMMON_LAYER_DIR = os.path.join(BACKEND_DIR, "lambdas", "common_layer", "python")
+DEFAULT_BUDGETS = os.path.join(os.path.dirname(__file__), "cold_start_budgets.json")
+
+# name: (code directory of the lambda, handler module, uses the common layer)
+LAMBDAS = {
+    "workspaces_api_resource": (
+        os.path.join(BACKEND_DIR, "lambdas", "workspaces_api_resource"),
+        "workspaces_api_resource_handler",
+        True,
+    ),
+    "total_usage_queue": (
+        os.path.join(BACKEND_DIR, "lambdas", "workspaces_api_resource"),
+        "total_usage_queue_handler",
+        True,
+    ),
+    "lambda_authorizer": (
+        os.path.join(BACKEND_DIR, "lambdas", "lambda_authorizer"),
+        "lambda_authorizer",
+        False,
+    ),
+    "step_functions_handler": (
+        os.path.join(BACKEND_DIR, "lambdas", "step_functions_handler"),
+        "src.app",
+        True,
+    ),
+    "total_usage_trigger": (
+        os.path.join(BACKEND_DIR, "lambdas", "sns_trigger_lambda"),
+        "total_usage_trigger_handler",
+        True,
+    ),
+    "parse_cost_and_usage": (
+        os.path.join(
+            REPOSITORY_DIR, "bmh_workspace", "lambdas", "parse_cost_and_usage_lambda"
+        ),
+        "parse_cost_and_usage_lambda",
+        False,
+    ),
+    "custom_cost_and_usage_report_cfn": (
+        os.path.join(
+            REPOSITORY_DIR,
+            "bmh_workspace",
+            "lambdas",
+            "custom_cost_and_usage_report_cfn",
+        ),
+        "custom_cost_and_usage_report_cfn",
+        False,
+    ),
+}
+
+# -X importtime does not report modules imported with importlib.import_module
+_CHILD_CODE = """
+import json, sys, time
+start = time.perf_counter()
+exec("import " + sys.argv[1])
+print(json.dumps({"import_ms": (time.perf_counter() - start) * 1000}))
+"""
+
+
+def measure(name, top):
+    """Imports the handler module of the lambda in a new interpreter.
+
+    return:
+        (dict) import_ms, process_ms and the heaviest imports:
+            [{"module", "self_ms", "cumulative_ms", "depth"}]
+    raises:
+        RuntimeError: the module could not be imported.
+    """
+    directory, module, uses_common_layer = LAMBDAS[name]
+    path = [directory] + ([COMMON_LAYER_DIR] if uses_common_layer else [])
+    env = dict(os.environ)
+    env["PYTHONPATH"] = os.pathsep.join(path)
+    # Some clients are created at import time
+    env.setdefault("AWS_DEFAULT_REGION", "us-east-1")
+
+    start = time.perf_counter()
+    process = subprocess.run(
+        [sys.executable, "-X", "importtime", "-c", _CHILD_CODE, module],
+        cwd=directory,
+        env=env,
+        capture_output=True,
+        text=True,
+    )
+    process_ms = (time.perf_counter() - start) * 1000
+    if process.returncode != 0:
+        raise RuntimeError(process.stderr.strip().splitlines()[-1])
+
+    return {
+        "import_ms": json.loads(process.stdout.strip().splitlines()[-1])["import_ms"],
+        "process_ms": process_ms,
+        "imports": heaviest_imports(process.stderr, module, top),
+    }
+
+
+def heaviest_imports(importtime_output, module, top):
+    """Parses the -X importtime output and returns the top imports (by cumulative
+    time) made directly by module."""
+    entries = []
+    for line in importtime_output.splitlines():
+        if not line.startswith("import time:") or "imported package" in line:
+            continue
+        self_us, cumulative_us, package = line[len("import time:") :].split("|")
+        depth = (len(package) - len(package.lstrip()) - 1) // 2
+        entries.append(
+            {
+                "module": package.strip(),
+                "self_ms": int(self_us) / 1000,
+                "cumulative_ms": int(cumulative_us) / 1000,
+                "depth": depth,
+            }
+        )
+
+    # Children are printed before their parent, keep the entries of the last
+    # import of the module.
+    end = max((i for i, e in enumerate(entries) if e["module"] == module), default=None)
+    if end is None:
+        return []
+    start = end
+    while start > 0 and entries[start - 1]["depth"] > entries[end]["depth"]:
+        start -= 1
+    direct = [e for e in entries[start:end] if e["depth"] == entries[end]["depth"] + 1]
+    return sorted(direct, key=lambda e: e["cumulative_ms"], reverse=True)[:top]
+
+
+def run(names, repeat, top):
+    results = {}
+    for name in names:
+        try:
+            runs = [measure(name, top) for _ in range(repeat)]
+        except RuntimeError as e:
+            results[name] = {"error": str(e)}
+            continue
+        results[name] = {
+            "import_ms": statistics.median(r["import_ms"] for r in runs),
+            "process_ms": statistics.median(r["process_ms"] for r in runs),
+            "imports": runs[0]["imports"],
+        }
+    return results
+
+
+def report(results, budgets, previous=None):
+    """Prints the results and returns the names of the lambdas over budget (or
+    which failed to import)"""
+    failures = []
+    print(
+        f"{'lambda':<34} {'import (ms)':>12} {'process (ms)':>13} "
+        f"{'budget (ms)':>12} {'change (ms)':>12}  status"
+    )
+    for name, result in results.items():
+        budget = budgets.get(name)
+        if "error" in result:
+            failures.append(name)
+            print(
+                f"{name:<34} {'-':>12} {'-':>13} {budget or '-':>12} {'-':>12}  {result['error']}"
+            )
+            continue
+
+        over_budget = budget is not None and result["import_ms"] > budget
+        if over_budget:
+            failures.append(name)
+        change = "-"
+        if previous and "import_ms" in previous.get(name, {}):
+            change = f"{result['import_ms'] - previous[name]['import_ms']:+.1f}"
+        print(
+            f"{name:<34} {result['import_ms']:>12.1f} {result['process_ms']:>13.1f} "
+            f"{budget or '-':>12} {change:>12}  {'OVER BUDGET' if over_budget else 'ok'}"
+        )
+
+    for name, result in results.items():
+        if not result.get("imports"):
+            continue
+        print(f"\n{name}: heaviest imports")
+        print(f"{'cumulative (ms)':>16} {'self (ms)':>10}  module")
+        for entry in result["imports"]:
+            print(
+                f"{entry['cumulative_ms']:>16.1f} {entry['self_ms']:>10.1f}  "
+                f"{entry['module']}"
+            )
+    return failures
+
+
+def main(args):
+    with open(args.budgets) as f:
+        budgets = json.load(f)
+
+    previous = None
+    if args.compare:
+        with open(args.compare) as f:
+            previous = json.load(f)
+
+    results = run(args.lambdas or list(LAMBDAS), args.repeat, args.top)
+    if args.output:
+        with open(args.output, "w") as f:
+            json.dump(results, f, indent=2)
+
+    failures = report(results, budgets, previous)
+    if failures:
+        print(f"\nOver budget or failed: {', '.join(failures)}")
+        return 1
+    return 0
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__.split("\n")[1])
+    parser.add_argument(
+        "--lambda",
+        dest="lambdas",
+        action="append",
+        choices=list(LAMBDAS),
+        help="Only measure this lambda (can be repeated).",
+    )
+    parser.add_argument("--repeat", type=int, default=3)
+    parser.add_argument(
+        "--top", type=int, default=10, help="Number of heaviest imports shown."
+    )
+    parser.add_argument("--budgets", default=DEFAULT_BUDGETS)
+    parser.add_argument("--output", help="Write the results to this JSON file.")
+    parser.add_argument("--compare", help="Results (JSON) of a previous run.")
+    sys.exit(main(parser.parse_args()))
@@ -0,0 +1,407 @@
+""" Load test of the API, locally
+
+Runs the API handler behind a local HTTP adapter (benchmarks.local_api), backed
+by moto, seeds synthetic users and workspaces and sends a mix of requests from
+concurrent clients. Reports the throughput and the latency percentiles of each
+route.
+
+    $ cd bmh_admin_portal_backend
+    $ python -m benchmarks.load_test --concurrency 50 --duration 30
+    $ python -m benchmarks.load_test --workspaces 20000 --users 2000 \\
+        --mix list=50,get=30,limits=10,batch_get=10 --authorizer
+
+All the clients share this process (and the GIL) with the API handler and moto,
+so the latencies are not those of Lambda and DynamoDB. Compare runs made on the
+same machine, e.g. before and after a change (--output and --compare), to find
+the routes whose latency grows with the table size or the concurrency.
+"""
+
+import argparse
+import http.client
+import json
+import logging
+import random
+import statistics
+import sys
+import threading
+import time
+from collections import defaultdict
+
+from .local_api import LocalApiServer, LocalAws, seed_workspaces
+
+DEFAULT_MIX = "list=40,get=25,changes=10,total_usage=10,limits=5,create=3,batch_get=5,bulk_total_usage=2"
+API_KEY = "local-api-key"
+APP_CLIENT_ID = "local-billing-app"
+BATCH_SIZE = 50
+
+
+class Traffic:
+    """Builds the requests of the traffic mix, as (method, url, headers, body)"""
+
+    def __init__(self, api, workspaces, seed=0):
+        self.api = api
+        self.workspaces = workspaces
+        self.users = sorted({w["user_id"] for w in workspaces})
+        self._tokens = {}
+        self._lock = threading.Lock()
+        self._rng = random.Random(seed)
+
+    def request(self, kind):
+        with self._lock:
+            workspace = self._rng.choice(self.workspaces)
+            rng = random.Random(self._rng.getrandbits(64))
+        return getattr(self, kind)(rng, workspace)
+
+    def list(self, rng, workspace):
+        return "GET", "/workspaces", self._user(workspace["user_id"]), None
+
+    def get(self, rng, workspace):
+        url = f"/workspaces/{workspace['bmh_workspace_id']}"
+        return "GET", url, self._user(workspace["user_id"]), None
+
+    def changes(self, rng, workspace):
+        # Polling of the workspaces changed in the last minute
+        since = int(time.time() * 1000) - 60_000
+        url = f"/workspaces?changed_since={since}"
+        return "GET", url, self._user(workspace["user_id"]), None
+
+    def create(self, rng, workspace):
+        body = {
+            "workspace_type": "Direct Pay",
+            "scientific_poc": "Researcher Name",
+            "project_short_title": "Load test",
+        }
+        return "POST", "/workspaces", self._user(workspace["user_id"]), body
+
+    def limits(self, rng, workspace):
+        hard_limit = rng.choice([225, 450, 900, 5000])
+        url = f"/workspaces/{workspace['bmh_workspace_id']}/limits"
+        body = {"soft-limit": hard_limit // 2, "hard-limit": hard_limit}
+        return "PUT", url, self._user(workspace["user_id"]), body
+
+    def total_usage(self, rng, workspace):
+        url = f"/workspaces/{workspace['bmh_workspace_id']}/total-usage"
+        body = {"total-usage": round(rng.uniform(0, 1000), 2)}
+        return "PUT", url, {"x-api-key": API_KEY}, body
+
+    def refresh_tokens(self, rng, workspace):
+        body = {"refresh_token": f"local-refresh-token-{rng.getrandbits(32)}"}
+        return "PUT", "/auth/refresh-tokens", {"x-api-key": API_KEY}, body
+
+    def batch_get(self, rng, workspace):
+        body = {
+            "workspaces": [
+                {"workspace_id": w["bmh_workspace_id"], "user_id": w["user_id"]}
+                for w in rng.sample(
+                    self.workspaces, min(BATCH_SIZE, len(self.workspaces))
+                )
+            ]
+        }
+        return "POST", "/workspaces/batch-get", self._app(), body
+
+    def bulk_total_usage(self, rng, workspace):
+        body = {
+            "workspaces": [
+                {
+                    "workspace_id": w["bmh_workspace_id"],
+                    "total-usage": round(rng.uniform(0, 1000), 2),
+                }
+                for w in rng.sample(
+                    self.workspaces, min(BATCH_SIZE, len(self.workspaces))
+                )
+            ]
+        }
+        return "PUT", "/workspaces/total-usage", self._app(), body
+
+    def _user(self, user):
+        return {"Authorization": f"Bearer {self._token(user=user)}"}
+
+    def _app(self):
+        return {"Authorization": f"Bearer {self._token(client_id=APP_CLIENT_ID)}"}
+
+    def _token(self, user=None, client_id=None):
+        key = (user, client_id)
+        with self._lock:
+            if key not in self._tokens:
+                self._tokens[key] = self.api.issue_token(user=user, client_id=client_id)
+            return self._tokens[key]
+
+
+def parse_mix(mix):
+    """Parses "list=40,get=25" into {"list": 40.0, "get": 25.0}
+
+    raises:
+        ValueError: Unknown kind of request or invalid weight.
+    """
+    weights = {}
+    for entry in mix.split(","):
+        kind, _, weight = entry.partition("=")
+        kind = kind.strip()
+        if (
+            not callable(getattr(Traffic, kind, None))
+            or kind.startswith("_")
+            or kind == "request"
+        ):
+            raise ValueError(f"Unknown kind of request: {kind}")
+        weights[kind] = float(weight)
+        if weights[kind] < 0:
+            raise ValueError(f"Invalid weight: {entry}")
+    if not any(weights.values()):
+        raise ValueError("The mix has no requests")
+    return weights
+
+
+def percentile(sorted_values, p):
+    """Nearest-rank percentile of a sorted list"""
+    if not sorted_values:
+        return None
+    rank = max(1, -(-len(sorted_values) * p // 100))
+    return sorted_values[int(rank) - 1]
+
+
+def summarize(latencies, statuses, elapsed_seconds):
+    """Statistics of each route.
+
+    args:
+        latencies (dict): {route: [latency_ms]}
+        statuses (dict): {route: {status_code: count}}
+        elapsed_seconds (float): Duration of the run.
+
+    return:
+        (dict) {route: {"count", "throughput", "p50", "p95", "p99", "max", "mean",
+        "statuses"}}
+    """
+    summary = {}
+    for route in sorted(latencies):
+        values = sorted(latencies[route])
+        summary[route] = {
+            "count": len(values),
+            "throughput": len(values) / elapsed_seconds,
+            "mean": statistics.fmean(values),
+            "p50": percentile(values, 50),
+            "p95": percentile(values, 95),
+            "p99": percentile(values, 99),
+            "max": values[-1],
+            "statuses": {
+                str(k): v for k, v in sorted(statuses[route].items(), key=str)
+            },
+        }
+    return summary
+
+
+def print_summary(summary, previous=None):
+    """Prints one line per route, with the change of p50 and p99 (milliseconds)
+    since a previous summary"""
+    header = (
+        f"{'route':<48} {'count':>7} {'req/s':>8} {'p50 (ms)':>9} {'p95 (ms)':>9} "
+        f"{'p99 (ms)':>9} {'max (ms)':>9}"
+    )
+    print(header + ("  change p50/p99" if previous else "") + "  statuses")
+    for route, stats in summary.items():
+        line = (
+            f"{route:<48} {stats['count']:>7} {stats['throughput']:>8.1f} "
+            f"{stats['p50']:>9.1f} {stats['p95']:>9.1f} {stats['p99']:>9.1f} "
+            f"{stats['max']:>9.1f}"
+        )
+        if previous:
+            before = previous.get(route)
+            change = "-"
+            if before:
+                change = (
+                    f"{stats['p50'] - before['p50']:+.1f}/"
+                    f"{stats['p99'] - before['p99']:+.1f}"
+                )
+            line += f"  {change:>15}"
+        statuses = ", ".join(f"{k}: {v}" for k, v in stats["statuses"].items())
+        print(f"{line}  {statuses}")
+
+
+def run(api, traffic, weights, concurrency, duration, max_requests=None, url=None):
+    """Sends requests from concurrent clients until the duration (seconds) or the
+    number of requests is reached. Requests go through the HTTP server at url
+    when it is set, otherwise they are sent to the LocalApi directly.
+
+    return:
+        (latencies, statuses, elapsed seconds), by "<method> <resource>"
+    """
+    kinds = list(weights)
+    kind_weights = [weights[k] for k in kinds]
+    latencies = defaultdict(list)
+    statuses = defaultdict(lambda: defaultdict(int))
+    lock = threading.Lock()
+    sent = [0]
+    deadline = time.monotonic() + duration
+
+    def client(index):
+        rng = random.Random(index)
+        connection = None
+        if url:
+            host, port = url.split("//")[1].split(":")
+            connection = http.client.HTTPConnection(host, int(port), timeout=60)
+        try:
+            while time.monotonic() < deadline:
+                with lock:
+                    if max_requests is not None and sent[0] >= max_requests:
+                        return
+                    sent[0] += 1
+                kind = rng.choices(kinds, kind_weights)[0]
+                method, path, headers, body = traffic.request(kind)
+                data = json.dumps(body).encode() if body is not None else None
+
+                start = time.perf_counter()
+                if connection is not None:
+                    status_code = _send(connection, method, path, headers, data)
+                    resource = api.match(method, path.split("?")[0])[0]
+                else:
+                    status_code, _, _, resource = api.invoke(
+                        method, path, headers, data
+                    )
+                latency_ms = (time.perf_counter() - start) * 1000
+
+                route = f"{method} {resource}"
+                with lock:
+                    latencies[route].append(latency_ms)
+                    statuses[route][status_code] += 1
+        finally:
+            if connection is not None:
+                connection.close()
+
+    start = time.monotonic()
+    threads = [
+        threading.Thread(target=client, args=(i,), daemon=True)
+        for i in range(concurrency)
+    ]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    return latencies, statuses, time.monotonic() - start
+
+
+def _send(connection, method, path, headers, data):
+    headers = dict(headers)
+    if data is not None:
+        headers["Content-Type"] = "application/json"
+    try:
+        connection.request(method, path, body=data, headers=headers)
+        response = connection.getresponse()
+        response.read()
+        return response.status
+    except (http.client.HTTPException, OSError):
+        connection.close()
+        return "connection error"
+
+
+def main(args):
+    try:
+        weights = parse_mix(args.mix)
+    except ValueError as e:
+        print(f"Invalid --mix: {e}")
+        return 2
+    if not args.verbose:
+        # The handler logs every request and response
+        logging.disable(logging.WARNING)
+
+    with LocalAws(
+        server=args.moto_server,
+        total_usage_queue=args.total_usage_queue,
+        in_memory=args.in_memory,
+    ) as aws:
+        start = time.perf_counter()
+        workspaces = seed_workspaces(
+            args.workspaces, num_users=args.users, topic_arn=aws.topic_arn
+        )
+        print(
+            f"Seeded {args.workspaces} workspaces of "
+            f"{len({w['user_id'] for w in workspaces})} users in "
+            f"{time.perf_counter() - start:.1f} s"
+            + (f", moto server at {aws.endpoint_url}" if aws.endpoint_url else "")
+        )
+
+        # The server also serves the token endpoint used by the /auth routes
+        with LocalApiServer(
+            authorizer=args.authorizer, token_latency_ms=args.token_latency_ms
+        ) as server:
+            latencies, statuses, elapsed = run(
+                server.api,
+                Traffic(server.api, workspaces),
+                weights,
+                args.concurrency,
+                args.duration,
+                args.requests,
+                url=None if args.in_process else server.url,
+            )
+
+    summary = summarize(latencies, statuses, elapsed)
+    total = sum(stats["count"] for stats in summary.values())
+    print(
+        f"{total} requests from {args.concurrency} clients in {elapsed:.1f} s "
+        f"({total / elapsed:.1f} req/s)\n"
+    )
+    previous = None
+    if args.compare:
+        with open(args.compare) as f:
+            previous = json.load(f)["routes"]
+    print_summary(summary, previous)
+
+    if args.output:
+        with open(args.output, "w") as f:
+            json.dump(
+                {"arguments": vars(args), "elapsed": elapsed, "routes": summary},
+                f,
+                indent=2,
+            )
+    return 0
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__.split("\n")[1])
+    parser.add_argument("--workspaces", type=int, default=5000)
+    parser.add_argument(
+        "--users", type=int, help="Owners of the workspaces (default workspaces / 3)."
+    )
+    parser.add_argument(
+        "--concurrency", type=int, default=50, help="Number of concurrent clients."
+    )
+    parser.add_argument("--duration", type=float, default=30, help="Seconds.")
+    parser.add_argument("--requests", type=int, help="Stop after this many requests.")
+    parser.add_argument(
+        "--mix",
+        default=DEFAULT_MIX,
+        help=f"Weights of the kinds of request (default {DEFAULT_MIX}).",
+    )
+    parser.add_argument(
+        "--authorizer",
+        action="store_true",
+        help="Validate JWTs with the lambda authorizer.",
+    )
+    parser.add_argument(
+        "--moto-server",
+        action="store_true",
+        help="Run moto as a server (requires moto[server]) instead of in process.",
+    )
+    parser.add_argument(
+        "--in-memory",
+        action="store_true",
+        help="Keep the workspaces in memory instead of the (moto) DynamoDB table.",
+    )
+    parser.add_argument(
+        "--total-usage-queue",
+        action="store_true",
+        help="Queue the total-usage updates (total_usage_queue_url).",
+    )
+    parser.add_argument(
+        "--token-latency-ms",
+        type=float,
+        default=0,
+        help="Response time of the local Fence token endpoint (/auth routes).",
+    )
+    parser.add_argument(
+        "--in-process",
+        action="store_true",
+        help="Call the adapter directly instead of through HTTP.",
+    )
+    parser.add_argument("--output", help="Write the results to this JSON file.")
+    parser.add_argument("--compare", help="Results (JSON) of a previous run.")
+    parser.add_argument("--verbose", action="store_true", help="Show the logs.")
+    sys.exit(main(parser.parse_args()))
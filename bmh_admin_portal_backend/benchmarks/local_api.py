@@ -0,0 +1,558 @@
+""" The API handler running locally, without AWS
+
+- LocalAws: moto, either in process (mock) or as a local server
+  (ThreadedMotoServer, requires moto[server]), with the DynamoDB table and
+  indexes, SSM parameters, SNS topic and client secret the API handler expects.
+  The workspaces can be kept in an InMemoryWorkspaceRepository instead of the
+  table.
+- seed_workspaces: synthetic users and workspaces in the table.
+- LocalApi: translates HTTP requests to API Gateway proxy events like the
+  deployed REST API (resources, authorizer context, API key, base64 encoded
+  bodies), and calls the API handler.
+- LocalApiServer: an HTTP server in front of LocalApi. It also stands in for the
+  token endpoint of Fence (/oauth2/token), used by the /auth routes.
+
+Requests authenticate like the deployed API: "Authorization: Bearer <token>" on
+the routes with the token authorizer, "x-api-key" on the routes which require an
+API key. By default the tokens are "user:<email>" or "app:<client_id>" and are
+trusted. With authorizer=True, the tokens are RS256 JWTs issued by LocalApi
+(issue_token) and validated by the lambda authorizer, which fetches the keys
+from the /.well-known/jwks endpoint of the server.
+"""
+
+import base64
+import contextlib
+import fnmatch
+import json
+import logging
+import os
+import re
+import socket
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import parse_qsl, urlsplit
+
+import boto3
+from bmh_common.workspace_repository import InMemoryWorkspaceRepository, split_details
+
+from .synthetic_workspaces import generate_workspaces
+
+TABLE_NAME = "local-workspaces"
+INDEX_NAME = "local-workspaces-index"
+CHANGES_INDEX_NAME = "local-workspaces-changes-index"
+TOPIC_NAME = "local-workspaces-topic"
+QUEUE_NAME = "local-total-usage-queue"
+AUDIENCE = "local-client"
+REGION = "us-east-1"
+METHOD_ARN_PREFIX = f"arn:aws:execute-api:{REGION}:123456789012:local/api"
+# API Gateway caches the policy of a token for 5 minutes by default
+AUTHORIZER_CACHE_SECONDS = 300
+
+# Environment of the API function (see bmh_admin_portal_backend_stack.py)
+ENVIRONMENT = {
+    "AWS_DEFAULT_REGION": REGION,
+    "AWS_ACCESS_KEY_ID": "testing",
+    "AWS_SECRET_ACCESS_KEY": "testing",
+    "dynamodb_table_param_name": "/local/dynamodb-table",
+    "dynamodb_index_param_name": "/local/dynamodb-index",
+    "dynamodb_changes_index_param_name": "/local/dynamodb-changes-index",
+    "api_usage_id_param_name": "/local/api-usage-id",
+    "email_domain": "example.org",
+    "occ_email_domain": "occ.example.org",
+    "user_services_email": "user-services@example.org",
+    "auth_client_id": "local-client",
+    "auth_client_secret_name": "/local/fence-client-secret",
+    "auth_redirect_uri": "http://localhost/login",
+    # Concurrent invocations share the process, the per invocation metrics would
+    # be mixed up.
+    "metrics_namespace": "",
+    "profile_sample_rate": "",
+    "profile_users": "",
+}
+
+# Methods of the REST API which require an API key rather than a token
+API_KEY_ROUTES = {
+    ("GET", "/auth/get-tokens"),
+    ("PUT", "/auth/refresh-tokens"),
+    ("PUT", "/workspaces/{workspace_id}/total-usage"),
+    ("PUT", "/workspaces/{workspace_id}/cost-breakdown"),
+}
+
+
+class LocalAws:
+    """Context manager which starts moto and sets the environment of the API
+    function.
+
+    args:
+        server (bool): Run a ThreadedMotoServer (requires moto[server]) and send
+            the AWS calls to it with AWS_ENDPOINT_URL, instead of mocking botocore
+            in this process.
+        total_usage_queue (bool): Create the total-usage SQS queue, updates of
+            total-usage are then queued instead of written to the table.
+        in_memory (bool): Keep the workspaces in an InMemoryWorkspaceRepository
+            (set as the workspace_repository of the API handler) instead of the
+            DynamoDB table, to leave the cost of moto out of the measurements.
+    """
+
+    def __init__(self, server=False, total_usage_queue=False, in_memory=False):
+        self.server = server
+        self.total_usage_queue = total_usage_queue
+        self.in_memory = in_memory
+        self.endpoint_url = None
+        self._stack = contextlib.ExitStack()
+
+    def __enter__(self):
+        environment = dict(ENVIRONMENT)
+        if self.server:
+            from moto.server import ThreadedMotoServer
+
+            port = _free_port()
+            moto_server = ThreadedMotoServer(ip_address="127.0.0.1", port=port)
+            moto_server.start()
+            self._stack.callback(moto_server.stop)
+            self.endpoint_url = environment[
+                "AWS_ENDPOINT_URL"
+            ] = f"http://127.0.0.1:{port}"
+        else:
+            from moto import (
+                mock_dynamodb,
+                mock_secretsmanager,
+                mock_sns,
+                mock_sqs,
+                mock_ssm,
+            )
+
+            for mock in (
+                mock_dynamodb(),
+                mock_secretsmanager(),
+                mock_sns(),
+                mock_sqs(),
+                mock_ssm(),
+            ):
+                self._stack.enter_context(mock)
+
+        self._stack.enter_context(_environment(environment))
+        try:
+            self.topic_arn = create_resources()
+            if self.total_usage_queue:
+                queue_url = boto3.client("sqs").create_queue(QueueName=QUEUE_NAME)
+                os.environ["total_usage_queue_url"] = queue_url["QueueUrl"]
+                self._stack.callback(os.environ.pop, "total_usage_queue_url", None)
+            if self.in_memory:
+                api = _api_module()
+                api.workspace_repository = InMemoryWorkspaceRepository()
+                self._stack.callback(setattr, api, "workspace_repository", None)
+        except Exception:
+            self._stack.close()
+            raise
+        return self
+
+    def __exit__(self, *exc_info):
+        self._stack.close()
+
+
+def create_resources():
+    """Creates the table (with the indexes of the deployed table), the SSM
+    parameters, the client secret and the SNS topic of the workspaces.
+
+    return:
+        (str) ARN of the SNS topic
+    """
+    boto3.client("dynamodb").create_table(
+        TableName=TABLE_NAME,
+        KeySchema=[
+            {"AttributeName": "user_id", "KeyType": "HASH"},
+            {"AttributeName": "bmh_workspace_id", "KeyType": "RANGE"},
+        ],
+        AttributeDefinitions=[
+            {"AttributeName": "user_id", "AttributeType": "S"},
+            {"AttributeName": "bmh_workspace_id", "AttributeType": "S"},
+            {"AttributeName": "changes_shard", "AttributeType": "S"},
+            {"AttributeName": "last_modified", "AttributeType": "N"},
+        ],
+        GlobalSecondaryIndexes=[
+            {
+                "IndexName": INDEX_NAME,
+                "KeySchema": [{"AttributeName": "bmh_workspace_id", "KeyType": "HASH"}],
+                "Projection": {"ProjectionType": "KEYS_ONLY"},
+            },
+            {
+                "IndexName": CHANGES_INDEX_NAME,
+                "KeySchema": [
+                    {"AttributeName": "changes_shard", "KeyType": "HASH"},
+                    {"AttributeName": "last_modified", "KeyType": "RANGE"},
+                ],
+                "Projection": {"ProjectionType": "ALL"},
+            },
+        ],
+        BillingMode="PAY_PER_REQUEST",
+    )
+
+    ssm = boto3.client("ssm")
+    for name, value in [
+        ("dynamodb_table_param_name", TABLE_NAME),
+        ("dynamodb_index_param_name", INDEX_NAME),
+        ("dynamodb_changes_index_param_name", CHANGES_INDEX_NAME),
+        ("api_usage_id_param_name", "local-usage-plan"),
+    ]:
+        ssm.put_parameter(Name=os.environ[name], Value=value, Type="String")
+
+    boto3.client("secretsmanager").create_secret(
+        Name=os.environ["auth_client_secret_name"],
+        SecretString=json.dumps({"fence_client_secret": "local-secret"}),
+    )
+
+    return boto3.client("sns").create_topic(Name=TOPIC_NAME)["TopicArn"]
+
+
+def seed_workspaces(num_workspaces, num_users=None, topic_arn=None, seed=0):
+    """Writes synthetic workspaces to the table.
+
+    args:
+        num_workspaces (int): Number of workspaces.
+        num_users (int): Number of users (owners of the workspaces), see
+            generate_workspaces.
+        topic_arn (str): SNS topic of all the workspaces (notifications of the
+            soft and hard limits).
+
+    return:
+        (list) The items written
+    """
+    items = generate_workspaces(num_workspaces, num_users=num_users, seed=seed)
+    put_workspaces(items, topic_arn)
+    return items
+
+
+def put_workspaces(items, topic_arn=None):
+    """Writes workspaces to the table (or to the in-memory repository of
+    LocalAws(in_memory=True)) as workspace and request details items, with
+    topic_arn as their SNS topic when it is set"""
+    if topic_arn:
+        for item in items:
+            item["sns-topic"] = topic_arn
+    rows = [row for item in items for row in split_details(item)]
+
+    repository = _api_module().workspace_repository
+    if isinstance(repository, InMemoryWorkspaceRepository):
+        repository.load(rows)
+        return
+
+    table = boto3.resource("dynamodb").Table(TABLE_NAME)
+    with table.batch_writer() as batch:
+        for row in rows:
+            batch.put_item(Item=row)
+
+
+class LocalApi:
+    """Calls the API handler with the proxy event of a HTTP request.
+
+    args:
+        authorizer (bool): Validate the tokens with the lambda authorizer (see
+            the module docstring).
+        jwks_url (str): Base URL of the /.well-known/jwks endpoint, required with
+            authorizer=True.
+    """
+
+    def __init__(self, authorizer=False, jwks_url=None):
+        api = _api_module()
+        self.api_handler = api.handler
+        self.routes = _compile_routes(api.ROUTES)
+
+        self.authorizer = None
+        if authorizer:
+            self._init_authorizer(jwks_url)
+        self._policies = {}
+        self._policies_lock = threading.Lock()
+
+    def _init_authorizer(self, jwks_url):
+        import jwt
+        from cryptography.hazmat.primitives.asymmetric import rsa
+
+        from lambdas.lambda_authorizer import lambda_authorizer
+
+        self.authorizer = lambda_authorizer.lambda_handler
+        self._private_key = rsa.generate_private_key(
+            public_exponent=65537, key_size=2048
+        )
+        jwk = json.loads(
+            jwt.algorithms.RSAAlgorithm.to_jwk(self._private_key.public_key())
+        )
+        self.jwks = {"keys": [{**jwk, "kid": "local", "alg": "RS256", "use": "sig"}]}
+        os.environ["auth_base_url"] = jwks_url
+        os.environ["allowed_client_id_audience"] = AUDIENCE
+
+    def issue_token(self, user=None, client_id=None, expires_in=3600):
+        """Returns the access token of a user, or of an application
+        (client_credentials) when user is None"""
+        if self.authorizer is None:
+            return f"user:{user}" if user else f"app:{client_id}"
+
+        import jwt
+
+        claims = {"aud": AUDIENCE, "exp": int(time.time()) + expires_in}
+        if user:
+            claims["context"] = {"user": {"name": user}}
+        else:
+            claims["azp"] = client_id
+        return jwt.encode(
+            claims, self._private_key, algorithm="RS256", headers={"kid": "local"}
+        )
+
+    def invoke(self, method, url, headers=None, body=None):
+        """Handles a HTTP request.
+
+        args:
+            method (str): HTTP method.
+            url (str): Path and query string, e.g. /workspaces?changed_since=0
+            headers (dict): Request headers.
+            body (bytes): Request body.
+
+        return:
+            (status_code, headers, body (bytes), resource) resource is None when no
+            route matched.
+        """
+        headers = dict(headers or {})
+        parts = urlsplit(url)
+        match = self.match(method, parts.path)
+        if match is None:
+            return 403, {}, b'{"message":"Missing Authentication Token"}', None
+        resource, path_params = match
+
+        request_context = {
+            "identity": {"apiKey": None},
+            "requestId": f"local-{time.time_ns()}",
+        }
+        if (method, resource) in API_KEY_ROUTES:
+            api_key = _get_header(headers, "x-api-key")
+            if not api_key:
+                return 403, {}, b'{"message":"Forbidden"}', resource
+            request_context["identity"]["apiKey"] = api_key
+        else:
+            authorizer_context = self.authorize(
+                _get_header(headers, "authorization"), method, parts.path
+            )
+            if not isinstance(authorizer_context, dict):
+                status_code, message = authorizer_context
+                return (
+                    status_code,
+                    {},
+                    json.dumps({"message": message}).encode(),
+                    resource,
+                )
+            request_context["authorizer"] = authorizer_context
+
+        query = dict(parse_qsl(parts.query)) or None
+        event = {
+            "resource": resource,
+            "path": parts.path,
+            "httpMethod": method,
+            "headers": headers or None,
+            "pathParameters": path_params or None,
+            "queryStringParameters": query,
+            "requestContext": request_context,
+            # All media types are binary for the API
+            "body": base64.b64encode(body).decode() if body else None,
+            "isBase64Encoded": bool(body),
+        }
+        response = self.api_handler(event, None)
+
+        response_body = response.get("body") or ""
+        if response.get("isBase64Encoded"):
+            response_body = base64.b64decode(response_body)
+        else:
+            response_body = response_body.encode("utf-8")
+        return (
+            response["statusCode"],
+            response.get("headers") or {},
+            response_body,
+            resource,
+        )
+
+    def match(self, method, path):
+        """Returns (resource, path parameters) of the route matching the
+        request, or None"""
+        for pattern, resource, methods in self.routes:
+            match = pattern.match(path)
+            if match and method in methods:
+                return resource, match.groupdict()
+        return None
+
+    def authorize(self, authorization, method, path):
+        """Returns the authorizer context of the request, or (status code,
+        message) when it is not authorized"""
+        if not authorization or not authorization.startswith("Bearer "):
+            return 401, "Unauthorized"
+        token = authorization[len("Bearer ") :]
+
+        if self.authorizer is None:
+            kind, _, name = token.partition(":")
+            if kind == "user" and name:
+                return {"user": name}
+            if kind == "app" and name:
+                return {"client_id": name}
+            return 401, "Unauthorized"
+
+        with self._policies_lock:
+            cached = self._policies.get(token)
+        if cached is None or cached[0] < time.monotonic():
+            try:
+                policy = self.authorizer(
+                    {
+                        "authorizationToken": authorization,
+                        "methodArn": f"{METHOD_ARN_PREFIX}/{method}{path}",
+                    },
+                    None,
+                )
+            except Exception:
+                return 401, "Unauthorized"
+            cached = (time.monotonic() + AUTHORIZER_CACHE_SECONDS, policy)
+            with self._policies_lock:
+                self._policies[token] = cached
+
+        policy = cached[1]
+        if not _allowed(
+            policy["policyDocument"], f"{METHOD_ARN_PREFIX}/{method}{path}"
+        ):
+            return 403, "User is not authorized to access this resource"
+        return policy["context"]
+
+
+class LocalApiServer:
+    """HTTP server (in a background thread) in front of a LocalApi.
+
+    Usage:
+        with LocalApiServer(authorizer=True) as server:
+            requests.get(f"{server.url}/workspaces", headers=...)
+
+    args:
+        authorizer (bool): See LocalApi.
+        port (int): Port of the server, a free port by default.
+        token_latency_ms (float): Time taken by the token endpoint to respond
+            (Fence is not local in production).
+    """
+
+    def __init__(self, authorizer=False, port=0, token_latency_ms=0):
+        self._server = ThreadingHTTPServer(("127.0.0.1", port), _RequestHandler)
+        self._server.daemon_threads = True
+        self._server.token_latency_ms = token_latency_ms
+        self.url = f"http://127.0.0.1:{self._server.server_address[1]}"
+        self.api = self._server.api = LocalApi(authorizer=authorizer, jwks_url=self.url)
+        os.environ["auth_oidc_uri"] = self.url
+        self._thread = threading.Thread(target=self._server.serve_forever, daemon=True)
+
+    def __enter__(self):
+        self._thread.start()
+        return self
+
+    def __exit__(self, *exc_info):
+        self._server.shutdown()
+        self._server.server_close()
+
+
+class _RequestHandler(BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+
+    def do_GET(self):
+        if self.path == "/.well-known/jwks" and self.server.api.authorizer:
+            return self._respond(200, {}, json.dumps(self.server.api.jwks).encode())
+        self._handle()
+
+    def do_POST(self):
+        if self.path.startswith("/oauth2/token"):
+            return self._token()
+        self._handle()
+
+    def do_PUT(self):
+        self._handle()
+
+    def _handle(self):
+        length = int(self.headers.get("Content-Length") or 0)
+        body = self.rfile.read(length) if length else None
+        try:
+            status_code, headers, body, _ = self.server.api.invoke(
+                self.command, self.path, dict(self.headers.items()), body
+            )
+        except Exception as e:
+            logging.getLogger(__name__).exception(e)
+            status_code, headers, body = 502, {}, b'{"message":"Internal server error"}'
+        self._respond(status_code, headers, body)
+
+    def _token(self):
+        """Token endpoint of Fence, for the authorization_code and refresh_token
+        grants"""
+        self.rfile.read(int(self.headers.get("Content-Length") or 0))
+        time.sleep(self.server.token_latency_ms / 1000)
+        tokens = {
+            name: f"local-{name}-{time.time_ns()}"
+            for name in ("access_token", "id_token", "refresh_token")
+        }
+        self._respond(200, {}, json.dumps(tokens).encode())
+
+    def _respond(self, status_code, headers, body):
+        self.send_response(status_code)
+        for name, value in headers.items():
+            self.send_header(name, value)
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        pass
+
+
+def _api_module():
+    # Imported once the environment of the function is set
+    from lambdas.workspaces_api_resource import workspaces_api_resource_handler
+
+    return workspaces_api_resource_handler
+
+
+def _compile_routes(routes):
+    """Regular expressions of the resources, the literal ones first (API Gateway
+    prefers /workspaces/total-usage over /workspaces/{workspace_id})"""
+    compiled = []
+    for resource, methods in routes.items():
+        pattern = re.sub(r"\\{(\w+)\\}", r"(?P<\1>[^/]+)", re.escape(resource))
+        compiled.append((re.compile(f"^{pattern}$"), resource, set(methods)))
+    return sorted(compiled, key=lambda route: route[1].count("{"))
+
+
+def _allowed(policy_document, method_arn):
+    allowed = False
+    for statement in policy_document["Statement"]:
+        resources = statement["Resource"]
+        if isinstance(resources, str):
+            resources = [resources]
+        if any(fnmatch.fnmatchcase(method_arn, r) for r in resources):
+            if statement["Effect"] == "Deny":
+                return False
+            allowed = True
+    return allowed
+
+
+def _get_header(headers, name):
+    for key, value in headers.items():
+        if key.lower() == name:
+            return value
+    return None
+
+
+def _free_port():
+    with socket.socket() as s:
+        s.bind(("127.0.0.1", 0))
+        return s.getsockname()[1]
+
+
+@contextlib.contextmanager
+def _environment(variables):
+    previous = {name: os.environ.get(name) for name in variables}
+    os.environ.update(variables)
+    try:
+        yield
+    finally:
+        for name, value in previous.items():
+            if value is None:
+                os.environ.pop(name, None)
+            else:
+                os.environ[name] = value
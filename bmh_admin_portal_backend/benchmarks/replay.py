@@ -0,0 +1,467 @@
+""" Replay of production API events
+
+Extracts the API Gateway events logged by the API function from exported
+CloudWatch logs, sanitizes them, and replays them against the local API handler
+(benchmarks.local_api, backed by moto) with their original timing, or
+accelerated. Reports the latency distribution of each route, and compares runs,
+e.g. of two versions of the code.
+
+The API function logs the complete events (redacted) when its log_full_payloads
+environment variable is enabled (otherwise only a summary, which can not be
+replayed), and truncates its log messages to log_max_chars: raise it (e.g. to
+100000) while capturing traffic.
+
+    $ cd bmh_admin_portal_backend
+    # Logs of the API function, e.g. exported with
+    # aws logs filter-log-events --log-group-name <group> --filter-pattern '"Event: "'
+    $ python -m benchmarks.replay extract logs.json --output events.jsonl
+    $ python -m benchmarks.replay run events.jsonl --speed 10 --output before.json
+    $ git checkout my-branch
+    $ python -m benchmarks.replay run events.jsonl --speed 10 --compare before.json
+    $ python -m benchmarks.replay diff before.json after.json
+
+Supported log formats: the JSON output of aws logs filter-log-events or
+get-log-events, JSON lines with "timestamp" and "message", and text lines
+starting with a timestamp (CloudWatch exports to S3, optionally gzipped).
+"""
+
+import argparse
+import copy
+import gzip
+import json
+import logging
+import re
+import sys
+import time
+from collections import defaultdict
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime
+
+from bmh_common.log_utils import decode_body, redact
+
+from .load_test import print_summary, summarize
+from .local_api import LocalApiServer, LocalAws, put_workspaces
+from .synthetic_workspaces import generate_workspaces
+
+EVENT_MARKER = "Event: "
+# Headers which change the response, the others are dropped
+KEPT_HEADERS = {
+    "accept",
+    "accept-encoding",
+    "content-type",
+    "if-none-match",
+    "x-profile",
+}
+_TIMESTAMP_PATTERN = re.compile(r"\d{4}-\d{2}-\d{2}T\d{2}:\d{2}:\d{2}(?:\.\d+)?Z?")
+
+
+def read_log_records(path):
+    """Yields the (timestamp in milliseconds or None, message) of the records of
+    an exported log file"""
+    opener = gzip.open if path.endswith(".gz") else open
+    with opener(path, "rt", encoding="utf-8") as f:
+        content = f.read()
+
+    try:
+        document = json.loads(content)
+    except ValueError:
+        document = None
+    if isinstance(document, dict) and isinstance(document.get("events"), list):
+        for record in document["events"]:
+            yield record.get("timestamp"), record.get("message", "")
+        return
+
+    for line in content.splitlines():
+        if line.startswith("{"):
+            try:
+                record = json.loads(line)
+            except ValueError:
+                record = None
+            if isinstance(record, dict) and "message" in record:
+                yield record.get("timestamp"), record["message"]
+                continue
+        match = _TIMESTAMP_PATTERN.search(line)
+        timestamp = None
+        if match:
+            parsed = datetime.fromisoformat(match.group(0).replace("Z", "+00:00"))
+            timestamp = int(parsed.timestamp() * 1000)
+        yield timestamp, line
+
+
+def extract_events(records, anonymize_users=False):
+    """Parses and sanitizes the events logged in the records.
+
+    args:
+        records: (timestamp, message) pairs, see read_log_records.
+        anonymize_users (bool): Replace the users (emails) with user<n>@example.org
+
+    return:
+        (events, counts) events are {"timestamp", "event"} sorted by timestamp,
+        counts has the number of events which were "extracted", "summaries"
+        (logged without log_full_payloads) and "truncated" (see log_max_chars).
+    """
+    events = []
+    counts = defaultdict(int)
+    users = {}
+    for timestamp, message in records:
+        start = message.find(EVENT_MARKER)
+        if start < 0:
+            continue
+        start = message.find("{", start)
+        try:
+            event, _ = json.JSONDecoder().raw_decode(message[start:])
+        except ValueError:
+            counts["truncated"] += 1
+            continue
+        if not isinstance(event, dict) or "httpMethod" not in event:
+            continue
+        if "requestContext" not in event:
+            counts["summaries"] += 1
+            continue
+
+        event = sanitize_event(event)
+        if anonymize_users:
+            _anonymize(event, users)
+        if timestamp is None:
+            timestamp = event["requestContext"].get("requestTimeEpoch")
+        events.append({"timestamp": timestamp, "event": event})
+        counts["extracted"] += 1
+
+    events.sort(key=lambda e: e["timestamp"] or 0)
+    return events, dict(counts)
+
+
+def sanitize_event(event):
+    """Redacts the tokens and keys (bmh_common.log_utils.redact), and drops the
+    headers and request context fields which are not needed to replay it"""
+    event = redact(decode_body(event))
+    headers = {
+        name: value
+        for name, value in (event.get("headers") or {}).items()
+        if name.lower() in KEPT_HEADERS
+    }
+    request_context = event.get("requestContext") or {}
+    return {
+        "resource": event["resource"],
+        "path": event.get("path"),
+        "httpMethod": event["httpMethod"],
+        "headers": headers or None,
+        "pathParameters": event.get("pathParameters"),
+        "queryStringParameters": event.get("queryStringParameters"),
+        "body": event.get("body"),
+        "isBase64Encoded": False,
+        "requestContext": {
+            "authorizer": request_context.get("authorizer"),
+            # Redacted, the handler only checks that there is one
+            "identity": {
+                "apiKey": (request_context.get("identity") or {}).get("apiKey")
+            },
+            "requestId": request_context.get("requestId"),
+            "requestTimeEpoch": request_context.get("requestTimeEpoch"),
+        },
+    }
+
+
+def _anonymize(event, users):
+    def anonymous(user):
+        if user not in users:
+            users[user] = f"user{len(users)}@example.org"
+        return users[user]
+
+    authorizer = event["requestContext"].get("authorizer") or {}
+    if authorizer.get("user"):
+        authorizer["user"] = anonymous(authorizer["user"])
+    query = event.get("queryStringParameters") or {}
+    if query.get("user"):
+        query["user"] = anonymous(query["user"])
+    body = _json_body(event)
+    if isinstance(body, dict):
+        for workspace in body.get("workspaces") or []:
+            if isinstance(workspace, dict) and workspace.get("user_id"):
+                workspace["user_id"] = anonymous(workspace["user_id"])
+        event["body"] = json.dumps(body)
+
+
+def replay_workspaces(events, workspaces_per_user=3, seed=0):
+    """Synthetic workspaces for the users and the workspace ids of the events:
+    the workspaces requested by id (owned by the user of the request when it is
+    known), and workspaces_per_user more for each user.
+
+    return:
+        (list) workspace items
+    """
+    owners = {}
+    users = set()
+    for e in events:
+        event = e["event"]
+        user = (event["requestContext"].get("authorizer") or {}).get("user")
+        query_user = (event.get("queryStringParameters") or {}).get("user")
+        user = user or query_user
+        if user:
+            users.add(user)
+        workspace_id = (event.get("pathParameters") or {}).get("workspace_id")
+        if workspace_id and workspace_id != "admin_all":
+            if user:
+                owners[workspace_id] = user
+            else:
+                owners.setdefault(workspace_id, None)
+        body = _json_body(event)
+        if isinstance(body, dict) and isinstance(body.get("workspaces"), list):
+            for workspace in body["workspaces"]:
+                if isinstance(workspace, dict) and workspace.get("workspace_id"):
+                    if workspace.get("user_id"):
+                        owners[workspace["workspace_id"]] = workspace["user_id"]
+                        users.add(workspace["user_id"])
+                    else:
+                        owners.setdefault(workspace["workspace_id"], None)
+
+    users = sorted(users) or ["owner@example.org"]
+    templates = generate_workspaces(
+        len(owners) + workspaces_per_user * len(users), seed=seed
+    )
+    items = []
+    for i, (workspace_id, user) in enumerate(sorted(owners.items())):
+        item = templates[i]
+        item.update(
+            user_id=user or users[i % len(users)],
+            bmh_workspace_id=workspace_id,
+            workspace_request_id=workspace_id,
+        )
+        items.append(item)
+    for i, item in enumerate(templates[len(owners) :]):
+        item["user_id"] = users[i % len(users)]
+        items.append(item)
+    return items
+
+
+def replay(handler, events, speed=1.0, concurrency=64):
+    """Invokes the handler with the events, at their original timing divided by
+    speed (speed 0 sends them as fast as possible).
+
+    return:
+        (results, elapsed seconds) results are {"route", "status", "latency_ms",
+        "lag_ms"} in the order of the events, lag_ms is the delay between the
+        scheduled and the actual start of the invocation.
+    """
+    results = [None] * len(events)
+    first = next((e["timestamp"] for e in events if e["timestamp"]), None)
+
+    def invoke(index, scheduled):
+        event = copy.deepcopy(events[index]["event"])
+        start = time.perf_counter()
+        try:
+            status = handler(event, None)["statusCode"]
+        except Exception as e:
+            status = f"exception {type(e).__name__}"
+        results[index] = {
+            "route": f"{event['httpMethod']} {event['resource']}",
+            "status": status,
+            "latency_ms": (time.perf_counter() - start) * 1000,
+            "lag_ms": max(0.0, (start - scheduled) * 1000),
+        }
+
+    start = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=concurrency) as executor:
+        for index, e in enumerate(events):
+            scheduled = start
+            if speed and first is not None and e["timestamp"]:
+                scheduled = start + (e["timestamp"] - first) / 1000 / speed
+                delay = scheduled - time.perf_counter()
+                if delay > 0:
+                    time.sleep(delay)
+            executor.submit(invoke, index, scheduled)
+    return results, time.perf_counter() - start
+
+
+def status_changes(before, after):
+    """Events whose status code differs between two runs of the same events
+
+    return:
+        [(index, route, status before, status after)]
+    """
+    if len(before) != len(after):
+        return []
+    return [
+        (i, a["route"], b["status"], a["status"])
+        for i, (b, a) in enumerate(zip(before, after))
+        if str(b["status"]) != str(a["status"])
+    ]
+
+
+def print_comparison(previous, current):
+    print_summary(current["routes"], previous["routes"])
+    if len(previous["events"]) != len(current["events"]):
+        print("\nThe runs replayed different events, statuses were not compared")
+        return
+    changes = status_changes(previous["events"], current["events"])
+    print(f"\n{len(changes)} events with a different status")
+    for index, route, before, after in changes[:20]:
+        print(f"  #{index} {route}: {before} -> {after}")
+
+
+def _json_body(event):
+    try:
+        return json.loads(decode_body(event).get("body") or "null")
+    except ValueError:
+        return None
+
+
+def _load_events(paths, anonymize_users=False):
+    """Events of JSON lines files written by extract, or of exported logs"""
+    events, counts = [], defaultdict(int)
+    for path in paths:
+        if path.endswith(".jsonl"):
+            with open(path) as f:
+                events.extend(json.loads(line) for line in f if line.strip())
+            continue
+        extracted, file_counts = extract_events(read_log_records(path), anonymize_users)
+        events.extend(extracted)
+        for name, count in file_counts.items():
+            counts[name] += count
+    events.sort(key=lambda e: e["timestamp"] or 0)
+    return events, dict(counts)
+
+
+def _print_counts(counts):
+    print(f"Extracted {counts.get('extracted', 0)} events")
+    if counts.get("summaries"):
+        print(
+            f"Skipped {counts['summaries']} event summaries, enable "
+            "log_full_payloads on the API function to log complete events"
+        )
+    if counts.get("truncated"):
+        print(
+            f"Skipped {counts['truncated']} truncated events, raise log_max_chars "
+            "on the API function"
+        )
+
+
+def extract_main(args):
+    events, counts = _load_events(args.logs, args.anonymize_users)
+    with open(args.output, "w") as f:
+        for event in events:
+            f.write(json.dumps(event) + "\n")
+    _print_counts(counts)
+    return 0
+
+
+def run_main(args):
+    events, counts = _load_events(args.events, args.anonymize_users)
+    if counts:
+        _print_counts(counts)
+    if not events:
+        print("No events to replay")
+        return 1
+    if not args.verbose:
+        # The handler logs every request and response
+        logging.disable(logging.WARNING)
+
+    with LocalAws(
+        server=args.moto_server,
+        total_usage_queue=args.total_usage_queue,
+        in_memory=args.in_memory,
+    ) as aws, LocalApiServer(token_latency_ms=args.token_latency_ms) as server:
+        put_workspaces(
+            replay_workspaces(events, args.workspaces_per_user), aws.topic_arn
+        )
+        if args.workspaces:
+            put_workspaces(generate_workspaces(args.workspaces, seed=1), aws.topic_arn)
+
+        span = (events[-1]["timestamp"] or 0) - (events[0]["timestamp"] or 0)
+        print(
+            f"Replaying {len(events)} events spanning {span / 1000:.1f} s"
+            + (f" at {args.speed}x" if args.speed else " as fast as possible")
+        )
+        results, elapsed = replay(
+            server.api.api_handler, events, args.speed, args.concurrency
+        )
+
+    latencies = defaultdict(list)
+    statuses = defaultdict(lambda: defaultdict(int))
+    for result in results:
+        latencies[result["route"]].append(result["latency_ms"])
+        statuses[result["route"]][result["status"]] += 1
+    lags = sorted(r["lag_ms"] for r in results)
+    current = {
+        "arguments": {k: v for k, v in vars(args).items() if k != "main"},
+        "elapsed": elapsed,
+        "routes": summarize(latencies, statuses, elapsed),
+        "events": [{"route": r["route"], "status": r["status"]} for r in results],
+    }
+    print(
+        f"Replayed in {elapsed:.1f} s, start lag p50 {lags[len(lags) // 2]:.1f} ms, "
+        f"max {lags[-1]:.1f} ms\n"
+    )
+
+    if args.compare:
+        with open(args.compare) as f:
+            print_comparison(json.load(f), current)
+    else:
+        print_summary(current["routes"])
+    if args.output:
+        with open(args.output, "w") as f:
+            json.dump(current, f, indent=2)
+    return 0
+
+
+def diff_main(args):
+    with open(args.before) as f:
+        before = json.load(f)
+    with open(args.after) as f:
+        after = json.load(f)
+    print_comparison(before, after)
+    return 0
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__.split("\n")[1])
+    commands = parser.add_subparsers(dest="command", required=True)
+
+    extract = commands.add_parser("extract", help="Write the sanitized events.")
+    extract.add_argument("logs", nargs="+", help="Exported log files.")
+    extract.add_argument("--output", required=True, help="JSON lines file.")
+    extract.add_argument("--anonymize-users", action="store_true")
+    extract.set_defaults(main=extract_main)
+
+    run = commands.add_parser("run", help="Replay events against the local API.")
+    run.add_argument(
+        "events", nargs="+", help="Files written by extract (.jsonl) or logs."
+    )
+    run.add_argument(
+        "--speed",
+        type=float,
+        default=1.0,
+        help="Acceleration of the original timing, 0 for as fast as possible.",
+    )
+    run.add_argument("--concurrency", type=int, default=64)
+    run.add_argument(
+        "--workspaces-per-user",
+        type=int,
+        default=3,
+        help="Workspaces seeded for each user of the events.",
+    )
+    run.add_argument(
+        "--workspaces", type=int, default=0, help="Other workspaces in the table."
+    )
+    run.add_argument(
+        "--token-latency-ms",
+        type=float,
+        default=0,
+        help="Response time of the local Fence token endpoint (/auth routes).",
+    )
+    run.add_argument("--moto-server", action="store_true")
+    run.add_argument("--in-memory", action="store_true")
+    run.add_argument("--total-usage-queue", action="store_true")
+    run.add_argument("--anonymize-users", action="store_true")
+    run.add_argument("--output", help="Write the results to this JSON file.")
+    run.add_argument("--compare", help="Results (JSON) of a previous run.")
+    run.add_argument("--verbose", action="store_true", help="Show the logs.")
+    run.set_defaults(main=run_main)
+
+    diff = commands.add_parser("diff", help="Compare the results of two runs.")
+    diff.add_argument("before")
+    diff.add_argument("after")
+    diff.set_defaults(main=diff_main)
+
+    args = parser.parse_args()
+    sys.exit(args.main(args))
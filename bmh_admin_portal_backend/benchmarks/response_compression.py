@@ -0,0 +1,85 @@
+""" Benchmark of API response compression
+
+Reports the size and the time to serialize, compress (gzip levels, and brotli when
+it is installed) and base64 encode a synthetic workspace listing, as returned by
+GET /workspaces/admin_all.
+
+    $ cd bmh_admin_portal_backend
+    $ python -m benchmarks.response_compression --workspaces 5000
+"""
+
+import argparse
+import base64
+import gzip
+import time
+
+from lambdas.workspaces_api_resource.workspaces_api_resource_handler import (
+    brotli,
+    to_json,
+)
+
+from .synthetic_workspaces import generate_workspaces, listing_projection
+
+
+def _time(function, repeat):
+    """Returns the result of function and its best run time in milliseconds"""
+    best = None
+    for _ in range(repeat):
+        start = time.perf_counter()
+        result = function()
+        elapsed = (time.perf_counter() - start) * 1000
+        best = elapsed if best is None else min(best, elapsed)
+    return result, best
+
+
+def main(args):
+    items = generate_workspaces(args.workspaces)
+    if args.listing:
+        items = listing_projection(items)
+
+    body, serialize_ms = _time(lambda: to_json(items), args.repeat)
+    body_bytes = body.encode("utf-8")
+
+    codecs = [
+        (f"gzip -{level}", lambda level=level: gzip.compress(body_bytes, level))
+        for level in (1, 6, 9)
+    ]
+    if brotli is not None:
+        codecs += [
+            (f"br q{quality}", lambda q=quality: brotli.compress(body_bytes, quality=q))
+            for quality in (1, 5, 11)
+        ]
+
+    print(f"{args.workspaces} workspaces, serialized in {serialize_ms:.1f} ms")
+    # "bytes" is what the client downloads, "base64" counts against the lambda
+    # response payload limit (6 MB).
+    print(
+        f"{'encoding':>10} {'bytes':>10} {'base64':>10} {'ratio':>7} "
+        f"{'compress (ms)':>14} {'base64 (ms)':>12}"
+    )
+    print(
+        f"{'identity':>10} {len(body_bytes):>10} {'-':>10} {1:>7.2f} "
+        f"{0:>14.1f} {0:>12.1f}"
+    )
+    for name, compress in codecs:
+        compressed, compress_ms = _time(compress, args.repeat)
+        encoded, base64_ms = _time(lambda: base64.b64encode(compressed), args.repeat)
+        print(
+            f"{name:>10} {len(compressed):>10} {len(encoded):>10} "
+            f"{len(body_bytes) / len(compressed):>7.2f} "
+            f"{compress_ms:>14.1f} {base64_ms:>12.1f}"
+        )
+    if brotli is None:
+        print("brotli is not installed, only gzip was measured")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__.split("\n")[1])
+    parser.add_argument("--workspaces", type=int, default=5000)
+    parser.add_argument(
+        "--listing",
+        action="store_true",
+        help="Only keep the attributes of GET /workspaces (admin_all returns all).",
+    )
+    parser.add_argument("--repeat", type=int, default=5)
+    main(parser.parse_args())
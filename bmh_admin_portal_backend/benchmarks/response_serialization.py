@@ -0,0 +1,102 @@
+""" Benchmark of API response serialization and logging
+
+Compares the previous create_response, which serialized the body with CustomEncoder
+and then serialized the whole response again to log it, with the current one which
+serializes the body once (compact separators, default= function) and logs a
+truncated line. Logs are written to an in-memory stream so that the time spent
+formatting and writing them is included.
+
+    $ cd bmh_admin_portal_backend
+    $ python -m benchmarks.response_serialization --workspaces 5000
+"""
+
+import argparse
+import decimal
+import io
+import json
+import logging
+import time
+
+from bmh_common.log_utils import max_chars
+from lambdas.workspaces_api_resource import workspaces_api_resource_handler as api
+
+from .synthetic_workspaces import generate_workspaces, listing_projection
+
+
+def _time(function, repeat):
+    """Returns the result of function and its best run time in milliseconds"""
+    best = None
+    for _ in range(repeat):
+        start = time.perf_counter()
+        result = function()
+        elapsed = (time.perf_counter() - start) * 1000
+        best = elapsed if best is None else min(best, elapsed)
+    return result, best
+
+
+# JSON encoder of the previous create_response
+class CustomEncoder(json.JSONEncoder):
+    def default(self, obj):
+        if isinstance(obj, set):
+            return list(obj)
+        # Handle Decimal types which DynamoDB uses for numbers
+        if isinstance(obj, decimal.Decimal):
+            return float(obj)
+        return json.JSONEncoder.default(self, obj)
+
+
+def legacy_create_response(body, status_code=200):
+    """create_response before the body was serialized only once"""
+    headers = {"Access-Control-Allow-Origin": "*"}
+    retval = {
+        "statusCode": status_code,
+        "headers": headers,
+        "body": json.dumps(body, cls=CustomEncoder),
+    }
+
+    api.logger.info("Response: ")
+    api.logger.info(json.dumps(retval))
+    return retval
+
+
+def main(args):
+    items = generate_workspaces(args.workspaces)
+    if args.listing:
+        items = listing_projection(items)
+
+    stream = io.StringIO()
+    api.logger.handlers = [logging.StreamHandler(stream)]
+    api.logger.propagate = False
+
+    print(
+        f"{args.workspaces} workspaces, "
+        f"log truncated at {max_chars(api.logger)} characters"
+    )
+    print(f"{'version':>10} {'body (bytes)':>13} {'log (bytes)':>12} {'time (ms)':>10}")
+    for name, create_response in [
+        ("previous", legacy_create_response),
+        ("current", api.create_response),
+    ]:
+
+        def run():
+            stream.seek(0)
+            stream.truncate()
+            return create_response(body=items)
+
+        response, elapsed_ms = _time(run, args.repeat)
+        print(
+            f"{name:>10} {len(response['body'].encode('utf-8')):>13} "
+            f"{len(stream.getvalue().encode('utf-8')):>12} {elapsed_ms:>10.1f}"
+        )
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__.split("\n")[1])
+    parser.add_argument("--workspaces", type=int, default=5000)
+    parser.add_argument(
+        "--listing",
+        action="store_true",
+        help="Only keep the attributes of GET /workspaces (admin_all returns all).",
+    )
+    parser.add_argument("--repeat", type=int, default=5)
+    main(parser.parse_args())
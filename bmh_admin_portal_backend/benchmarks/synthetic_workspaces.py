@@ -0,0 +1,96 @@
+""" Synthetic workspace items
+
+Generates items shaped like the ones stored in the workspaces DynamoDB table (same
+attribute names and types, numbers as Decimal like boto3 returns them), for the
+benchmarks of the API handler.
+"""
+
+import decimal
+import random
+import uuid
+
+from bmh_common.workspace_repository import changes_shard
+from lambdas.workspaces_api_resource.workspaces_api_resource_handler import (
+    VALID_WORKSPACE_TYPES,
+    WORKSPACE_ATTRIBUTES,
+)
+
+REQUEST_STATUSES = ["pending", "active", "active", "active", "above limit", "failed"]
+SERVICES = [
+    "Amazon Elastic Compute Cloud - Compute",
+    "EC2 - Other",
+    "Amazon Simple Storage Service",
+    "Amazon Elastic File System",
+    "Amazon Virtual Private Cloud",
+    "AmazonCloudWatch",
+    "AWS Key Management Service",
+    "Amazon Elastic Container Service",
+]
+
+
+def generate_workspaces(
+    num_workspaces, num_users=None, seed=0, cost_breakdown_months=0
+):
+    """Returns a list of num_workspaces workspace items.
+
+    args:
+        num_workspaces: (int) Number of items.
+        num_users: (int) Number of distinct user_ids, defaults to one user for every
+            3 workspaces.
+        seed: (int) Seed for the random generator.
+        cost_breakdown_months: (int) Months of cost-breakdown (per service costs)
+            of the workspaces which are not pending, the largest attribute of the
+            items of the deployed table. None by default.
+    """
+    rng = random.Random(seed)
+    num_users = num_users or max(1, num_workspaces // 3)
+
+    items = []
+    for i in range(num_workspaces):
+        workspace_id = str(uuid.UUID(int=rng.getrandbits(128)))
+        workspace_type = rng.choice(VALID_WORKSPACE_TYPES)
+        hard_limit = decimal.Decimal(rng.choice([225, 450, 900, 5000]))
+        creation_date = 1_650_000_000 + rng.randrange(60_000_000)
+        item = {
+            "user_id": f"researcher{i % num_users}@university.edu",
+            "bmh_workspace_id": workspace_id,
+            "workspace_request_id": workspace_id,
+            "workspace_type": workspace_type,
+            "request_status": rng.choice(REQUEST_STATUSES),
+            "nih_funded_award_number": str(rng.randrange(10**9, 10**10)),
+            "total-usage": round(decimal.Decimal(rng.uniform(0, 1000)), 2),
+            "strides-credits": decimal.Decimal(250),
+            "soft-limit": hard_limit / 2,
+            "hard-limit": hard_limit,
+            "direct_pay_limit": decimal.Decimal(0),
+            "creation_date": creation_date,
+            "usage_update_time": creation_date + rng.randrange(10_000_000),
+            "account_id": str(rng.randrange(10**11, 10**12)),
+            "sns-topic": f"arn:aws:sns:us-east-1:123456789012:workspace-{workspace_id}",
+            "subnet": i + 1,
+            "scientific_poc": "Researcher Name",
+            "project_short_title": "Synthetic workspace",
+            "record_type": "workspace",
+            "changes_shard": changes_shard(workspace_id),
+            "last_modified": 1000 * (creation_date + rng.randrange(10_000_000)),
+        }
+        if cost_breakdown_months and item["request_status"] != "pending":
+            item["cost-breakdown"] = _cost_breakdown(rng, cost_breakdown_months)
+        items.append(item)
+    return items
+
+
+def _cost_breakdown(rng, months):
+    return {
+        f"{2024 - month // 12}-{12 - month % 12:02d}": {
+            service: round(decimal.Decimal(rng.uniform(0, 100)), 2)
+            for service in rng.sample(SERVICES, rng.randint(2, len(SERVICES)))
+        }
+        for month in range(months)
+    }
+
+
+def listing_projection(items):
+    """Keeps the attributes returned by GET /workspaces"""
+    attributes = set(WORKSPACE_ATTRIBUTES)
+    return [{k: v for k, v in item.items() if k in attributes} for item in items]
@@ -10,9 +10,12 @@ from aws_cdk import (
     aws_iam as iam,
     aws_ssm as ssm,
     aws_dynamodb as dynamodb,
+    aws_events as events,
+    aws_events_targets as events_targets,
     aws_s3 as s3,
     aws_s3_deployment as s3_deployment,
     aws_secretsmanager as secretsmanager,
+    aws_sqs as sqs,
 )
 from aws_cdk.aws_lambda_python import PythonFunction
 
@@ -54,6 +57,24 @@ class BmhAdminPortalBackendStack(core.Stack):
             projection_type=dynamodb.ProjectionType.KEYS_ONLY,
         )
 
+        # Used by GET /workspaces/admin_all?changed_since=<timestamp>. Every workspace
+        # item has changes_shard ("workspace#<n>", see bmh_common/workspace_repository.py)
+        # and last_modified (epoch milliseconds). The shards spread the writes over
+        # several index partitions. All the attributes are projected, the changes have
+        # the same attributes as the admin_all listing. The changes of a single user
+        # are read from the table.
+        changes_index_name = "bmh-workspace-changes-index-" + dynamodb_table.node.addr
+        dynamodb_table.add_global_secondary_index(
+            partition_key=dynamodb.Attribute(
+                name="changes_shard", type=dynamodb.AttributeType.STRING
+            ),
+            sort_key=dynamodb.Attribute(
+                name="last_modified", type=dynamodb.AttributeType.NUMBER
+            ),
+            index_name=changes_index_name,
+            projection_type=dynamodb.ProjectionType.ALL,
+        )
+
         ssm.StringParameter(
             self,
             "workspace-dynamodb-table-parameter",
@@ -68,6 +89,13 @@ class BmhAdminPortalBackendStack(core.Stack):
             parameter_name=config["dynamodb_index_param_name"],
             string_value=index_name,
         )
+        ssm.StringParameter(
+            self,
+            "workspace-dynamodb-changes-gsi-parameter",
+            description="Dynamodb Table GSI name for Workspace changes",
+            parameter_name=config["dynamodb_changes_index_param_name"],
+            string_value=changes_index_name,
+        )
 
         ############################### Create API ##########################################
         log_group = logs.LogGroup(self, "bmh-workspaces-api-loggroup")
@@ -82,8 +110,14 @@ class BmhAdminPortalBackendStack(core.Stack):
                 stage_name="api",
             ),
             default_cors_preflight_options={
-                "allow_origins": apigateway.Cors.ALL_ORIGINS
+                "allow_origins": apigateway.Cors.ALL_ORIGINS,
+                # Conditional GET requests of workspaces (ETag)
+                "allow_headers": apigateway.Cors.DEFAULT_HEADERS
+                + ["If-None-Match", "X-Profile"],
             },
+            # Lets the lambda return compressed (base64 encoded) responses. Request
+            # bodies are then also passed to the lambda base64 encoded.
+            binary_media_types=["*/*"],
         )
 
         # Store the API URL in SSM parameter store
@@ -170,6 +204,31 @@ class BmhAdminPortalBackendStack(core.Stack):
         ########################################################################################
         # admin_vm = AdminVM(self, 'brh-admin-vm')
 
+        ########################################################################################
+        ##### Common lambda layer
+        ########################################################################################
+        ## Code shared by the lambdas (logging), importable from /opt/python.
+        common_layer = lambda_.LayerVersion(
+            self,
+            "common-layer",
+            code=lambda_.Code.asset("lambdas/common_layer"),
+            compatible_runtimes=[lambda_.Runtime.PYTHON_3_9],
+            description="Code shared by the BRH Admin Portal lambdas",
+        )
+        ## Sampling, size cap and redaction of the logs (see bmh_common/log_utils.py),
+        ## namespace of the embedded metrics (see bmh_common/instrumentation.py) and
+        ## opt-in profiling (see bmh_common/profiling.py)
+        log_environment = {
+            "log_sample_rates": config.get("log_sample_rates", ""),
+            "log_max_chars": str(config.get("log_max_chars", 4096)),
+            "log_full_payloads": str(config.get("log_full_payloads", False)).lower(),
+            "log_redact_fields": config.get("log_redact_fields", ""),
+            "metrics_namespace": config.get("metrics_namespace", "BRHAdminPortal"),
+            "profile_sample_rate": str(config.get("profile_sample_rate", 0)),
+            "profile_users": config.get("profile_users", ""),
+            "profile_s3_bucket": config.get("profile_s3_bucket", ""),
+        }
+
         ########################################################################################
         ##### Step Functions Workflow
         ########################################################################################
@@ -178,6 +237,8 @@ class BmhAdminPortalBackendStack(core.Stack):
             "provision_step_fn",
             brh_asset_bucket=brh_workspace_assets_bucket,
             dynamodb_table=dynamodb_table,
+            common_layer=common_layer,
+            log_environment=log_environment,
         )
         step_fn_workflow = provisioning_workflow.workflow
         ########################################################################################
@@ -201,9 +262,11 @@ class BmhAdminPortalBackendStack(core.Stack):
             handler="total_usage_trigger_handler.handler",
             timeout=core.Duration.seconds(600),
             description="Function which handles Total Usage SNS trigger for BRH Admin Portal",
+            layers=[common_layer],
             environment={
                 "DD_LOGS_ENABLED": "true",
                 "dynamodb_table_param_name": config["dynamodb_table_param_name"],
+                **log_environment,
             },
         )
 
@@ -221,6 +284,25 @@ class BmhAdminPortalBackendStack(core.Stack):
             )
         )
 
+        ## Queue which buffers total-usage updates. The workspace accounts' Cost and Usage
+        ## Reports are refreshed at about the same time, the API only enqueues the updates
+        ## and total-usage-queue-function applies them in batches. The API answers 202
+        ## instead of 200 when it enqueues, so it is only enabled by total_usage_queue_enabled.
+        total_usage_dlq = sqs.Queue(
+            self,
+            "total-usage-dlq",
+            retention_period=core.Duration.days(14),
+        )
+        total_usage_queue = sqs.Queue(
+            self,
+            "total-usage-queue",
+            # At least 6 times the timeout of the consumer function
+            visibility_timeout=core.Duration.seconds(6 * 120),
+            dead_letter_queue=sqs.DeadLetterQueue(
+                max_receive_count=5, queue=total_usage_dlq
+            ),
+        )
+
         ## Lambda function which handles the API Gateway endpoints.
         workspaces_resource_lambda = lambda_.Function(
             self,
@@ -230,10 +312,14 @@ class BmhAdminPortalBackendStack(core.Stack):
             handler="workspaces_api_resource_handler.handler",
             timeout=core.Duration.seconds(600),
             description="Function which handles API Gateway requests for BRH Admin Portal",
+            layers=[common_layer],
             environment={
                 "DD_LOGS_ENABLED": "true",
                 "dynamodb_table_param_name": config["dynamodb_table_param_name"],
                 "dynamodb_index_param_name": config["dynamodb_index_param_name"],
+                "dynamodb_changes_index_param_name": config[
+                    "dynamodb_changes_index_param_name"
+                ],
                 "api_usage_id_param_name": config["api_usage_id_param_name"],
                 "brh_asset_bucket": brh_workspace_assets_bucket.bucket_name,
                 "brh_portal_url": config["api_url_param_name"],
@@ -253,8 +339,33 @@ class BmhAdminPortalBackendStack(core.Stack):
                 "account_creation_asset_bucket_name": config[
                     "account_creation_asset_bucket_name"
                 ],
+                "total_usage_queue_url": (
+                    total_usage_queue.queue_url
+                    if config.get("total_usage_queue_enabled", False)
+                    else ""
+                ),
+                "response_compression_min_bytes": str(
+                    config.get("response_compression_min_bytes", 1024)
+                ),
+                "usage_update_min_interval_seconds": str(
+                    config.get("usage_update_min_interval_seconds", 0)
+                ),
+                # Updates skipped by usage_update_min_interval_seconds are
+                # delayed in the queue and applied when the interval is over
+                "total_usage_flush_queue_url": total_usage_queue.queue_url,
+                **log_environment,
             },
         )
+        total_usage_queue.grant_send_messages(workspaces_resource_lambda)
+        if config.get("profile_s3_bucket"):
+            workspaces_resource_lambda.add_to_role_policy(
+                iam.PolicyStatement(
+                    actions=["s3:PutObject"],
+                    resources=[
+                        f"arn:aws:s3:::{config['profile_s3_bucket']}/profiles/*"
+                    ],
+                )
+            )
 
         auth_client_secret_param.grant_read(workspaces_resource_lambda)
         step_fn_workflow.grant_start_execution(workspaces_resource_lambda)
@@ -323,6 +434,118 @@ class BmhAdminPortalBackendStack(core.Stack):
         dynamodb_table.grant_read_write_data(workspaces_resource_lambda)
         dynamodb_table.grant_read_write_data(total_usage_trigger_lambda)
 
+        ## Lambda function which applies the queued total-usage updates.
+        ## Shares the code of the API lambda.
+        total_usage_queue_lambda = lambda_.Function(
+            self,
+            "total-usage-queue-function",
+            runtime=lambda_.Runtime.PYTHON_3_9,
+            code=lambda_.Code.asset("lambdas/workspaces_api_resource"),
+            handler="total_usage_queue_handler.handler",
+            timeout=core.Duration.seconds(120),
+            description="Function which applies queued total usage updates for BRH Admin Portal",
+            layers=[common_layer],
+            environment={
+                "DD_LOGS_ENABLED": "true",
+                "dynamodb_table_param_name": config["dynamodb_table_param_name"],
+                "dynamodb_index_param_name": config["dynamodb_index_param_name"],
+                "email_domain": config["email_domain"],
+                "usage_update_min_interval_seconds": str(
+                    config.get("usage_update_min_interval_seconds", 0)
+                ),
+                # Updates skipped by usage_update_min_interval_seconds are
+                # delayed in the queue and applied when the interval is over
+                "total_usage_flush_queue_url": total_usage_queue.queue_url,
+                **log_environment,
+            },
+        )
+        total_usage_queue_lambda.add_to_role_policy(
+            iam.PolicyStatement(
+                actions=["ssm:GetParameters", "ssm:GetParameter"],
+                resources=[f"arn:aws:ssm:{self.region}:{self.account}:parameter/bmh/*"],
+            )
+        )
+        total_usage_queue_lambda.add_to_role_policy(
+            iam.PolicyStatement(actions=["sns:Publish"], resources=["*"])
+        )
+        dynamodb_table.grant_read_write_data(total_usage_queue_lambda)
+        total_usage_queue.grant_consume_messages(total_usage_queue_lambda)
+        total_usage_queue.grant_send_messages(total_usage_queue_lambda)
+
+        lambda_.EventSourceMapping(
+            self,
+            "total-usage-queue-event-source",
+            target=total_usage_queue_lambda,
+            event_source_arn=total_usage_queue.queue_arn,
+            batch_size=100,
+            max_batching_window=core.Duration.seconds(30),
+            report_batch_item_failures=True,
+        )
+
+        ## Optional job which updates total-usage of all workspaces from the consolidated
+        ## billing (payer) Cost and Usage Report. Shares the code of the API lambda.
+        if config.get("consolidated_cur_bucket"):
+            consolidated_cur_bucket = s3.Bucket.from_bucket_name(
+                self, "consolidated-cur-bucket", config["consolidated_cur_bucket"]
+            )
+            consolidated_usage_lambda = lambda_.Function(
+                self,
+                "consolidated-usage-function",
+                runtime=lambda_.Runtime.PYTHON_3_9,
+                code=lambda_.Code.asset("lambdas/workspaces_api_resource"),
+                handler="consolidated_usage_handler.handler",
+                timeout=core.Duration.seconds(900),
+                memory_size=2048,
+                description="Function which updates total usage of all workspaces from the consolidated billing CUR",
+                layers=[
+                    common_layer,
+                    lambda_.LayerVersion.from_layer_version_arn(
+                        self,
+                        "aws-sdk-pandas-layer",
+                        config["aws_sdk_pandas_layer_arn"],
+                    ),
+                ],
+                environment={
+                    "DD_LOGS_ENABLED": "true",
+                    "dynamodb_table_param_name": config["dynamodb_table_param_name"],
+                    "consolidated_cur_path": "/".join(
+                        [
+                            "s3:/",
+                            config["consolidated_cur_bucket"],
+                            config["consolidated_cur_prefix"],
+                        ]
+                    ),
+                    "email_domain": config["email_domain"],
+                    "usage_update_min_interval_seconds": str(
+                        config.get("usage_update_min_interval_seconds", 0)
+                    ),
+                    "total_usage_flush_queue_url": total_usage_queue.queue_url,
+                    **log_environment,
+                },
+            )
+            consolidated_cur_bucket.grant_read(consolidated_usage_lambda)
+            dynamodb_table.grant_read_write_data(consolidated_usage_lambda)
+            total_usage_queue.grant_send_messages(consolidated_usage_lambda)
+            consolidated_usage_lambda.add_to_role_policy(
+                iam.PolicyStatement(
+                    actions=["ssm:GetParameters", "ssm:GetParameter"],
+                    resources=[
+                        f"arn:aws:ssm:{self.region}:{self.account}:parameter/bmh/*"
+                    ],
+                )
+            )
+            consolidated_usage_lambda.add_to_role_policy(
+                iam.PolicyStatement(actions=["sns:Publish"], resources=["*"])
+            )
+
+            # Cost and Usage Reports are refreshed ~3 times a day.
+            events.Rule(
+                self,
+                "consolidated-usage-schedule",
+                schedule=events.Schedule.rate(core.Duration.hours(8)),
+                targets=[events_targets.LambdaFunction(consolidated_usage_lambda)],
+            )
+
         workspaces_resource_lambda_integration = apigateway.LambdaIntegration(
             handler=workspaces_resource_lambda
         )
@@ -356,6 +579,21 @@ class BmhAdminPortalBackendStack(core.Stack):
         )
         ######################################################################################
 
+        ################################ PUT workspaces/total-usage #########################
+        ## Static path, takes precedence over workspaces/{workspace_id}
+        bulk_total_usage = workspaces_resource.add_resource("total-usage")
+        bulk_total_usage.add_method(
+            "PUT", workspaces_resource_lambda_integration, authorizer=token_authorizer
+        )
+        ######################################################################################
+
+        ################################ POST workspaces/batch-get ##########################
+        batch_get = workspaces_resource.add_resource("batch-get")
+        batch_get.add_method(
+            "POST", workspaces_resource_lambda_integration, authorizer=token_authorizer
+        )
+        ######################################################################################
+
         ############################## GET workspaces/{workspace_id} #########################
         workspace_resource = workspaces_resource.add_resource("{workspace_id}")
         workspace_get = workspace_resource.add_method(
@@ -383,6 +621,12 @@ class BmhAdminPortalBackendStack(core.Stack):
             "PUT", workspaces_resource_lambda_integration, api_key_required=True
         )
 
+        ################ PUT workspaces/{workspace_id}/cost-breakdown #############################
+        cost_breakdown = workspace_resource.add_resource("cost-breakdown")
+        cost_breakdown.add_method(
+            "PUT", workspaces_resource_lambda_integration, api_key_required=True
+        )
+
         ################ PUT workspaces/{workspace_id}/direct-pay-limit #############################
         limits_resource = workspace_resource.add_resource("direct-pay-limit")
         limits_put = limits_resource.add_method(
@@ -390,6 +634,21 @@ class BmhAdminPortalBackendStack(core.Stack):
         )
         ######################################################################################
 
+        # binary_media_types=["*/*"] matches any Accept header, including the one of
+        # CORS preflight requests. Their MOCK integrations (default_cors_preflight_options)
+        # only map text payloads, they would fail with 500 when the payload is
+        # treated as binary.
+        for method in api.methods:
+            if method.http_method == "OPTIONS":
+                cfn_method = method.node.default_child
+                cfn_method.add_property_override(
+                    "Integration.ContentHandling", "CONVERT_TO_TEXT"
+                )
+                cfn_method.add_property_override(
+                    "Integration.IntegrationResponses.0.ContentHandling",
+                    "CONVERT_TO_TEXT",
+                )
+
         default_usage_plan = apigateway.UsagePlan(
             self,
             "default-usage-plan",
@@ -14,6 +14,7 @@ class BMHAdminPortalBackendConfig:
         return {
             "dynamodb_table_param_name": "/bmh/workspace-dynamodb-table",
             "dynamodb_index_param_name": "/bmh/workspace-dynamodb-gsindex",
+            "dynamodb_changes_index_param_name": "/bmh/workspace-dynamodb-changes-gsindex",
             "api_url_param_name": "/bmh/workspaces-api/url",
             "api_usage_id_param_name": "/bmh/usage_plan_id",
             "brh-workspace-assets-bucket": "/bmh/workspace-assets-bucket",
@@ -48,4 +49,37 @@ class BMHAdminPortalBackendConfig:
             "strides_credits_request_email": "",
             "strides_grant_request_email": "",
             "user_services_email": "",  # Emails regarding total_usage and updated limits are sent to user services from AWS SNS
+            # Optional: total-usage updates received less than this many seconds after the previous update of
+            # the same workspace are delayed in the total-usage queue until the interval is over (the last value
+            # is stored then), unless they cross the soft or hard limit. 0 disables it.
+            "usage_update_min_interval_seconds": 0,
+            # Optional: PUT /workspaces/{workspace_id}/total-usage enqueues the updates and answers 202 instead of
+            # applying them and answering 200. Only enable it once the CUR parsers of all the workspace accounts
+            # accept a 202 response.
+            "total_usage_queue_enabled": False,
+            # Optional: logging of the lambdas (see lambdas/common_layer/python/bmh_common/log_utils.py).
+            # Fraction of the records kept per level, e.g. "DEBUG=0,INFO=0.1", and maximum length of a message.
+            "log_sample_rates": "",
+            "log_max_chars": 4096,
+            # Log complete (redacted) events instead of a summary. Only meant for debugging.
+            "log_full_payloads": False,
+            # Comma separated field names redacted in addition to tokens, api keys and secrets.
+            "log_redact_fields": "",
+            # Optional: CloudWatch namespace of the latency metrics (embedded in the logs). Empty to disable them.
+            "metrics_namespace": "BRHAdminPortal",
+            # Optional: cProfile profiling of the API and step functions lambdas. Fraction of the invocations
+            # profiled, users who can request a profile with the X-Profile header, and bucket where the full
+            # profiles are written (otherwise only a summary is logged).
+            "profile_sample_rate": 0,
+            "profile_users": "",
+            "profile_s3_bucket": "",
+            # Optional: Cost and Usage Report (parquet) of the consolidated billing (payer) account.
+            # When a bucket is set, a scheduled job reads this report once and updates total-usage of
+            # every provisioned workspace, based on the account_id of the workspace.
+            # consolidated_cur_prefix should point to the report data, i.e. <prefix>/<report name>/<report name>
+            "consolidated_cur_bucket": "",
+            "consolidated_cur_prefix": "",
+            # ARN of the AWS SDK for pandas (awswrangler) lambda layer for python 3.9, used by the job above.
+            # https://aws-sdk-pandas.readthedocs.io/en/stable/layers.html
+            "aws_sdk_pandas_layer_arn": "",
         }
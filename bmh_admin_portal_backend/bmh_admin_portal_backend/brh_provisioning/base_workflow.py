@@ -17,6 +17,8 @@ class ProvisioningWorkflow(core.Construct):
         construct_id: str,
         brh_asset_bucket=None,
         dynamodb_table=None,
+        common_layer=None,
+        log_environment=None,
         **kwargs,
     ) -> None:
         super().__init__(scope, construct_id, **kwargs)
@@ -40,7 +42,7 @@ class ProvisioningWorkflow(core.Construct):
 
         # Create Lambda function to handle events.
         self.stepfn_lambda = self.create_stepfn_lambda(
-            config, brh_asset_bucket, dynamodb_table
+            config, brh_asset_bucket, dynamodb_table, common_layer, log_environment
         )
         ###################################################################################
 
@@ -55,7 +57,9 @@ class ProvisioningWorkflow(core.Construct):
         self.email_task = self.create_email_task()
         self.workflow = self.create_step_functions_workflow()
 
-    def create_stepfn_lambda(self, config, brh_asset_bucket, dynamodb_table):
+    def create_stepfn_lambda(
+        self, config, brh_asset_bucket, dynamodb_table, common_layer, log_environment
+    ):
         """Creates the lambda (and necessary permissions) which handles step function tasks"""
 
         stepfn_lambda = lambda_.Function(
@@ -66,6 +70,7 @@ class ProvisioningWorkflow(core.Construct):
             code=lambda_.Code.asset("lambdas/step_functions_handler"),
             handler="src.app.handler",
             description="Function which deploys BRH specific infrastructure (cost and usage, etc.) to member accounts.",
+            layers=[common_layer] if common_layer else None,
             environment={
                 "DD_LOGS_ENABLED": "true",
                 "brh_asset_bucket_param_name": config["brh-workspace-assets-bucket"],
@@ -76,6 +81,7 @@ class ProvisioningWorkflow(core.Construct):
                 "email_domain": config["email_domain"],
                 #  TODO: Add admin email SNS here to notify admins for each request.
                 # "provision_workspace_sns_topic": self.stepfn_event_topic.topic_arn
+                **(log_environment or {}),
             },
         )
         # self.stepfn_event_topic.grant_publish(stepfn_lambda)
@@ -124,6 +130,17 @@ class ProvisioningWorkflow(core.Construct):
             iam.PolicyStatement(actions=["ses:*"], resources=["*"])
         )
 
+        ## Grant permissions to write profiles (see bmh_common/profiling.py)
+        if config.get("profile_s3_bucket"):
+            stepfn_lambda.add_to_role_policy(
+                iam.PolicyStatement(
+                    actions=["s3:PutObject"],
+                    resources=[
+                        f"arn:aws:s3:::{config['profile_s3_bucket']}/profiles/*"
+                    ],
+                )
+            )
+
         return stepfn_lambda
 
     def create_occ_lambda_task(self, config):
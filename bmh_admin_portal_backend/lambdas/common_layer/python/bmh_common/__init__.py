@@ -0,0 +1,2 @@
+""" Code shared by the backend lambdas, deployed as a lambda layer (importable from
+/opt/python in the functions which use the layer). """
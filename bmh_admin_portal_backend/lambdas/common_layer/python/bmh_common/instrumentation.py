@@ -0,0 +1,323 @@
+""" Latency of the invocations and of the AWS calls they make, published as
+CloudWatch Embedded Metric Format (EMF) log lines, so no PutMetricData call is
+needed.
+
+AWS calls are timed with botocore before-call/after-call hooks registered on the
+default boto3 session, so every client created with boto3.client/boto3.resource
+is covered. The calls are attributed to the route of the current invocation.
+
+DynamoDB calls also request ReturnConsumedCapacity=INDEXES, and the read and
+write capacity units they consume are added up per route and operation (and per
+table/index), to find out which endpoints drive the on-demand bill.
+
+    metrics_namespace: CloudWatch namespace of the metrics (default BRHAdminPortal).
+        Empty to disable the metrics.
+
+Usage:
+    from bmh_common import instrumentation
+
+    @instrumentation.instrumented
+    def handler(event, context):
+        instrumentation.set_route("GET /workspaces/{workspace_id}")
+        instrumentation.set_properties(WorkspaceId=workspace_id)
+        ...
+"""
+
+import functools
+import json
+import os
+import sys
+import threading
+import time
+from collections import defaultdict
+
+import boto3
+
+DEFAULT_NAMESPACE = "BRHAdminPortal"
+UNKNOWN_ROUTE = "unknown"
+
+# EMF accepts at most 100 values per metric
+MAX_VALUES_PER_METRIC = 100
+
+# The capacity units of the other DynamoDB operations are write capacity units
+DYNAMODB_READ_OPERATIONS = frozenset(
+    ["GetItem", "BatchGetItem", "Query", "Scan", "TransactGetItems"]
+)
+
+_START_TIME_KEY = "bmh_instrumentation_start"
+
+_lock = threading.Lock()
+_current = None
+_cold_start = True
+
+
+class Invocation:
+    """AWS calls made during one invocation of the function"""
+
+    def __init__(self):
+        self.start = time.perf_counter()
+        self.route = UNKNOWN_ROUTE
+        # Logged with the metrics of the invocation, but not dimensions
+        self.properties = {}
+        # [{"service", "operation", "duration_ms", "error", "read_units",
+        #   "write_units", "units_by_index"}]
+        self.calls = []
+
+    def add_call(self, call):
+        with _lock:
+            self.calls.append(call)
+
+
+def instrumented(function):
+    """Decorator of lambda handlers: times the invocation and the AWS calls it
+    makes, and prints the EMF lines when it returns."""
+
+    @functools.wraps(function)
+    def wrapper(event, context):
+        namespace = os.environ.get("metrics_namespace", DEFAULT_NAMESPACE)
+        if not namespace:
+            return function(event, context)
+
+        global _current, _cold_start
+        register_hooks()
+        cold_start, _cold_start = _cold_start, False
+        invocation = _current = Invocation()
+
+        status_code = None
+        try:
+            retval = function(event, context)
+            if isinstance(retval, dict):
+                status_code = retval.get("statusCode")
+            return retval
+        except Exception:
+            status_code = "exception"
+            raise
+        finally:
+            _current = None
+            properties = {
+                "StatusCode": status_code,
+                "RequestId": getattr(context, "aws_request_id", None),
+                **invocation.properties,
+            }
+            for line in emf_lines(namespace, invocation, cold_start, properties):
+                emit(line)
+
+    return wrapper
+
+
+def set_route(route):
+    """Attributes the current invocation (and its AWS calls) to route"""
+    if _current is not None:
+        _current.route = route
+
+
+def set_properties(**properties):
+    """Adds properties (e.g. WorkspaceId) to the metrics of the current invocation.
+    They can be searched with CloudWatch Logs Insights but are not dimensions."""
+    if _current is not None:
+        _current.properties.update(properties)
+
+
+def register_hooks(session=None):
+    """Registers the hooks timing AWS calls. Only clients created after this call
+    are timed. Registering more than once has no effect."""
+    session = session or boto3._get_default_session()
+    events = session.events
+    events.register(
+        "before-parameter-build.dynamodb",
+        _request_consumed_capacity,
+        unique_id="bmh-instrumentation-consumed-capacity",
+    )
+    events.register(
+        "before-call", _before_call, unique_id="bmh-instrumentation-before-call"
+    )
+    events.register(
+        "after-call", _after_call, unique_id="bmh-instrumentation-after-call"
+    )
+    events.register(
+        "after-call-error",
+        _after_call_error,
+        unique_id="bmh-instrumentation-after-call-error",
+    )
+
+
+def _request_consumed_capacity(params, model, **kwargs):
+    if _current is None or "ReturnConsumedCapacity" not in model.input_shape.members:
+        return
+    if params.get("ReturnConsumedCapacity", "NONE") == "NONE":
+        params["ReturnConsumedCapacity"] = "INDEXES"
+
+
+def _before_call(context=None, **kwargs):
+    if _current is not None and context is not None:
+        context[_START_TIME_KEY] = time.perf_counter()
+
+
+def _after_call(event_name, context=None, http_response=None, parsed=None, **kwargs):
+    error = http_response is not None and http_response.status_code >= 300
+    _record_call(event_name, context, error, (parsed or {}).get("ConsumedCapacity"))
+
+
+def _after_call_error(event_name, context=None, **kwargs):
+    _record_call(event_name, context, True)
+
+
+def _record_call(event_name, context, error, consumed_capacity=None):
+    invocation = _current
+    if invocation is None or not context or _START_TIME_KEY not in context:
+        return
+    duration_ms = (time.perf_counter() - context.pop(_START_TIME_KEY)) * 1000
+    # e.g. after-call.dynamodb.Query
+    _, service, operation = event_name.split(".", 2)
+    call = {
+        "service": service,
+        "operation": operation,
+        "duration_ms": duration_ms,
+        "error": error,
+        "read_units": 0,
+        "write_units": 0,
+        "units_by_index": {},
+    }
+    if consumed_capacity:
+        _add_consumed_capacity(call, consumed_capacity)
+    invocation.add_call(call)
+
+
+def _add_consumed_capacity(call, consumed_capacity):
+    """consumed_capacity is a dict (single table operations) or a list (batch and
+    transaction operations) of ConsumedCapacity"""
+    if isinstance(consumed_capacity, dict):
+        consumed_capacity = [consumed_capacity]
+
+    is_read = call["operation"] in DYNAMODB_READ_OPERATIONS
+    for capacity in consumed_capacity:
+        units = capacity.get("CapacityUnits", 0)
+        call["read_units"] += capacity.get("ReadCapacityUnits", units if is_read else 0)
+        call["write_units"] += capacity.get(
+            "WriteCapacityUnits", 0 if is_read else units
+        )
+
+        table_name = capacity.get("TableName", "")
+        indexes = {table_name: capacity.get("Table")}
+        for index_type in ("GlobalSecondaryIndexes", "LocalSecondaryIndexes"):
+            for index_name, index_capacity in capacity.get(index_type, {}).items():
+                indexes[f"{table_name}/{index_name}"] = index_capacity
+        for name, index_capacity in indexes.items():
+            if index_capacity:
+                call["units_by_index"][name] = call["units_by_index"].get(
+                    name, 0
+                ) + index_capacity.get("CapacityUnits", 0)
+
+
+def emf_lines(namespace, invocation, cold_start, properties=None):
+    """Returns the EMF documents of an invocation: one with the duration (and the
+    consumed capacity) of the invocation per route, and one per AWS operation with
+    the latency and consumed capacity of its calls per route and service, and per
+    service and operation."""
+    function_name = os.environ.get("AWS_LAMBDA_FUNCTION_NAME", "local")
+    duration_ms = (time.perf_counter() - invocation.start) * 1000
+    timestamp = int(time.time() * 1000)
+
+    with _lock:
+        calls = list(invocation.calls)
+
+    lines = [
+        _emf(
+            namespace,
+            timestamp,
+            [["Function", "Route"]],
+            {
+                "Duration": ("Milliseconds", duration_ms),
+                "ColdStart": ("Count", int(cold_start)),
+                "AwsCalls": ("Count", len(calls)),
+                "AwsCallTime": (
+                    "Milliseconds",
+                    sum(c["duration_ms"] for c in calls),
+                ),
+                "ReadCapacityUnits": ("None", _sum(calls, "read_units")),
+                "WriteCapacityUnits": ("None", _sum(calls, "write_units")),
+            },
+            {
+                "Function": function_name,
+                "Route": invocation.route,
+                **(properties or {}),
+            },
+        )
+    ]
+
+    by_operation = defaultdict(list)
+    for call in calls:
+        by_operation[(call["service"], call["operation"])].append(call)
+
+    for (service, operation), operation_calls in sorted(by_operation.items()):
+        for i in range(0, len(operation_calls), MAX_VALUES_PER_METRIC):
+            chunk = operation_calls[i : i + MAX_VALUES_PER_METRIC]
+            lines.append(
+                _emf(
+                    namespace,
+                    timestamp,
+                    [
+                        ["Function", "Route", "Service"],
+                        ["Function", "Service", "Operation"],
+                    ],
+                    {
+                        "AwsCallLatency": (
+                            "Milliseconds",
+                            [c["duration_ms"] for c in chunk],
+                        ),
+                        "AwsCallCount": ("Count", len(chunk)),
+                        "AwsCallErrors": ("Count", sum(c["error"] for c in chunk)),
+                        "ReadCapacityUnits": ("None", _sum(chunk, "read_units")),
+                        "WriteCapacityUnits": ("None", _sum(chunk, "write_units")),
+                    },
+                    {
+                        "Function": function_name,
+                        "Route": invocation.route,
+                        "Service": service,
+                        "Operation": operation,
+                        "CapacityUnitsByIndex": _units_by_index(chunk),
+                    },
+                )
+            )
+    return lines
+
+
+def _sum(calls, key):
+    return float(sum(c[key] for c in calls))
+
+
+def _units_by_index(calls):
+    units = defaultdict(float)
+    for call in calls:
+        for name, value in call["units_by_index"].items():
+            units[name] += float(value)
+    return dict(units)
+
+
+def emit(document):
+    """EMF documents must be a log line of their own, which is why they are
+    printed rather than logged."""
+    sys.stdout.write(json.dumps(document, default=str) + "\n")
+    sys.stdout.flush()
+
+
+def _emf(namespace, timestamp, dimensions, metrics, properties):
+    """metrics: {name: (unit, value or list of values)}"""
+    document = {
+        "_aws": {
+            "Timestamp": timestamp,
+            "CloudWatchMetrics": [
+                {
+                    "Namespace": namespace,
+                    "Dimensions": dimensions,
+                    "Metrics": [
+                        {"Name": name, "Unit": unit}
+                        for name, (unit, _) in metrics.items()
+                    ],
+                }
+            ],
+        },
+    }
+    document.update(properties)
+    document.update({name: value for name, (_, value) in metrics.items()})
+    return document
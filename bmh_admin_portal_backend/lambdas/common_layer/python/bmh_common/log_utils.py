@@ -0,0 +1,280 @@
+""" Logging shared by the lambdas: per-level sampling, size caps and redaction of
+credentials, configured with environment variables of the function.
+
+    log_sample_rates: Fraction of the records kept per level, e.g. "DEBUG=0,INFO=0.1".
+        Levels which are not listed are always logged.
+    log_max_chars: Messages longer than this are truncated (default 4096).
+    log_full_payloads: "true" to log complete (redacted) events instead of a
+        summary. Meant for debugging.
+    log_redact_fields: Comma separated field names redacted in addition to
+        REDACTED_FIELDS.
+
+Usage:
+    from bmh_common.log_utils import get_logger, log_event
+
+    logger = get_logger(__name__)
+
+    def handler(event, context):
+        log_event(logger, event)
+"""
+
+import json
+import logging
+import os
+import random
+import re
+
+REDACTED = "***"
+
+# Compared after lower-casing and replacing dashes with underscores
+REDACTED_FIELDS = frozenset(
+    [
+        "authorization",
+        "authorizationtoken",
+        "access_token",
+        "id_token",
+        "refresh_token",
+        "token",
+        "api_key",
+        "apikey",
+        "x_api_key",
+        "client_secret",
+        "password",
+        "secret",
+    ]
+)
+
+# Query string parameters redacted in addition to the fields, e.g. the
+# authorization code in the URL of the token request
+REDACTED_QUERY_PARAMETERS = frozenset(["code"])
+
+DEFAULT_MAX_CHARS = 4096
+
+# Attributes of the event kept in the summary logged by log_event
+EVENT_SUMMARY_KEYS = [
+    "httpMethod",
+    "resource",
+    "path",
+    "action",
+    "source",
+    "detail-type",
+    "workspace_id",
+    "bmh_workspace_id",
+]
+
+_BEARER_PATTERN = re.compile(r"(Bearer\s+)[A-Za-z0-9\-._~+/]+=*", re.IGNORECASE)
+
+
+def get_logger(name):
+    """Returns the logger of a lambda module, with the sampling, size cap and
+    redaction filter configured from the environment. Records of other loggers
+    (e.g. botocore) are not filtered."""
+    logging.basicConfig(level=logging.INFO, format="%(message)s")
+    logger = logging.getLogger(name)
+    logger.setLevel(logging.INFO)
+    if not any(isinstance(f, LogFilter) for f in logger.filters):
+        logger.addFilter(LogFilter.from_environment())
+    return logger
+
+
+def log_event(logger, event, message="Event"):
+    """Logs a summary of the event of an invocation, or the complete (redacted)
+    event when log_full_payloads is enabled."""
+    if not logger.isEnabledFor(logging.INFO):
+        return
+    if _is_true(os.environ.get("log_full_payloads")):
+        payload = redact(decode_body(event))
+    else:
+        payload = summarize_event(event)
+    logger.info(f"{message}: {json.dumps(payload, default=str)}")
+
+
+def decode_body(event):
+    """Returns the event with its body decoded when API Gateway sent it base64
+    encoded, so that the fields of the body can be redacted."""
+    if not isinstance(event, dict) or not event.get("isBase64Encoded"):
+        return event
+    import base64
+
+    try:
+        body = base64.b64decode(event.get("body") or "").decode("utf-8")
+    except ValueError:
+        # Binary, not logged
+        body = REDACTED
+    return {**event, "body": body, "isBase64Encoded": False}
+
+
+def summarize_event(event):
+    """Keeps what identifies the invocation (route, request id, number of records)
+    and drops the headers and bodies."""
+    if not isinstance(event, dict):
+        return {"type": type(event).__name__}
+
+    summary = {key: event[key] for key in EVENT_SUMMARY_KEYS if key in event}
+
+    request_id = (event.get("requestContext") or {}).get("requestId")
+    if request_id is not None:
+        summary["requestId"] = request_id
+    if event.get("queryStringParameters"):
+        summary["queryStringParameters"] = redact(event["queryStringParameters"])
+    if event.get("body") is not None:
+        summary["body_length"] = len(event["body"])
+
+    records = event.get("Records")
+    if isinstance(records, list):
+        summary["records"] = len(records)
+        if records:
+            # SQS uses eventSource, SNS uses EventSource
+            summary["event_source"] = records[0].get("eventSource") or records[0].get(
+                "EventSource"
+            )
+    return summary
+
+
+def redact(value, fields=None):
+    """Returns a copy of value in which the values of sensitive fields are replaced.
+    Strings holding JSON (e.g. the body of an API Gateway event) are redacted as well.
+    """
+    fields = _redacted_fields() if fields is None else fields
+
+    if isinstance(value, dict):
+        return {
+            key: REDACTED if _normalize(key) in fields else redact(item, fields)
+            for key, item in value.items()
+        }
+    if isinstance(value, (list, tuple)):
+        return [redact(item, fields) for item in value]
+    if isinstance(value, str):
+        stripped = value.lstrip()
+        if stripped[:1] in ("{", "["):
+            try:
+                parsed = json.loads(value)
+            except ValueError:
+                return redact_text(value, fields)
+            return json.dumps(redact(parsed, fields))
+        return redact_text(value, fields)
+    return value
+
+
+def redact_text(text, fields=None):
+    """Redacts already formatted messages: bearer tokens, "field": "value" pairs,
+    including escaped JSON and python reprs (single quotes), and field=value
+    parameters of query strings (URLs)."""
+    fields = _redacted_fields() if fields is None else fields
+    text = _BEARER_PATTERN.sub(rf"\g<1>{REDACTED}", text)
+    text = _field_pattern(fields).sub(rf"\g<1>{REDACTED}", text)
+    return _query_pattern(fields).sub(rf"\g<1>{REDACTED}", text)
+
+
+def max_chars(logger):
+    """Returns the size cap (log_max_chars) of the messages of a logger returned by
+    get_logger, so that large values can be cut before formatting the message."""
+    for log_filter in logger.filters:
+        if isinstance(log_filter, LogFilter):
+            return log_filter.max_chars
+    return DEFAULT_MAX_CHARS
+
+
+def truncate(text, max_chars):
+    if len(text) <= max_chars:
+        return text
+    return text[:max_chars] + f"... [{len(text) - max_chars} more characters]"
+
+
+class LogFilter(logging.Filter):
+    """Drops a fraction of the records of each level, then redacts and truncates
+    the message of the records which are kept."""
+
+    def __init__(self, sample_rates=None, max_chars=DEFAULT_MAX_CHARS, fields=None):
+        super().__init__()
+        self.sample_rates = sample_rates or {}
+        self.max_chars = max_chars
+        self.fields = REDACTED_FIELDS if fields is None else fields
+
+    @classmethod
+    def from_environment(cls):
+        return cls(
+            sample_rates=parse_sample_rates(os.environ.get("log_sample_rates", "")),
+            max_chars=int(os.environ.get("log_max_chars", DEFAULT_MAX_CHARS)),
+            fields=_redacted_fields(),
+        )
+
+    def filter(self, record):
+        rate = self.sample_rates.get(record.levelno)
+        if rate is not None and random.random() >= rate:
+            return False
+
+        message = record.getMessage()
+        if self.fields:
+            message = redact_text(message, self.fields)
+        record.msg = truncate(message, self.max_chars)
+        record.args = None
+        return True
+
+
+def parse_sample_rates(value):
+    """Parses "DEBUG=0,INFO=0.1" into {logging.DEBUG: 0.0, logging.INFO: 0.1}
+
+    raises:
+        ValueError: unknown level or rate which is not a number between 0 and 1.
+    """
+    rates = {}
+    for entry in filter(None, (e.strip() for e in value.split(","))):
+        level_name, _, rate = entry.partition("=")
+        level = logging.getLevelName(level_name.strip().upper())
+        if not isinstance(level, int):
+            raise ValueError(f"Unknown log level in log_sample_rates: {level_name}")
+        rate = float(rate)
+        if not 0 <= rate <= 1:
+            raise ValueError(f"Sample rate of {level_name} must be between 0 and 1")
+        rates[level] = rate
+    return rates
+
+
+def _redacted_fields():
+    extra = os.environ.get("log_redact_fields", "")
+    return REDACTED_FIELDS | {_normalize(f) for f in extra.split(",") if f.strip()}
+
+
+def _normalize(key):
+    return str(key).strip().lower().replace("-", "_")
+
+
+_field_patterns = {}
+
+
+def _field_pattern(fields):
+    """Matches "field": "value" where the quotes may be escaped, field is case
+    insensitive and may use dashes or underscores. Group 1 is everything before
+    the value."""
+    fields = frozenset(fields)
+    pattern = _field_patterns.get(fields)
+    if pattern is None:
+        names = "|".join(
+            sorted(re.escape(f).replace("_", "[-_]") for f in fields) or ["(?!)"]
+        )
+        pattern = re.compile(
+            rf"""(\\*["']({names})\\*["']\s*:\s*\\*["'])[^"'\\]*""", re.IGNORECASE
+        )
+        _field_patterns[fields] = pattern
+    return pattern
+
+
+_query_patterns = {}
+
+
+def _query_pattern(fields):
+    """Matches field=value parameters of a query string (after "?", "&" or ";"),
+    for the fields and REDACTED_QUERY_PARAMETERS. Group 1 is everything before
+    the value."""
+    fields = frozenset(fields) | REDACTED_QUERY_PARAMETERS
+    pattern = _query_patterns.get(fields)
+    if pattern is None:
+        names = "|".join(sorted(re.escape(f).replace("_", "[-_]") for f in fields))
+        pattern = re.compile(rf"""([?&;]({names})=)[^&;#\s"']*""", re.IGNORECASE)
+        _query_patterns[fields] = pattern
+    return pattern
+
+
+def _is_true(value):
+    return str(value).lower() in ("1", "true", "yes")
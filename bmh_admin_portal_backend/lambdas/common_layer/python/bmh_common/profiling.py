@@ -0,0 +1,168 @@
+""" Opt-in cProfile profiling of lambda invocations, to see where the Python time
+of a slow route goes. Configured with environment variables of the function:
+
+    profile_sample_rate: Fraction of the invocations which are profiled (default 0).
+    profile_users: Comma separated users (authorizer context of API Gateway) who
+        can request a profile of their request with the X-Profile header.
+    profile_s3_bucket: Bucket where the full profiles (pstats files) are written.
+        When it is not set, only a summary is logged.
+    profile_top_functions: Number of functions in the logged summary (default 30).
+
+When neither profile_sample_rate nor profile_users is set, the decorator returns
+the handler unchanged, so it adds no overhead.
+
+Usage:
+    from bmh_common import profiling
+
+    @profiling.profiled
+    def handler(event, context):
+        ...
+"""
+
+import cProfile
+import functools
+import logging
+import os
+import pstats
+import random
+import tempfile
+import time
+
+PROFILE_HEADER = "x-profile"
+DEFAULT_TOP_FUNCTIONS = 30
+
+logger = logging.getLogger(__name__)
+logger.setLevel(logging.INFO)
+
+
+class ProfilingConfig:
+    def __init__(
+        self,
+        sample_rate=0.0,
+        users=(),
+        s3_bucket=None,
+        top_functions=DEFAULT_TOP_FUNCTIONS,
+    ):
+        self.sample_rate = sample_rate
+        self.users = frozenset(users)
+        self.s3_bucket = s3_bucket
+        self.top_functions = top_functions
+
+    @classmethod
+    def from_environment(cls):
+        return cls(
+            sample_rate=float(os.environ.get("profile_sample_rate") or 0),
+            users=[
+                u.strip()
+                for u in os.environ.get("profile_users", "").split(",")
+                if u.strip()
+            ],
+            s3_bucket=os.environ.get("profile_s3_bucket") or None,
+            top_functions=int(
+                os.environ.get("profile_top_functions") or DEFAULT_TOP_FUNCTIONS
+            ),
+        )
+
+    @property
+    def enabled(self):
+        return self.sample_rate > 0 or bool(self.users)
+
+    def should_profile(self, event):
+        if self.sample_rate > 0 and random.random() < self.sample_rate:
+            return True
+        return bool(self.users) and _requested_by_user(event, self.users)
+
+
+def profiled(function):
+    """Decorator of lambda handlers which profiles the sampled (or requested)
+    invocations. The environment is read when the module is imported."""
+    config = ProfilingConfig.from_environment()
+    if not config.enabled:
+        return function
+
+    @functools.wraps(function)
+    def wrapper(event, context):
+        if not config.should_profile(event):
+            return function(event, context)
+
+        profiler = cProfile.Profile()
+        profiler.enable()
+        try:
+            return function(event, context)
+        finally:
+            profiler.disable()
+            try:
+                report(profiler, config, event, context)
+            except Exception as e:
+                # Profiling must not fail the invocation
+                logger.exception(e)
+
+    return wrapper
+
+
+def report(profiler, config, event, context):
+    """Logs a summary of the profile, and writes the full profile to S3 when
+    profile_s3_bucket is set."""
+    stats = pstats.Stats(profiler)
+    name = _invocation_name(event)
+    logger.info(
+        f"Profile of {name} (top {config.top_functions} functions by cumulative time)\n"
+        + summarize(stats, config.top_functions)
+    )
+
+    if config.s3_bucket:
+        key = _s3_key(context)
+        upload_stats(stats, config.s3_bucket, key)
+        logger.info(f"Full profile written to s3://{config.s3_bucket}/{key}")
+
+
+def summarize(stats, top_functions):
+    """One line per function: cumulative and own time (ms), number of calls and
+    the function (file shortened to its last two path components)."""
+    rows = sorted(stats.stats.items(), key=lambda item: item[1][3], reverse=True)
+    lines = [f"{'cum (ms)':>10} {'own (ms)':>10} {'calls':>8}  function"]
+    for (filename, line, function_name), (_, ncalls, tottime, cumtime, _) in rows[
+        :top_functions
+    ]:
+        location = "/".join(filename.split(os.sep)[-2:])
+        lines.append(
+            f"{cumtime * 1000:>10.1f} {tottime * 1000:>10.1f} {ncalls:>8}  "
+            f"{location}:{line}({function_name})"
+        )
+    return "\n".join(lines)
+
+
+def upload_stats(stats, bucket, key):
+    """Writes the stats in the pstats format (open with pstats or snakeviz)"""
+    import boto3
+
+    with tempfile.NamedTemporaryFile(suffix=".prof") as f:
+        stats.dump_stats(f.name)
+        boto3.client("s3").upload_file(f.name, bucket, key)
+
+
+def _requested_by_user(event, users):
+    headers = (event or {}).get("headers") or {}
+    requested = any(
+        name.lower() == PROFILE_HEADER and str(value).lower() in ("1", "true")
+        for name, value in headers.items()
+    )
+    if not requested:
+        return False
+    authorizer = ((event or {}).get("requestContext") or {}).get("authorizer") or {}
+    return authorizer.get("user") in users
+
+
+def _invocation_name(event):
+    if isinstance(event, dict):
+        if "httpMethod" in event:
+            return f"{event['httpMethod']} {event.get('resource')}"
+        if "action" in event:
+            return event["action"]
+    return "invocation"
+
+
+def _s3_key(context):
+    function_name = os.environ.get("AWS_LAMBDA_FUNCTION_NAME", "local")
+    request_id = getattr(context, "aws_request_id", None) or str(int(time.time()))
+    return f"profiles/{function_name}/{time.strftime('%Y/%m/%d')}/{request_id}.prof"
@@ -0,0 +1,904 @@
+""" Data access of the workspaces table, shared by the lambdas which read or write
+workspaces, so that keys, expressions and error mapping are written once.
+
+Two implementations with the same semantics:
+    DynamoDBWorkspaceRepository: the bmh-workspace-table (user_id, bmh_workspace_id),
+        its index on bmh_workspace_id and its index on changes_shard/last_modified.
+    InMemoryWorkspaceRepository: a dict, for tests and benchmarks which do not
+        need DynamoDB (or moto).
+
+Every write sets record_type, last_modified (epoch milliseconds) and
+changes_shard, the keys of the index used by
+GET /workspaces/admin_all?changed_since=<timestamp>. The index is sharded on
+changes_shard ("workspace#<n>", from the workspace id) so that the writes of all
+the workspaces are not on a single index partition, which sustains about 1000
+writes per second; reads query every shard.
+
+A workspace is stored as two items of the partition of its user:
+    the workspace item (bmh_workspace_id): HOT_ATTRIBUTES, the keys, status,
+        usage and limits, which are read and updated by the busy paths;
+    the request details item (details_id(bmh_workspace_id)): the other attributes
+        (the fields of the request form, the cost breakdown), only read by
+        get_details (GET /workspaces/{workspace_id}).
+The details item has no last_modified and its sort key sorts after the workspace
+ids, so lookups, queries and updates of workspaces only read the small items. A
+scan (list_all) still reads the details items, and consumes read capacity for
+them, before filtering them out. The two items are written in a transaction.
+
+Usage:
+    from bmh_common.workspace_repository import (
+        DynamoDBWorkspaceRepository,
+        WorkspaceNotFoundError,
+    )
+
+    repository = DynamoDBWorkspaceRepository(table_name, index_name=index_name)
+    user_id = repository.find_user_id(workspace_id)
+    repository.update(workspace_id, user_id, {"request_status": "active"})
+"""
+
+import copy
+import decimal
+import heapq
+import random
+import threading
+import time
+import zlib
+from concurrent.futures import ThreadPoolExecutor
+
+import boto3
+from boto3.dynamodb.types import TypeDeserializer
+from botocore.exceptions import ClientError
+
+WORKSPACE_RECORD_TYPE = "workspace"
+DETAILS_RECORD_TYPE = "workspace_details"
+
+# Sort key prefix of the request details items. "~" sorts after the characters of
+# the workspace ids (UUIDs), so a query of the workspaces of a user ends before the
+# details items.
+DETAILS_ID_PREFIX = "~details#"
+
+# Number of partition keys of the changes index. Changing it requires setting
+# changes_shard again on every workspace item (scripts/backfill_last_modified.py).
+CHANGES_INDEX_SHARDS = 8
+
+# Attributes stored on the workspace item, the others are request details
+HOT_ATTRIBUTES = frozenset(
+    [
+        "user_id",
+        "bmh_workspace_id",
+        "workspace_request_id",
+        "record_type",
+        "last_modified",
+        "changes_shard",
+        "workspace_type",
+        "request_status",
+        "creation_date",
+        "provision_time",
+        "root_account_email",
+        "account_id",
+        "api-key",
+        "sns-topic",
+        "subnet",
+        "ecs",
+        "local",
+        "total-usage",
+        "usage_update_time",
+        "usage_reported_at",
+        "strides-credits",
+        "soft-limit",
+        "hard-limit",
+        "limit_update_time",
+        "direct_pay_limit",
+        # Returned by the listings
+        "nih_funded_award_number",
+        "scientific_poc",
+    ]
+)
+
+# BatchGetItem accepts at most 100 keys per request
+BATCH_GET_CHUNK_SIZE = 100
+BATCH_GET_MAX_ATTEMPTS = 5
+
+# Above this number of workspaces, find_user_ids scans the (keys only) index
+# instead of querying it once per workspace.
+USER_LOOKUP_SCAN_THRESHOLD = 100
+USER_LOOKUP_MAX_WORKERS = 16
+
+
+class WorkspaceNotFoundError(Exception):
+    """Raised when a workspace is expected to exist and does not"""
+
+
+class UpdateCoalescedError(Exception):
+    """Raised when a total-usage update is not written because the previous one was
+    less than min_interval seconds ago. It can be applied in retry_after seconds."""
+
+    def __init__(self, retry_after):
+        super().__init__(f"Total usage updated recently, retry in {retry_after}s")
+        self.retry_after = retry_after
+
+
+class WorkspaceRepository:
+    """Operations on the workspaces. Items are dicts of DynamoDB types (numbers are
+    decimal.Decimal). attributes limits the attributes of the returned items
+    (all of them when None). Except get_details and update_details, they only
+    read and write the workspace items, not the request details."""
+
+    def put(self, item):
+        """Creates or replaces a workspace, split into its workspace item and its
+        request details item (see split_details)."""
+        raise NotImplementedError
+
+    def put_many(self, items):
+        """Creates or replaces workspaces, in batches."""
+        raise NotImplementedError
+
+    def get(self, workspace_id, user_id, attributes=None):
+        """return:
+        item (dict): None when the workspace does not exist."""
+        raise NotImplementedError
+
+    def get_details(self, workspace_id, user_id, attributes=None):
+        """return:
+        details (dict): request details of the workspace, without the keys. Empty
+            when the workspace has no details item."""
+        raise NotImplementedError
+
+    def find_user_id(self, workspace_id):
+        """Looks up the user of a workspace with the bmh_workspace_id index.
+
+        return:
+            user_id (str): None when the workspace does not exist (or is not unique).
+        """
+        raise NotImplementedError
+
+    def find_user_ids(self, workspace_ids):
+        """Looks up the users of many workspaces.
+
+        return:
+            user_ids (dict): {workspace_id: user_id}, workspaces which were not found
+                (or are not unique) are missing.
+        """
+        raise NotImplementedError
+
+    def list_by_user(self, user_id, attributes=None):
+        """return:
+        items (list): workspaces of the user, by bmh_workspace_id."""
+        raise NotImplementedError
+
+    def list_all(self, attributes=None, having=()):
+        """Iterates over all the workspaces (every page of a scan).
+
+        args:
+            attributes (list): Attributes of the items, all when None.
+            having (list): Only the items which have all these attributes.
+        """
+        raise NotImplementedError
+
+    def list_changed(self, changed_since, user_id=None, attributes=None):
+        """The changes of all the workspaces are read from the changes index, the
+        changes of a user from the user's partition of the table.
+
+        return:
+            items (list): workspaces modified after changed_since (epoch
+                milliseconds), of user_id when given, by last_modified.
+        """
+        raise NotImplementedError
+
+    def batch_get(self, keys, attributes=None):
+        """args:
+            keys (list): [(workspace_id, user_id)]
+
+        return:
+            items (list): the workspaces which exist, in no particular order.
+        """
+        raise NotImplementedError
+
+    def update(self, workspace_id, user_id, values):
+        """Sets attributes of an existing workspace.
+
+        args:
+            values (dict): {attribute name: value}
+
+        return:
+            item (dict): all the attributes of the workspace after the update.
+
+        raises:
+            WorkspaceNotFoundError: the workspace does not exist.
+        """
+        raise NotImplementedError
+
+    def update_details(self, workspace_id, user_id, values):
+        """Sets request details of a workspace, creating its details item when it
+        does not exist (workspaces created before the split). The caller checks
+        that the workspace exists.
+
+        args:
+            values (dict): {attribute name: value}
+
+        return:
+            details (dict): request details of the workspace after the update.
+        """
+        raise NotImplementedError
+
+    def update_total_usage(
+        self, workspace_id, user_id, total_usage, min_interval=0, reported_at=None
+    ):
+        """Sets total-usage (and usage_update_time), unless it did not change.
+
+        When min_interval (seconds) is set, an update less than min_interval seconds
+        after the previous one is not written unless it crosses the soft or hard
+        limit, UpdateCoalescedError tells the caller when to apply it again.
+
+        When reported_at is set, it is stored as usage_reported_at, and usage
+        reported before the stored usage_reported_at is dropped, so that updates
+        which are delivered out of order do not overwrite a more recent one.
+
+        args:
+            total_usage (decimal.Decimal): New (rounded) total usage.
+            reported_at (int): When the usage was reported, in epoch milliseconds.
+
+        return:
+            item (dict): all the attributes of the workspace before the update,
+                None when the update was skipped (unchanged or out of date).
+
+        raises:
+            WorkspaceNotFoundError: the workspace does not exist.
+            UpdateCoalescedError: the update must be applied again later.
+        """
+        raise NotImplementedError
+
+
+class DynamoDBWorkspaceRepository(WorkspaceRepository):
+    """Workspaces of a DynamoDB table. The table and index names may be functions
+    (e.g. reading an SSM parameter), called when the name is first needed."""
+
+    def __init__(
+        self, table_name, index_name=None, changes_index_name=None, dynamodb=None
+    ):
+        self._names = {
+            "table": table_name,
+            "index": index_name,
+            "changes_index": changes_index_name,
+        }
+        self._dynamodb = dynamodb
+        self._table = None
+
+    def _name(self, key):
+        name = self._names[key]
+        if callable(name):
+            name = self._names[key] = name()
+        if name is None:
+            raise ValueError(f"The {key.replace('_', ' ')} name was not given")
+        return name
+
+    @property
+    def dynamodb(self):
+        if self._dynamodb is None:
+            self._dynamodb = boto3.resource("dynamodb")
+        return self._dynamodb
+
+    @property
+    def table(self):
+        if self._table is None:
+            self._table = self.dynamodb.Table(self._name("table"))
+        return self._table
+
+    def put(self, item):
+        rows = split_details(_stamped(item, item["bmh_workspace_id"]))
+        if len(rows) == 1:
+            self.table.put_item(Item=rows[0])
+            return
+        # A workspace item is never visible without its details. The client of
+        # the resource serializes the items like the Table does.
+        self.dynamodb.meta.client.transact_write_items(
+            TransactItems=[
+                {"Put": {"TableName": self.table.name, "Item": row}} for row in rows
+            ]
+        )
+
+    def put_many(self, items):
+        with self.table.batch_writer() as batch:
+            for item in items:
+                stamped = _stamped(item, item["bmh_workspace_id"])
+                for row in split_details(stamped):
+                    batch.put_item(Item=row)
+
+    def get(self, workspace_id, user_id, attributes=None):
+        response = self.table.get_item(
+            Key=_key(workspace_id, user_id), **_projection(attributes)
+        )
+        return response.get("Item")
+
+    def get_details(self, workspace_id, user_id, attributes=None):
+        response = self.table.get_item(
+            Key=_key(details_id(workspace_id), user_id), **_projection(attributes)
+        )
+        return _without_keys(response.get("Item", {}))
+
+    def find_user_id(self, workspace_id):
+        response = self.table.query(
+            IndexName=self._name("index"),
+            KeyConditionExpression="#workspaceid = :workspaceid",
+            ExpressionAttributeNames={"#workspaceid": "bmh_workspace_id"},
+            ExpressionAttributeValues={":workspaceid": workspace_id},
+        )
+        items = response.get("Items", [])
+        return items[0]["user_id"] if len(items) == 1 else None
+
+    def find_user_ids(self, workspace_ids):
+        if not workspace_ids:
+            return {}
+
+        if len(workspace_ids) <= USER_LOOKUP_SCAN_THRESHOLD:
+            # Resolved once, before the threads use them
+            self._name("index")
+            self.table
+            with ThreadPoolExecutor(
+                max_workers=min(USER_LOOKUP_MAX_WORKERS, len(workspace_ids))
+            ) as executor:
+                user_ids = dict(
+                    zip(workspace_ids, executor.map(self.find_user_id, workspace_ids))
+                )
+            return {w: u for w, u in user_ids.items() if u is not None}
+
+        # A single (paginated) scan of the index is cheaper than thousands of queries
+        wanted = set(workspace_ids)
+        found = {}
+        for item in self._scan(
+            IndexName=self._name("index"),
+            **_projection(["bmh_workspace_id", "user_id"]),
+        ):
+            if item["bmh_workspace_id"] in wanted:
+                found.setdefault(item["bmh_workspace_id"], []).append(item["user_id"])
+        return {w: users[0] for w, users in found.items() if len(users) == 1}
+
+    def list_by_user(self, user_id, attributes=None):
+        projection = _projection(attributes)
+        return list(
+            self._paginate(
+                self.table.query,
+                KeyConditionExpression=(
+                    "#userid = :userid AND #workspaceid < :detailsprefix"
+                ),
+                ExpressionAttributeNames={
+                    "#userid": "user_id",
+                    "#workspaceid": "bmh_workspace_id",
+                    **projection.get("ExpressionAttributeNames", {}),
+                },
+                ExpressionAttributeValues={
+                    ":userid": user_id,
+                    ":detailsprefix": DETAILS_ID_PREFIX,
+                },
+                **_without_names(projection),
+            )
+        )
+
+    def list_all(self, attributes=None, having=()):
+        # The scan reads (and is charged for) the details items too, they are
+        # filtered out
+        kwargs = _projection(attributes)
+        names = {f"#h{i}": name for i, name in enumerate(having)}
+        names["#workspaceid"] = "bmh_workspace_id"
+        kwargs["FilterExpression"] = " AND ".join(
+            ["NOT begins_with(#workspaceid, :detailsprefix)"]
+            + [f"attribute_exists(#h{i})" for i in range(len(having))]
+        )
+        kwargs["ExpressionAttributeNames"] = {
+            **kwargs.get("ExpressionAttributeNames", {}),
+            **names,
+        }
+        kwargs["ExpressionAttributeValues"] = {":detailsprefix": DETAILS_ID_PREFIX}
+        return self._scan(**kwargs)
+
+    def list_changed(self, changed_since, user_id=None, attributes=None):
+        # last_modified is needed to sort the items.
+        fetched = attributes
+        if attributes is not None and "last_modified" not in attributes:
+            fetched = list(attributes) + ["last_modified"]
+        if user_id:
+            changed = self._list_changed_by_user(changed_since, user_id, fetched)
+        else:
+            changed = self._list_changed_by_shard(changed_since, fetched)
+        return [_project(item, attributes) for item in changed]
+
+    def _list_changed_by_shard(self, changed_since, attributes):
+        # The shards are queried concurrently, each one is sorted by last_modified
+        projection = _projection(attributes)
+        index_name = self._name("changes_index")
+        table = self.table
+
+        def query(shard):
+            return list(
+                self._paginate(
+                    table.query,
+                    IndexName=index_name,
+                    KeyConditionExpression=(
+                        "#changesshard = :changesshard AND #lastmodified > :changedsince"
+                    ),
+                    ExpressionAttributeNames={
+                        "#changesshard": "changes_shard",
+                        "#lastmodified": "last_modified",
+                        **projection.get("ExpressionAttributeNames", {}),
+                    },
+                    ExpressionAttributeValues={
+                        ":changesshard": _shard_key(shard),
+                        ":changedsince": changed_since,
+                    },
+                    **_without_names(projection),
+                )
+            )
+
+        with ThreadPoolExecutor(max_workers=CHANGES_INDEX_SHARDS) as executor:
+            shards = list(executor.map(query, range(CHANGES_INDEX_SHARDS)))
+        return list(heapq.merge(*shards, key=lambda item: item["last_modified"]))
+
+    def _list_changed_by_user(self, changed_since, user_id, attributes):
+        # A user has few workspaces, their partition is read (and filtered) rather
+        # than the changes index, where they are spread over all the shards.
+        projection = _projection(attributes)
+        items = self._paginate(
+            self.table.query,
+            KeyConditionExpression=(
+                "#userid = :userid AND #workspaceid < :detailsprefix"
+            ),
+            FilterExpression="#lastmodified > :changedsince",
+            ExpressionAttributeNames={
+                "#userid": "user_id",
+                "#workspaceid": "bmh_workspace_id",
+                "#lastmodified": "last_modified",
+                **projection.get("ExpressionAttributeNames", {}),
+            },
+            ExpressionAttributeValues={
+                ":userid": user_id,
+                ":detailsprefix": DETAILS_ID_PREFIX,
+                ":changedsince": changed_since,
+            },
+            **_without_names(projection),
+        )
+        return sorted(items, key=lambda item: item["last_modified"])
+
+    def batch_get(self, keys, attributes=None):
+        """Fetches the items with BatchGetItem, in chunks of 100 keys. Unprocessed
+        keys (throttling, response size) are retried with exponential backoff."""
+        table_name = self._name("table")
+        keys = [_key(workspace_id, user_id) for workspace_id, user_id in keys]
+        items = []
+        for start in range(0, len(keys), BATCH_GET_CHUNK_SIZE):
+            request_items = {
+                table_name: {
+                    "Keys": keys[start : start + BATCH_GET_CHUNK_SIZE],
+                    **_projection(attributes),
+                }
+            }
+            for attempt in range(BATCH_GET_MAX_ATTEMPTS):
+                if attempt > 0:
+                    time.sleep(random.uniform(0, 0.05 * 2**attempt))
+                response = self.dynamodb.batch_get_item(RequestItems=request_items)
+                items.extend(response.get("Responses", {}).get(table_name, []))
+                request_items = response.get("UnprocessedKeys")
+                if not request_items:
+                    break
+            else:
+                raise Exception(
+                    f"Could not get {len(request_items[table_name]['Keys'])} workspaces "
+                    f"after {BATCH_GET_MAX_ATTEMPTS} attempts"
+                )
+        return items
+
+    def update(self, workspace_id, user_id, values):
+        names, expression_values, assignments = {}, {}, []
+        for i, (name, value) in enumerate(_stamped(values, workspace_id).items()):
+            names[f"#u{i}"] = name
+            expression_values[f":u{i}"] = value
+            assignments.append(f"#u{i} = :u{i}")
+
+        try:
+            response = self.table.update_item(
+                Key=_key(workspace_id, user_id),
+                UpdateExpression="SET " + ", ".join(assignments),
+                ConditionExpression="attribute_exists(bmh_workspace_id)",
+                ExpressionAttributeNames=names,
+                ExpressionAttributeValues=expression_values,
+                ReturnValues="ALL_NEW",
+            )
+        except ClientError as e:
+            if e.response["Error"]["Code"] == "ConditionalCheckFailedException":
+                raise WorkspaceNotFoundError(
+                    f"Could not find Workspace with id {workspace_id}"
+                )
+            raise
+        return response["Attributes"]
+
+    def update_details(self, workspace_id, user_id, values):
+        values = {**values, "record_type": DETAILS_RECORD_TYPE}
+        names = {f"#u{i}": name for i, name in enumerate(values)}
+        response = self.table.update_item(
+            Key=_key(details_id(workspace_id), user_id),
+            UpdateExpression="SET "
+            + ", ".join(f"#u{i} = :u{i}" for i in range(len(values))),
+            ExpressionAttributeNames=names,
+            ExpressionAttributeValues={
+                f":u{i}": value for i, value in enumerate(values.values())
+            },
+            ReturnValues="ALL_NEW",
+        )
+        return _without_keys(response["Attributes"])
+
+    def update_total_usage(
+        self, workspace_id, user_id, total_usage, min_interval=0, reported_at=None
+    ):
+        now = int(time.time())
+        stamp = _stamped({}, workspace_id)
+        condition = (
+            "attribute_exists(bmh_workspace_id) AND "
+            "(attribute_not_exists(#totalusage) OR #totalusage <> :totalusage)"
+        )
+        names = {
+            "#totalusage": "total-usage",
+            "#usageupdatetime": "usage_update_time",
+            "#lastmodified": "last_modified",
+            "#recordtype": "record_type",
+            "#changesshard": "changes_shard",
+        }
+        values = {
+            ":totalusage": total_usage,
+            ":usageupdatetime": now,
+            ":lastmodified": stamp["last_modified"],
+            ":recordtype": stamp["record_type"],
+            ":changesshard": stamp["changes_shard"],
+        }
+        if min_interval > 0:
+            condition += (
+                " AND (attribute_not_exists(#usageupdatetime)"
+                " OR #usageupdatetime <= :coalescebefore"
+                " OR (#totalusage < #softlimit AND #softlimit <= :totalusage)"
+                " OR (#totalusage < #hardlimit AND #hardlimit <= :totalusage))"
+            )
+            names["#softlimit"] = "soft-limit"
+            names["#hardlimit"] = "hard-limit"
+            values[":coalescebefore"] = now - min_interval
+        update = (
+            "SET #totalusage = :totalusage, #usageupdatetime = :usageupdatetime, "
+            "#lastmodified = :lastmodified, #recordtype = :recordtype, "
+            "#changesshard = :changesshard"
+        )
+        if reported_at is not None:
+            condition += " AND " + _REPORTED_BEFORE
+            update += ", #reportedat = :reportedat"
+            names["#reportedat"] = "usage_reported_at"
+            values[":reportedat"] = reported_at
+
+        try:
+            response = self.table.update_item(
+                Key=_key(workspace_id, user_id),
+                UpdateExpression=update,
+                ConditionExpression=condition,
+                ExpressionAttributeNames=names,
+                ExpressionAttributeValues=values,
+                ReturnValues="ALL_OLD",
+                ReturnValuesOnConditionCheckFailure="ALL_OLD",
+            )
+        except ClientError as e:
+            if e.response["Error"]["Code"] == "ConditionalCheckFailedException":
+                if "Item" not in e.response:
+                    raise WorkspaceNotFoundError(
+                        f"Could not find Workspace with id {workspace_id}"
+                    )
+                old = {
+                    name: _deserializer.deserialize(value)
+                    for name, value in e.response["Item"].items()
+                }
+                if reported_at is not None and (
+                    old.get("usage_reported_at", -1) >= reported_at
+                ):
+                    return None
+                if old.get("total-usage") == total_usage:
+                    if reported_at is not None:
+                        # Unchanged but the most recent update, older updates
+                        # delivered after it must still be dropped
+                        self._set_usage_reported_at(workspace_id, user_id, reported_at)
+                    return None
+                if min_interval > 0:
+                    raise UpdateCoalescedError(
+                        int(old["usage_update_time"]) + min_interval - now
+                    )
+                return None
+            raise
+        return response["Attributes"]
+
+    def _set_usage_reported_at(self, workspace_id, user_id, reported_at):
+        # last_modified is not changed, the workspace did not change
+        try:
+            self.table.update_item(
+                Key=_key(workspace_id, user_id),
+                UpdateExpression="SET #reportedat = :reportedat",
+                ConditionExpression=(
+                    "attribute_exists(bmh_workspace_id) AND " + _REPORTED_BEFORE
+                ),
+                ExpressionAttributeNames={"#reportedat": "usage_reported_at"},
+                ExpressionAttributeValues={":reportedat": reported_at},
+            )
+        except ClientError as e:
+            if e.response["Error"]["Code"] != "ConditionalCheckFailedException":
+                raise
+
+    def _scan(self, **kwargs):
+        return self._paginate(self.table.scan, **kwargs)
+
+    @staticmethod
+    def _paginate(operation, **kwargs):
+        # Queries and scans return at most 1 MB per page
+        while True:
+            response = operation(**kwargs)
+            yield from response.get("Items", [])
+            if "LastEvaluatedKey" not in response:
+                return
+            kwargs["ExclusiveStartKey"] = response["LastEvaluatedKey"]
+
+
+class InMemoryWorkspaceRepository(WorkspaceRepository):
+    """Workspaces in a dict, with the semantics of DynamoDBWorkspaceRepository:
+    numbers are stored as decimal.Decimal (floats are rejected) and items are
+    copied in and out. Safe to use from several threads."""
+
+    def __init__(self, items=()):
+        self._lock = threading.Lock()
+        self._items = {}
+        # Request details, by the key of their workspace
+        self._details = {}
+        self.load(items)
+
+    def load(self, items):
+        """Stores items as they are (not stamped or split), like the existing
+        rows of a table: workspace items and details items."""
+        items = [_to_dynamodb(item) for item in items]
+        with self._lock:
+            for item in items:
+                self._store(item)
+
+    def put(self, item):
+        rows = [
+            _to_dynamodb(row)
+            for row in split_details(_stamped(item, item["bmh_workspace_id"]))
+        ]
+        with self._lock:
+            for row in rows:
+                self._store(row)
+
+    def _store(self, row):
+        workspace_id = row["bmh_workspace_id"]
+        if workspace_id.startswith(DETAILS_ID_PREFIX):
+            workspace_id = workspace_id[len(DETAILS_ID_PREFIX) :]
+            self._details[(row["user_id"], workspace_id)] = row
+        else:
+            self._items[(row["user_id"], workspace_id)] = row
+
+    def put_many(self, items):
+        for item in items:
+            self.put(item)
+
+    def get(self, workspace_id, user_id, attributes=None):
+        with self._lock:
+            item = self._items.get((user_id, workspace_id))
+            return None if item is None else _project(item, attributes)
+
+    def get_details(self, workspace_id, user_id, attributes=None):
+        with self._lock:
+            details = self._details.get((user_id, workspace_id), {})
+            return _without_keys(_project(details, attributes))
+
+    def find_user_id(self, workspace_id):
+        with self._lock:
+            users = [u for (u, w) in self._items if w == workspace_id]
+        return users[0] if len(users) == 1 else None
+
+    def find_user_ids(self, workspace_ids):
+        wanted = set(workspace_ids)
+        found = {}
+        with self._lock:
+            for user_id, workspace_id in self._items:
+                if workspace_id in wanted:
+                    found.setdefault(workspace_id, []).append(user_id)
+        return {w: users[0] for w, users in found.items() if len(users) == 1}
+
+    def list_by_user(self, user_id, attributes=None):
+        with self._lock:
+            return [
+                _project(self._items[key], attributes)
+                for key in sorted(self._items)
+                if key[0] == user_id
+            ]
+
+    def list_all(self, attributes=None, having=()):
+        with self._lock:
+            items = [
+                _project(item, attributes)
+                for item in self._items.values()
+                if all(name in item for name in having)
+            ]
+        yield from items
+
+    def list_changed(self, changed_since, user_id=None, attributes=None):
+        with self._lock:
+            changed = [
+                item
+                for item in self._items.values()
+                if item.get("record_type") == WORKSPACE_RECORD_TYPE
+                and "last_modified" in item
+                and item["last_modified"] > changed_since
+                and (not user_id or item["user_id"] == user_id)
+            ]
+            changed.sort(key=lambda item: item["last_modified"])
+            return [_project(item, attributes) for item in changed]
+
+    def batch_get(self, keys, attributes=None):
+        with self._lock:
+            return [
+                _project(self._items[(user_id, workspace_id)], attributes)
+                for workspace_id, user_id in dict.fromkeys(keys)
+                if (user_id, workspace_id) in self._items
+            ]
+
+    def update(self, workspace_id, user_id, values):
+        values = _to_dynamodb(_stamped(values, workspace_id))
+        with self._lock:
+            item = self._items.get((user_id, workspace_id))
+            if item is None:
+                raise WorkspaceNotFoundError(
+                    f"Could not find Workspace with id {workspace_id}"
+                )
+            item.update(values)
+            return copy.deepcopy(item)
+
+    def update_details(self, workspace_id, user_id, values):
+        values = _to_dynamodb({**values, "record_type": DETAILS_RECORD_TYPE})
+        with self._lock:
+            details = self._details.setdefault(
+                (user_id, workspace_id), _key(details_id(workspace_id), user_id)
+            )
+            details.update(values)
+            return _without_keys(copy.deepcopy(details))
+
+    def update_total_usage(
+        self, workspace_id, user_id, total_usage, min_interval=0, reported_at=None
+    ):
+        now = int(time.time())
+        total_usage = _to_dynamodb(total_usage)
+        with self._lock:
+            item = self._items.get((user_id, workspace_id))
+            if item is None:
+                raise WorkspaceNotFoundError(
+                    f"Could not find Workspace with id {workspace_id}"
+                )
+            if reported_at is not None:
+                if item.get("usage_reported_at", -1) >= reported_at:
+                    return None
+
+            old_total_usage = item.get("total-usage")
+            if old_total_usage == total_usage:
+                if reported_at is not None:
+                    item["usage_reported_at"] = reported_at
+                return None
+            if min_interval > 0 and not (
+                item.get("usage_update_time") is None
+                or item["usage_update_time"] <= now - min_interval
+                or _crosses(old_total_usage, item.get("soft-limit"), total_usage)
+                or _crosses(old_total_usage, item.get("hard-limit"), total_usage)
+            ):
+                raise UpdateCoalescedError(
+                    int(item["usage_update_time"]) + min_interval - now
+                )
+
+            old_item = copy.deepcopy(item)
+            values = {"total-usage": total_usage, "usage_update_time": now}
+            if reported_at is not None:
+                values["usage_reported_at"] = reported_at
+            item.update(_to_dynamodb(_stamped(values, workspace_id)))
+            return old_item
+
+
+def details_id(workspace_id):
+    """return:
+    sort key (str): bmh_workspace_id of the request details item of a workspace."""
+    return DETAILS_ID_PREFIX + workspace_id
+
+
+def split_details(item):
+    """Splits a workspace into the items stored in the table.
+
+    return:
+        rows (list): the workspace item (HOT_ATTRIBUTES), followed by the request
+            details item when the workspace has other attributes.
+    """
+    hot = {name: value for name, value in item.items() if name in HOT_ATTRIBUTES}
+    details = {
+        name: value for name, value in item.items() if name not in HOT_ATTRIBUTES
+    }
+    if not details:
+        return [hot]
+    details.update(
+        _key(details_id(item["bmh_workspace_id"]), item["user_id"]),
+        record_type=DETAILS_RECORD_TYPE,
+    )
+    return [hot, details]
+
+
+def _key(workspace_id, user_id):
+    return {"bmh_workspace_id": workspace_id, "user_id": user_id}
+
+
+def _without_keys(details):
+    return {
+        name: value
+        for name, value in details.items()
+        if name not in ("bmh_workspace_id", "user_id", "record_type")
+    }
+
+
+def changes_shard(workspace_id):
+    """return:
+    (str) changes_shard of the workspace, the partition key of the changes index.
+    """
+    return _shard_key(zlib.crc32(workspace_id.encode("utf-8")) % CHANGES_INDEX_SHARDS)
+
+
+def _shard_key(shard):
+    return f"{WORKSPACE_RECORD_TYPE}#{shard}"
+
+
+def _stamped(values, workspace_id):
+    return {
+        **values,
+        "record_type": WORKSPACE_RECORD_TYPE,
+        "last_modified": _now_milliseconds(),
+        "changes_shard": changes_shard(workspace_id),
+    }
+
+
+def _now_milliseconds():
+    return int(time.time() * 1000)
+
+
+# Condition of the total usage updates with a reported_at
+_REPORTED_BEFORE = "(attribute_not_exists(#reportedat) OR #reportedat < :reportedat)"
+_deserializer = TypeDeserializer()
+
+
+def _projection(attributes):
+    """ProjectionExpression of attributes, with placeholders since names with
+    dashes can not be used in expressions"""
+    if attributes is None:
+        return {}
+    names = {f"#p{i}": name for i, name in enumerate(attributes)}
+    return {"ProjectionExpression": ", ".join(names), "ExpressionAttributeNames": names}
+
+
+def _without_names(projection):
+    return {k: v for k, v in projection.items() if k != "ExpressionAttributeNames"}
+
+
+def _project(item, attributes):
+    if attributes is not None:
+        item = {name: item[name] for name in attributes if name in item}
+    return copy.deepcopy(item)
+
+
+def _crosses(old, limit, new):
+    # Comparisons with a missing attribute are false in condition expressions
+    return old is not None and limit is not None and old < limit <= new
+
+
+def _to_dynamodb(value):
+    """Converts value to the types returned by DynamoDB, like boto3 does"""
+    if isinstance(value, bool) or value is None:
+        return value
+    if isinstance(value, int):
+        return decimal.Decimal(value)
+    if isinstance(value, float):
+        raise TypeError("Float types are not supported. Use Decimal types instead.")
+    if isinstance(value, dict):
+        return {k: _to_dynamodb(v) for k, v in value.items()}
+    if isinstance(value, (list, tuple)):
+        return [_to_dynamodb(v) for v in value]
+    return copy.deepcopy(value)
@@ -85,6 +85,8 @@ def lambda_handler(event, context):
         policy.allowMethod("PUT", "/workspaces/*/limits")
         policy.allowMethod("PUT", "/workspaces/*/direct-pay-limit")
         policy.allowMethod("GET", "/workspaces/*")
+        policy.allowMethod("PUT", "/workspaces/total-usage")
+        policy.allowMethod("POST", "/workspaces/batch-get")
 
     # Finally, build the policy
     authResponse = policy.build()
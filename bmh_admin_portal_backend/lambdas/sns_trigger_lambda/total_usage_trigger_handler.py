@@ -1,32 +1,28 @@
 import os
-import json
 import boto3
 
+from bmh_common.log_utils import get_logger, log_event
+from bmh_common.workspace_repository import DynamoDBWorkspaceRepository
 
-import logging
-
-logger = logging.getLogger(__name__)
-logging.basicConfig(level=logging.INFO, format="%(message)s")
-logger.setLevel(logging.INFO)
+logger = get_logger(__name__)
 
 OVER_THE_LIMIT_STATUS = "above limit"
 ACTIVE_STATUS = "active"
 
 
 def handler(event, context):
-    logger.info(json.dumps(event))
+    log_event(logger, event)
     records = event["Records"]
 
-    dynamodb = boto3.resource("dynamodb")
-    dynamodb_table_name = _get_dynamodb_table_name()
-    table = dynamodb.Table(dynamodb_table_name)
+    repository = DynamoDBWorkspaceRepository(_get_dynamodb_table_name())
 
+    updated = 0
     for record in records:
         attributes = record["Sns"]["MessageAttributes"]
         if not attributes:
             continue
 
-        logger.info(f"{attributes=}")
+        logger.debug(f"{attributes=}")
         workspace_id = attributes["workspace_id"]["Value"]
         user_id = attributes["user_id"]["Value"]
         total_usage = attributes["total_usage"]["Value"]
@@ -36,20 +32,13 @@ def handler(event, context):
             if float(total_usage) > float(hard_limit)
             else ACTIVE_STATUS
         )
-        try:
-            table_response = table.update_item(
-                Key={"bmh_workspace_id": workspace_id, "user_id": user_id},
-                UpdateExpression="set #req_stat = :status",
-                ConditionExpression="attribute_exists(bmh_workspace_id)",
-                ExpressionAttributeValues={
-                    ":status": update_status,
-                },
-                ExpressionAttributeNames={"#req_stat": "request_status"},
-                ReturnValues="ALL_NEW",
-            )
-            logger.info(f"Table response: {table_response}")
-        except Exception as e:
-            raise e
+        attributes = repository.update(
+            workspace_id, user_id, {"request_status": update_status}
+        )
+        logger.debug(f"Updated attributes: {attributes}")
+        updated += 1
+
+    logger.info(f"Updated the status of {updated} workspaces")
 
 
 ################################ Helper Methods ################################
@@ -3,31 +3,27 @@
 # This AWS Content is provided subject to the terms of the AWS Customer Agreement
 # available at http://aws.amazon.com/agreement or other written agreement between
 # Customer and either Amazon Web Services, Inc. or Amazon Web Services EMEA SARL or both.
-import json
 from enum import Enum
 
-from .handlers import (
-    ProvisionBRHHandler,
-    FailureHandler,
-    SuccessHandler,
-    EmailHandler,
-)
+from . import handlers
 
-import logging
+from bmh_common import instrumentation, profiling
+from bmh_common.log_utils import get_logger, log_event
 
-logger = logging.getLogger(__name__)
-logging.basicConfig(level=logging.INFO, format="%(message)s")
-logger.setLevel(logging.INFO)
+logger = get_logger(__name__)
 
 
+@instrumentation.instrumented
+@profiling.profiled
 def handler(event, context):
-    logger.info(json.dumps(event))
+    log_event(logger, event)
 
+    # Handler classes are imported when first used (see handlers/__init__.py)
     dispatch = {
-        Actions.BRH_PROVISION.value: ProvisionBRHHandler,
-        Actions.SUCCESS.value: SuccessHandler,
-        Actions.FAILURE.value: FailureHandler,
-        Actions.EMAIL.value: EmailHandler,
+        Actions.BRH_PROVISION.value: "ProvisionBRHHandler",
+        Actions.SUCCESS.value: "SuccessHandler",
+        Actions.FAILURE.value: "FailureHandler",
+        Actions.EMAIL.value: "EmailHandler",
     }
 
     action = event.get("action", None)
@@ -41,7 +37,8 @@ def handler(event, context):
     retval = None
     try:
         logger.info(f"Dispacthing {action} action")
-        handler = dispatch[action]()
+        instrumentation.set_route(action)
+        handler = getattr(handlers, dispatch[action])()
         retval = handler.handle(event)
     except Exception as e:
         logger.exception(e)
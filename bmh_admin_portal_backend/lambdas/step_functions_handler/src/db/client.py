@@ -1,18 +1,23 @@
-import os
-import boto3
-from botocore.exceptions import ClientError
-from boto3.dynamodb.conditions import Key, Attr
+from bmh_common.workspace_repository import (
+    DynamoDBWorkspaceRepository,
+    WorkspaceNotFoundError,
+)
 
 from ..util import Util
 
 
 class DBClient:
-    def __init__(self):
-        self.table_name = Util.get_dynamodb_table_name()
-        self.index_name = Util.get_dynamodb_index_name()
-
-        dynamodb = boto3.resource("dynamodb")
-        self.table = dynamodb.Table(self.table_name)
+    def __init__(self, repository=None):
+        """args:
+        repository: (WorkspaceRepository, optional) Defaults to the DynamoDB table
+            whose name is read from SSM.
+        """
+        if repository is None:
+            repository = DynamoDBWorkspaceRepository(
+                Util.get_dynamodb_table_name(),
+                index_name=Util.get_dynamodb_index_name,
+            )
+        self.repository = repository
 
     def set_status(self, workspace_request_id, status, email=None):
         """Will set the account ID given a workspace request ID
@@ -23,7 +28,7 @@ class DBClient:
             email: (string, optional) Email/user_id. If not provided, will look up in GSI.
 
         return:
-            table_response (dict): response for update_item call
+            attributes (dict): attributes of the workspace after the update
 
         """
         return self._update_single_attribute(
@@ -38,7 +43,7 @@ class DBClient:
             email: (string, optional) Email/user_id. If not provided, will look up in GSI.
 
         return:
-            table_response (dict): response for update_item call
+            attributes (dict): attributes of the workspace after the update
 
         """
         subnet_id = self._get_first_available_subnet_id()
@@ -55,7 +60,7 @@ class DBClient:
             email: (string, optional) Email/user_id. If not provided, will look up in GSI.
 
         return:
-            table_response (dict): response for update_item call
+            attributes (dict): attributes of the workspace after the update
 
         """
         return self._update_single_attribute("ecs", ecs, workspace_request_id, email)
@@ -69,7 +74,7 @@ class DBClient:
             email: (string, optional) Email/user_id. If not provided, will look up in GSI.
 
         return:
-            table_response (dict): response for update_item call
+            attributes (dict): attributes of the workspace after the update
 
         """
         return self._update_single_attribute(
@@ -83,29 +88,18 @@ class DBClient:
             workspace_request_id: (string) Request ID which should already exist in database.
 
         return:
-            email (string): User ID stored in GSI based on Workspace Request ID.
+            data (dict): All the attributes of the workspace item (not its request
+                details).
 
         raises:
             InvalidWorkspaceRequestException: When workspace request ID does not exist.
         """
-
-        # Query the Global Secondary Index to get the User.
-        try:
-            response = self.table.scan(
-                FilterExpression=Attr("bmh_workspace_id").eq(workspace_request_id)
+        email = self.get_email_by_workspace_request_id(workspace_request_id)
+        data = self.repository.get(workspace_request_id, email)
+        if data is None:
+            raise InvalidWorkspaceRequestIdException(
+                f"Could find workspace request {workspace_request_id}"
             )
-        except ClientError as e:
-            if e.response["Error"]["Code"] == "ConditionalCheckFailedException":
-                raise InvalidWorkspaceRequestIdException(
-                    f"Could find workspace request {workspace_request_id}"
-                )
-            else:
-                raise e
-
-        # And now update the row.
-        items = response.get("Items", [])
-        assert len(items) == 1
-        data = items[0]
         return data
 
     def get_email_by_workspace_request_id(self, workspace_request_id):
@@ -122,24 +116,11 @@ class DBClient:
         """
 
         # Query the Global Secondary Index to get the User.
-        try:
-            index_response = self.table.query(
-                IndexName=self.index_name,
-                KeyConditionExpression=Key("bmh_workspace_id").eq(workspace_request_id),
-                ReturnConsumedCapacity="NONE",
+        user_id = self.repository.find_user_id(workspace_request_id)
+        if user_id is None:
+            raise InvalidWorkspaceRequestIdException(
+                f"Could find workspace request {workspace_request_id}"
             )
-        except ClientError as e:
-            if e.response["Error"]["Code"] == "ConditionalCheckFailedException":
-                raise InvalidWorkspaceRequestIdException(
-                    f"Could find workspace request {workspace_request_id}"
-                )
-            else:
-                raise e
-
-        # And now update the row.
-        items = index_response.get("Items", [])
-        assert len(items) == 1
-        user_id = items[0]["user_id"]
         return user_id
 
     def _update_single_attribute(
@@ -155,7 +136,7 @@ class DBClient:
                 will look up the value in the GSI.
 
         return:
-            table_response (dict): The response returned by the update_item called to DynamoDB Table
+            attributes (dict): attributes of the workspace after the update
 
         raises:
             InvalidWorkspaceRequestException: When workspace request ID does not exist.
@@ -164,23 +145,13 @@ class DBClient:
             email = self.get_email_by_workspace_request_id(workspace_request_id)
 
         try:
-            table_response = self.table.update_item(
-                Key={"bmh_workspace_id": workspace_request_id, "user_id": email},
-                UpdateExpression="set #attributename = :attributevalue",
-                ConditionExpression="attribute_exists(bmh_workspace_id)",
-                ExpressionAttributeValues={":attributevalue": attribute_value},
-                ExpressionAttributeNames={"#attributename": attribute_name},
-                ReturnValues="ALL_NEW",
+            return self.repository.update(
+                workspace_request_id, email, {attribute_name: attribute_value}
+            )
+        except WorkspaceNotFoundError:
+            raise InvalidWorkspaceRequestIdException(
+                f"Could find workspace request {workspace_request_id}"
             )
-        except ClientError as e:
-            if e.response["Error"]["Code"] == "ConditionalCheckFailedException":
-                raise InvalidWorkspaceRequestIdException(
-                    f"Could find workspace request {workspace_request_id}"
-                )
-            else:
-                raise e
-
-        return table_response
 
     def _get_first_available_subnet_id(self):
         """Scans the entire DynamoDB table are returns the first available subnet id.
@@ -193,23 +164,15 @@ class DBClient:
         """
         column_name = "subnet"
         first_available_subnet_id = 1
-        # Query the Global Secondary Index to get the User.
-        try:
-            response = self.table.scan(
-                Select="SPECIFIC_ATTRIBUTES",
-                ProjectionExpression=column_name,
-                FilterExpression="attribute_exists(" + column_name + ")",
+        used_subnets = {
+            item[column_name]
+            for item in self.repository.list_all(
+                attributes=[column_name], having=[column_name]
             )
-        except ClientError as e:
-            raise e
+        }
 
         # Not a scalable solution but works as a workaround due to the limitations of DynamoDB.
-        sorted_subnet = (
-            sorted(item[column_name] for item in response["Items"])
-            if response["Items"]
-            else []
-        )
-        while first_available_subnet_id in sorted_subnet:
+        while first_available_subnet_id in used_subnets:
             first_available_subnet_id += 1
 
         return first_available_subnet_id
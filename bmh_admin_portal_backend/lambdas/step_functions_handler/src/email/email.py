@@ -2,7 +2,15 @@ import os
 import boto3
 from botocore.exceptions import ClientError
 
-ses = boto3.client("ses")
+# Created on first use, only the email action sends emails
+_ses_client = None
+
+
+def _get_ses_client():
+    global _ses_client
+    if _ses_client is None:
+        _ses_client = boto3.client("ses")
+    return _ses_client
 
 
 from ..util import Util
@@ -16,7 +24,7 @@ class EmailClient:
 
     def create_email_template(self):
         try:
-            ses.create_template(
+            _get_ses_client().create_template(
                 Template={
                     "TemplateName": self.template_name,
                     "SubjectPart": "{{ACCOUNT_TYPE}} Account Update",
@@ -30,7 +38,7 @@ class EmailClient:
 
     def email_template(self, template_name):
         try:
-            template = ses.get_template(TemplateName=template_name)
+            template = _get_ses_client().get_template(TemplateName=template_name)
         except ClientError as e:
             if e.response["Error"]["Code"] == "TemplateDoesNotExist":
                 self.create_email_template()
@@ -48,7 +56,7 @@ class EmailClient:
         from_addr = f"request@{email_domain}"
 
         try:
-            response = ses.send_templated_email(
+            response = _get_ses_client().send_templated_email(
                 Source=from_addr,
                 Template=self.template_name,
                 Destination={"ToAddresses": [email]},
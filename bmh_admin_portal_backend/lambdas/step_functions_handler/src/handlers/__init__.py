@@ -1,4 +1,16 @@
-from .provision_brh_handler import ProvisionBRHHandler
-from .failure_handler import FailureHandler
-from .success_handler import SuccessHandler
-from .email_handler import EmailHandler
+import importlib
+
+# Each action only needs its own handler, they are imported on first use.
+_HANDLER_MODULES = {
+    "ProvisionBRHHandler": ".provision_brh_handler",
+    "FailureHandler": ".failure_handler",
+    "SuccessHandler": ".success_handler",
+    "EmailHandler": ".email_handler",
+}
+
+
+def __getattr__(name):
+    if name not in _HANDLER_MODULES:
+        raise AttributeError(f"module {__name__!r} has no attribute {name!r}")
+    module = importlib.import_module(_HANDLER_MODULES[name], __name__)
+    return getattr(module, name)
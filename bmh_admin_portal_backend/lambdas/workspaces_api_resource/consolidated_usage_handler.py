@@ -0,0 +1,136 @@
+# © 2021 Amazon Web Services, Inc. or its affiliates. All Rights Reserved.
+#
+# This AWS Content is provided subject to the terms of the AWS Customer Agreement
+# available at http://aws.amazon.com/agreement or other written agreement between
+# Customer and either Amazon Web Services, Inc. or Amazon Web Services EMEA SARL or both.
+
+""" Optional job which keeps total-usage up to date for all workspaces at once, from
+the Cost and Usage Report of the consolidated billing (payer) account. This replaces
+the per-account Cost and Usage Report stacks for organizations that have a payer CUR. """
+
+import decimal
+import os
+import sys
+from concurrent.futures import ThreadPoolExecutor
+
+# Boilerplate code to have a workaround for unit tests and AWS deployment for relative imports
+sys.path.append(os.path.join(os.path.dirname(__file__)))
+
+import workspaces_api_resource_handler as api
+from bmh_common.log_utils import get_logger, log_event
+
+logger = get_logger(__name__)
+
+ACCOUNT_ID_COL = "line_item_usage_account_id"
+COST_COL = "line_item_unblended_cost"
+
+# Number of concurrent DynamoDB updates
+MAX_WORKERS = 16
+
+
+def handler(event, context):
+    """Aggregates the consolidated billing Cost and Usage Report and updates the
+    total-usage of every workspace whose account_id appears in it.
+    Expects the following environment variables:
+        consolidated_cur_path: s3://<bucket>/<prefix>/<report name>/<report name>
+        dynamodb_table_param_name: The SSM Parameter name which stores the dynamodb table name.
+    """
+    log_event(logger, event)
+
+    costs = aggregate_cost_by_account(os.environ["consolidated_cur_path"])
+    logger.info(f"Found cost for {len(costs)} accounts")
+
+    summary = update_workspaces_total_usage(api._get_workspace_repository(), costs)
+    logger.info(f"Summary: {summary}")
+    return summary
+
+
+def aggregate_cost_by_account(path):
+    """Sums the cost of all the line items of the report per usage account.
+
+    The report is read in chunks with only the two needed columns, so memory use
+    does not grow with the size of the payer account's report.
+
+    return:
+        costs (dict): {account_id: total cost (Decimal)}
+    """
+    # Only this job needs awswrangler/pandas (provided by a lambda layer).
+    import awswrangler as wr
+
+    totals = None
+    for chunk in wr.s3.read_parquet(
+        path=path, dataset=True, columns=[ACCOUNT_ID_COL, COST_COL], chunked=True
+    ):
+        sums = chunk[COST_COL].groupby(chunk[ACCOUNT_ID_COL], observed=True).sum()
+        totals = sums if totals is None else totals.add(sums, fill_value=0)
+
+    if totals is None:
+        return {}
+    return {
+        str(account_id): round(decimal.Decimal(str(cost)), 2)
+        for account_id, cost in totals.items()
+    }
+
+
+def update_workspaces_total_usage(repository, costs):
+    """Maps account ids to workspaces (via the account_id attribute) and updates the
+    total-usage of the workspaces whose usage changed. Soft and hard limits are
+    evaluated exactly like PUT /workspaces/{workspace_id}/total-usage.
+
+    args:
+        repository: WorkspaceRepository.
+        costs: (dict) {account_id: total cost}
+
+    return:
+        summary (dict): number of workspaces updated, unchanged, failed and
+            the account ids which did not match any workspace.
+    """
+    # Provisioned workspaces
+    workspaces = repository.list_all(
+        attributes=["bmh_workspace_id", "user_id", "account_id", "total-usage"],
+        having=["account_id"],
+    )
+
+    to_update = []
+    unchanged = 0
+    matched_accounts = set()
+    for workspace in workspaces:
+        account_id = str(workspace["account_id"])
+        if account_id not in costs:
+            continue
+        matched_accounts.add(account_id)
+
+        total_usage = round(decimal.Decimal(costs[account_id]), 2)
+        if workspace.get("total-usage") == total_usage:
+            unchanged += 1
+            continue
+        to_update.append((workspace, total_usage))
+
+    def update(args):
+        workspace, total_usage = args
+        try:
+            old_attributes = api._update_total_usage(
+                repository,
+                workspace["bmh_workspace_id"],
+                workspace["user_id"],
+                total_usage,
+            )
+        except Exception as e:
+            logger.exception(e)
+            return "failed"
+        # None when the update was coalesced with a recent one
+        return "unchanged" if old_attributes is None else "updated"
+
+    with ThreadPoolExecutor(max_workers=MAX_WORKERS) as executor:
+        statuses = list(executor.map(update, to_update))
+
+    return {
+        "updated": statuses.count("updated"),
+        "unchanged": unchanged + statuses.count("unchanged"),
+        "failed": [
+            workspace["bmh_workspace_id"]
+            for (workspace, _), status in zip(to_update, statuses)
+            if status == "failed"
+        ],
+        "unmatched_accounts": sorted(set(costs) - matched_accounts),
+    }
@@ -0,0 +1,234 @@
+# © 2021 Amazon Web Services, Inc. or its affiliates. All Rights Reserved.
+#
+# This AWS Content is provided subject to the terms of the AWS Customer Agreement
+# available at http://aws.amazon.com/agreement or other written agreement between
+# Customer and either Amazon Web Services, Inc. or Amazon Web Services EMEA SARL or both.
+
+""" Validation of API requests with a subset of JSON schema, compiled once into
+functions so that validating a request does not walk the schema again.
+
+Supported keywords: type, enum, format, pattern, minLength, maxLength, minimum,
+maximum, properties, required, additionalProperties, propertyNames, items,
+minItems, maxItems.
+
+"format": "decimal" accepts numbers and numeric strings and converts them to
+decimal.Decimal, the type DynamoDB uses for numbers. """
+
+import decimal
+import re
+
+SUPPORTED_KEYWORDS = {
+    "type",
+    "enum",
+    "format",
+    "pattern",
+    "minLength",
+    "maxLength",
+    "minimum",
+    "maximum",
+    "properties",
+    "required",
+    "additionalProperties",
+    "propertyNames",
+    "items",
+    "minItems",
+    "maxItems",
+}
+
+_TYPES = {
+    "object": lambda v: isinstance(v, dict),
+    "array": lambda v: isinstance(v, list),
+    "string": lambda v: isinstance(v, str),
+    "integer": lambda v: isinstance(v, int) and not isinstance(v, bool),
+    "number": lambda v: isinstance(v, (int, float, decimal.Decimal))
+    and not isinstance(v, bool),
+    "boolean": lambda v: isinstance(v, bool),
+    "null": lambda v: v is None,
+}
+
+
+class RequestValidationError(ValueError):
+    """The request does not match the schema of its route"""
+
+
+def compile_schema(schema, name="body"):
+    """Compiles a schema into a function which validates a value and returns it
+    with its "format": "decimal" fields converted.
+
+    args:
+        schema (dict): JSON schema (subset, see SUPPORTED_KEYWORDS)
+        name (str): Name of the value in the error messages, e.g. "body".
+
+    raises:
+        ValueError: the schema uses an unsupported keyword or format.
+    """
+    validate = _compile(schema)
+
+    def validator(value):
+        """raises:
+        RequestValidationError: value does not match the schema."""
+        return validate(value, name)
+
+    return validator
+
+
+def _compile(schema):
+    unsupported = set(schema) - SUPPORTED_KEYWORDS
+    if unsupported:
+        raise ValueError(f"Unsupported schema keywords: {sorted(unsupported)}")
+
+    # Each check takes (value, path) and returns the (converted) value.
+    checks = []
+
+    if "type" in schema:
+        types = schema["type"] if isinstance(schema["type"], list) else [schema["type"]]
+        type_checks = [_TYPES[t] for t in types]
+        expected = " or ".join(types)
+
+        def check_type(value, path):
+            if not any(check(value) for check in type_checks):
+                raise RequestValidationError(f"{path} must be of type {expected}")
+            return value
+
+        checks.append(check_type)
+
+    if "enum" in schema:
+        allowed = list(schema["enum"])
+
+        def check_enum(value, path):
+            if value not in allowed:
+                raise RequestValidationError(f"{path} must be one of {allowed}")
+            return value
+
+        checks.append(check_enum)
+
+    if "format" in schema:
+        if schema["format"] != "decimal":
+            raise ValueError(f"Unsupported format: {schema['format']}")
+        checks.append(_to_decimal)
+
+    if "pattern" in schema:
+        pattern = re.compile(schema["pattern"])
+
+        def check_pattern(value, path):
+            if isinstance(value, str) and not pattern.search(value):
+                raise RequestValidationError(
+                    f"{path} must match the pattern {schema['pattern']}"
+                )
+            return value
+
+        checks.append(check_pattern)
+
+    for keyword, fails, message in [
+        ("minLength", lambda v, n: len(v) < n, "must have at least {} characters"),
+        ("maxLength", lambda v, n: len(v) > n, "must have at most {} characters"),
+    ]:
+        if keyword in schema:
+            checks.append(_bound_check(schema[keyword], str, fails, message))
+
+    for keyword, fails, message in [
+        ("minimum", lambda v, n: v < n, "must be at least {}"),
+        ("maximum", lambda v, n: v > n, "must be at most {}"),
+    ]:
+        if keyword in schema:
+            checks.append(
+                _bound_check(
+                    decimal.Decimal(str(schema[keyword])),
+                    (int, float, decimal.Decimal),
+                    fails,
+                    message,
+                )
+            )
+
+    for keyword, fails, message in [
+        ("minItems", lambda v, n: len(v) < n, "must have at least {} items"),
+        ("maxItems", lambda v, n: len(v) > n, "must have at most {} items"),
+    ]:
+        if keyword in schema:
+            checks.append(_bound_check(schema[keyword], list, fails, message))
+
+    if {"properties", "required", "additionalProperties", "propertyNames"} & set(
+        schema
+    ):
+        checks.append(_compile_object(schema))
+
+    if "items" in schema:
+        validate_item = _compile(schema["items"])
+
+        def check_items(value, path):
+            if not isinstance(value, list):
+                return value
+            return [validate_item(item, f"{path}[{i}]") for i, item in enumerate(value)]
+
+        checks.append(check_items)
+
+    def validate(value, path):
+        for check in checks:
+            value = check(value, path)
+        return value
+
+    return validate
+
+
+def _compile_object(schema):
+    required = list(schema.get("required", []))
+    properties = {
+        name: _compile(property_schema)
+        for name, property_schema in schema.get("properties", {}).items()
+    }
+    additional = schema.get("additionalProperties", True)
+    validate_additional = _compile(additional) if isinstance(additional, dict) else None
+    validate_name = (
+        _compile(schema["propertyNames"]) if "propertyNames" in schema else None
+    )
+
+    def check_object(value, path):
+        if not isinstance(value, dict):
+            return value
+        for name in required:
+            if name not in value:
+                raise RequestValidationError(f"{path}.{name} is required")
+
+        converted = {}
+        for name, item in value.items():
+            if validate_name is not None:
+                validate_name(name, f"{path} property name {name}")
+            if name in properties:
+                item = properties[name](item, f"{path}.{name}")
+            elif additional is False:
+                raise RequestValidationError(f"{path}.{name} is not allowed")
+            elif validate_additional is not None:
+                item = validate_additional(item, f"{path}.{name}")
+            converted[name] = item
+        return converted
+
+    return check_object
+
+
+def _bound_check(bound, value_type, fails, message):
+    message = message.format(bound)
+
+    def check(value, path):
+        if (
+            isinstance(value, value_type)
+            and not isinstance(value, bool)
+            and fails(value, bound)
+        ):
+            raise RequestValidationError(f"{path} {message}")
+        return value
+
+    return check
+
+
+def _to_decimal(value, path):
+    if isinstance(value, bool) or not isinstance(
+        value, (int, float, str, decimal.Decimal)
+    ):
+        raise RequestValidationError(f"{path} must be a number")
+    try:
+        number = decimal.Decimal(str(value).strip())
+    except decimal.InvalidOperation:
+        raise RequestValidationError(f"{path} must be a number")
+    if not number.is_finite():
+        raise RequestValidationError(f"{path} must be a finite number")
+    return number
@@ -0,0 +1,115 @@
+# © 2021 Amazon Web Services, Inc. or its affiliates. All Rights Reserved.
+#
+# This AWS Content is provided subject to the terms of the AWS Customer Agreement
+# available at http://aws.amazon.com/agreement or other written agreement between
+# Customer and either Amazon Web Services, Inc. or Amazon Web Services EMEA SARL or both.
+
+""" Consumer of the total-usage queue. PUT /workspaces/{workspace_id}/total-usage
+enqueues updates when total_usage_queue_url is set, this function applies them in
+batches. """
+
+import decimal
+import json
+import os
+import sys
+from concurrent.futures import ThreadPoolExecutor
+
+# Boilerplate code to have a workaround for unit tests and AWS deployment for relative imports
+sys.path.append(os.path.join(os.path.dirname(__file__)))
+
+import workspaces_api_resource_handler as api
+from bmh_common.log_utils import get_logger
+
+logger = get_logger(__name__)
+
+# Number of concurrent workspace updates within a batch
+MAX_WORKERS = 8
+
+
+def handler(event, context):
+    """Applies a batch of total-usage updates from SQS.
+    Expects the following environment variables:
+        dynamodb_table_param_name: The SSM Parameter name which stores the dynamodb table name.
+        dynamodb_index_param_name: The SSM Parameter name which stores the dynamodb index name.
+
+    The event source mapping must have ReportBatchItemFailures enabled, only the
+    messages listed in batchItemFailures are retried.
+    """
+    records = event.get("Records", [])
+    logger.info(f"Received {len(records)} total-usage updates")
+
+    latest, failures = dedupe_updates(records)
+    logger.info(f"{len(latest)} workspaces to update, {len(failures)} invalid messages")
+
+    if latest:
+        repository = api._get_workspace_repository()
+
+        def apply(update):
+            try:
+                apply_update(repository, update)
+            except Exception as e:
+                logger.exception(e)
+                return update["message_id"]
+            return None
+
+        with ThreadPoolExecutor(max_workers=min(MAX_WORKERS, len(latest))) as executor:
+            failures.extend(
+                message_id
+                for message_id in executor.map(apply, latest.values())
+                if message_id is not None
+            )
+
+    logger.info(f"Returning {len(failures)} failed messages")
+    return {"batchItemFailures": [{"itemIdentifier": m} for m in failures]}
+
+
+def dedupe_updates(records):
+    """Keeps the most recent update (by reported_at) of each workspace. Older updates
+    of the same workspace are superseded and acknowledged with the batch.
+
+    return:
+        latest (dict): {workspace_id: {"workspace_id", "user_id", "total-usage", "reported_at", "message_id"}}
+        failures (list): message ids of records which could not be parsed.
+    """
+    latest = {}
+    failures = []
+    for record in records:
+        try:
+            update = json.loads(record["body"])
+            update["message_id"] = record["messageId"]
+            workspace_id = update["workspace_id"]
+            reported_at = update["reported_at"]
+            decimal.Decimal(update["total-usage"])
+        except (KeyError, TypeError, ValueError, decimal.InvalidOperation) as e:
+            # Retrying will not fix it, it ends up in the dead-letter queue.
+            logger.error(f"Invalid total-usage message {record.get('messageId')}: {e}")
+            failures.append(record.get("messageId"))
+            continue
+
+        current = latest.get(workspace_id)
+        if current is None or current["reported_at"] <= reported_at:
+            latest[workspace_id] = update
+
+    return latest, failures
+
+
+def apply_update(repository, update):
+    """Stores the total-usage of the workspace (and sends limit notifications) like
+    the synchronous endpoint does. Updates reported before the stored one, e.g.
+    delivered in a later batch, are dropped.
+
+    The user of the workspace is looked up when the message does not have it
+    (messages enqueued before the API added it)."""
+    user_id = update.get("user_id") or repository.find_user_id(update["workspace_id"])
+    if user_id is None:
+        # Nothing to retry, the workspace does not exist.
+        logger.error(f"Could not find Workspace with id {update['workspace_id']}")
+        return
+
+    api._update_total_usage(
+        repository,
+        update["workspace_id"],
+        user_id,
+        update["total-usage"],
+        reported_at=update["reported_at"],
+    )
@@ -4,33 +4,45 @@
 # available at http://aws.amazon.com/agreement or other written agreement between
 # Customer and either Amazon Web Services, Inc. or Amazon Web Services EMEA SARL or both.
 
+import collections
 import json
-import random
-import uuid
+import logging
 import sys
 import traceback
 import decimal
+import math
 import os
-import base64
+import hashlib
 from datetime import datetime, timezone
-from urllib.request import Request, urlopen
 
 import boto3
 import botocore
 from botocore.exceptions import ClientError
-from boto3.dynamodb.conditions import Key
 
 # Boilerplate code to have a workaround for unit tests and AWS deployment for relative imports
 sys.path.append(os.path.join(os.path.dirname(__file__)))
 
-from email_helper.email_helper import EmailHelper
+from bmh_common import instrumentation, profiling
+from bmh_common.log_utils import get_logger, log_event, max_chars
+from bmh_common.workspace_repository import (
+    DynamoDBWorkspaceRepository,
+    UpdateCoalescedError,
+    WorkspaceNotFoundError,
+)
+from request_validation import RequestValidationError, compile_schema
 
+try:
+    # Optional, not part of the lambda runtime. Responses fall back to gzip.
+    import brotli
+except ImportError:
+    brotli = None
 
-import logging
+logger = get_logger(__name__)
 
-logger = logging.getLogger(__name__)
-logging.basicConfig(level=logging.INFO, format="%(message)s")
-logger.setLevel(logging.INFO)
+# Modules only needed by a few routes (email_helper, urllib.request, uuid, gzip,
+# base64, concurrent.futures) are imported when first used, so that they do not
+# add to the cold start of the GET requests which make most of the traffic.
+EmailHelper = None  # See _get_email_helper()
 
 DEFAULT_STRIDES_CREDITS_AMOUNT = 250
 
@@ -43,7 +55,234 @@ VALID_WORKSPACE_TYPES = [
     DIRECT_PAY_WORKSPACE_TYPE,
 ]
 
+# Only the most recent months of the cost breakdown are kept on the workspace item
+MAX_COST_BREAKDOWN_MONTHS = 12
+
+# Attributes returned when listing workspaces
+WORKSPACE_ATTRIBUTES = [
+    "bmh_workspace_id",
+    "nih_funded_award_number",
+    "request_status",
+    "workspace_type",
+    "total-usage",
+    "strides-credits",
+    "soft-limit",
+    "hard-limit",
+    "direct_pay_limit",
+]
+
+# Data access of the routes. Tests and benchmarks may set an
+# InMemoryWorkspaceRepository, see _get_workspace_repository().
+workspace_repository = None
+
+# Writes are visible in the changes index after a short
+# delay, the timestamp returned to clients for their next request is moved back by
+# this much.
+CHANGES_INDEX_LAG_MILLISECONDS = 5000
+
+# Responses larger than this are compressed when the client accepts it
+RESPONSE_COMPRESSION_MIN_BYTES = int(
+    os.environ.get("response_compression_min_bytes", 1024)
+)
+
+# POST /workspaces/batch-get
+MAX_BATCH_GET_WORKSPACES = 1000
+
+# PUT /workspaces/total-usage
+MAX_BULK_TOTAL_USAGE_ITEMS = 5000
+BULK_MAX_WORKERS = 16
+
+
+# Route table, built (and its schemas compiled) once per execution environment.
+# The lambdas look the route functions up when called, so they can be patched.
+Request = collections.namedtuple(
+    "Request", ["body", "path_params", "query_string_params", "user", "api_key"]
+)
+Route = collections.namedtuple("Route", ["call", "body", "path", "query"])
+Route.__new__.__defaults__ = (None, None, None)
+
+_WORKSPACE_PATH = compile_schema(
+    {
+        "type": "object",
+        "required": ["workspace_id"],
+        "properties": {"workspace_id": {"type": "string", "minLength": 1}},
+    },
+    name="path",
+)
+_WORKSPACES_QUERY = compile_schema(
+    {
+        "type": "object",
+        "properties": {
+            "changed_since": {"type": "string", "pattern": "^[0-9]+$"},
+            "user": {"type": "string"},
+        },
+    },
+    name="query",
+)
+
 
+def _body_schema(required, properties, **schema):
+    return compile_schema(
+        {"type": "object", "required": required, "properties": properties, **schema}
+    )
+
+
+ROUTES = {
+    "/auth/get-tokens": {
+        "GET": Route(
+            call=lambda r: _get_tokens(r.query_string_params, r.api_key),
+            query=compile_schema(
+                {
+                    "type": "object",
+                    "required": ["code"],
+                    "properties": {"code": {"type": "string", "minLength": 1}},
+                },
+                name="query",
+            ),
+        )
+    },
+    "/auth/refresh-tokens": {
+        "PUT": Route(
+            call=lambda r: _refresh_tokens(r.body, r.api_key),
+            body=_body_schema(
+                ["refresh_token"],
+                {"refresh_token": {"type": "string", "minLength": 1}},
+            ),
+        )
+    },
+    "/workspaces": {
+        "POST": Route(
+            call=lambda r: _workspaces_post(r.body, r.user),
+            body=_body_schema(
+                ["workspace_type"],
+                {"workspace_type": {"type": "string", "enum": VALID_WORKSPACE_TYPES}},
+            ),
+        ),
+        "GET": Route(
+            call=lambda r: _workspaces_get(
+                r.path_params, r.user, r.query_string_params
+            ),
+            query=_WORKSPACES_QUERY,
+        ),
+    },
+    "/workspaces/total-usage": {
+        # Each workspace is validated by the route, with one result per workspace
+        "PUT": Route(
+            call=lambda r: _workspaces_set_total_usage_bulk(r.body, r.user),
+            body=_body_schema(
+                ["workspaces"],
+                {
+                    "workspaces": {
+                        "type": "array",
+                        "maxItems": MAX_BULK_TOTAL_USAGE_ITEMS,
+                    }
+                },
+            ),
+        )
+    },
+    "/workspaces/batch-get": {
+        "POST": Route(
+            call=lambda r: _workspaces_batch_get(r.body, r.user),
+            body=_body_schema(
+                ["workspaces"],
+                {
+                    "workspaces": {
+                        "type": "array",
+                        "maxItems": MAX_BATCH_GET_WORKSPACES,
+                        "items": {
+                            "type": "object",
+                            "required": ["workspace_id"],
+                            "properties": {
+                                "workspace_id": {"type": "string", "minLength": 1},
+                                "user_id": {"type": "string"},
+                            },
+                        },
+                    }
+                },
+            ),
+        )
+    },
+    "/workspaces/{workspace_id}": {
+        "GET": Route(
+            call=lambda r: _workspaces_get(
+                r.path_params, r.user, r.query_string_params
+            ),
+            path=_WORKSPACE_PATH,
+            query=_WORKSPACES_QUERY,
+        )
+    },
+    "/workspaces/{workspace_id}/limits": {
+        "PUT": Route(
+            call=lambda r: _workspaces_set_limits(r.body, r.path_params, r.user),
+            body=_body_schema(
+                ["soft-limit", "hard-limit"],
+                {
+                    "soft-limit": {"format": "decimal", "minimum": 0},
+                    "hard-limit": {"format": "decimal", "minimum": 0},
+                    "user": {"type": "string"},
+                },
+            ),
+            path=_WORKSPACE_PATH,
+        )
+    },
+    "/workspaces/{workspace_id}/total-usage": {
+        "PUT": Route(
+            call=lambda r: _workspaces_set_total_usage(
+                r.body, r.path_params, r.api_key
+            ),
+            body=_body_schema(["total-usage"], {"total-usage": {"format": "decimal"}}),
+            path=_WORKSPACE_PATH,
+        )
+    },
+    "/workspaces/{workspace_id}/cost-breakdown": {
+        "PUT": Route(
+            call=lambda r: _workspaces_set_cost_breakdown(
+                r.body, r.path_params, r.api_key
+            ),
+            # {<month>: {<service>: <cost>}}, months are sorted as strings
+            body=_body_schema(
+                ["cost-breakdown"],
+                {
+                    "cost-breakdown": {
+                        "type": "object",
+                        "propertyNames": {"pattern": "^[0-9]{4}-(0[1-9]|1[0-2])$"},
+                        "additionalProperties": {
+                            "type": "object",
+                            "additionalProperties": {"format": "decimal"},
+                        },
+                    }
+                },
+            ),
+            path=_WORKSPACE_PATH,
+        )
+    },
+    "/workspaces/{workspace_id}/provision": {
+        "POST": Route(
+            call=lambda r: _workspace_provision(r.body, r.path_params),
+            body=_body_schema(
+                ["account_id"], {"account_id": {"type": "string", "minLength": 1}}
+            ),
+            path=_WORKSPACE_PATH,
+        )
+    },
+    "/workspaces/{workspace_id}/direct-pay-limit": {
+        "PUT": Route(
+            call=lambda r: _workspace_direct_pay_limit(r.body, r.path_params, r.user),
+            body=_body_schema(
+                ["direct_pay_limit"],
+                {
+                    "direct_pay_limit": {"format": "decimal", "minimum": 0},
+                    "user": {"type": "string"},
+                },
+            ),
+            path=_WORKSPACE_PATH,
+        )
+    },
+}
+
+
+@instrumentation.instrumented
+@profiling.profiled
 def handler(event, context):
     """Handles all API requests for the BMH Portal Backend
     Expects the following environment variables:
@@ -52,7 +291,7 @@ def handler(event, context):
             API Keys.
     """
 
-    logger.info(json.dumps(event))
+    log_event(logger, event)
 
     resource = event["resource"]
     path = event["path"]
@@ -71,38 +310,24 @@ def handler(event, context):
     body = event.get("body", "{}")
     try:
         if body is not None:
+            # All media types are binary for the API (to return compressed responses),
+            # so API Gateway sends the body base64 encoded.
+            if event.get("isBase64Encoded"):
+                import base64
+
+                body = base64.b64decode(body).decode("utf-8")
             body = json.loads(body)
     except Exception as e:
         return create_response(
             status_code=400, body={"message": "Error: Body is not valid json"}
         )
 
-    dispatch = {
-        "/auth/get-tokens": {"GET": lambda: _get_tokens(query_string_params, api_key)},
-        "/auth/refresh-tokens": {"PUT": lambda: _refresh_tokens(body, api_key)},
-        "/workspaces": {
-            "POST": lambda: _workspaces_post(body, user),
-            "GET": lambda: _workspaces_get(path_params, user),
-        },
-        "/workspaces/{workspace_id}": {
-            "GET": lambda: _workspaces_get(path_params, user, query_string_params)
-        },
-        "/workspaces/{workspace_id}/limits": {
-            "PUT": lambda: _workspaces_set_limits(body, path_params, user)
-        },
-        "/workspaces/{workspace_id}/total-usage": {
-            "PUT": lambda: _workspaces_set_total_usage(body, path_params, api_key)
-        },
-        "/workspaces/{workspace_id}/provision": {
-            "POST": lambda: _workspace_provision(body, path_params)
-        },
-        "/workspaces/{workspace_id}/direct-pay-limit": {
-            "PUT": lambda: _workspace_direct_pay_limit(body, path_params, user)
-        },
-    }
-
     try:
-        closure = dispatch[resource][method]
+        route = ROUTES[resource][method]
+        instrumentation.set_route(f"{method} {resource}")
+        instrumentation.set_properties(
+            WorkspaceId=(path_params or {}).get("workspace_id")
+        )
     except KeyError as e:
         logger.exception(e)
         return create_response(
@@ -112,19 +337,55 @@ def handler(event, context):
             },
         )
 
+    # Invalid requests are rejected before any AWS client is created.
+    try:
+        request = _validate_request(
+            route,
+            Request(
+                body=body,
+                path_params=path_params,
+                query_string_params=query_string_params,
+                user=user,
+                api_key=api_key,
+            ),
+        )
+    except RequestValidationError as e:
+        return create_response(status_code=400, body={"message": str(e)})
+
     # Handle generic exceptions. Maybe we should have specific errors to indicate the
     # status code to be returned.
     try:
-        retval = closure()
-    except AssertionError as e:
-        return create_response(status_code=400, body={"message": str(e)})
+        retval = route.call(request)
     except Exception as e:
         logger.exception(e)
         return create_response(
             status_code=500, body={"message": f"{type(e).__name__}: {str(e)}"}
         )
 
-    return retval
+    if method == "GET":
+        retval = _apply_conditional_get(event, retval)
+
+    return _compress_response(event, retval)
+
+
+def _validate_request(route, request):
+    """Validates the body, path and query string parameters of the request with
+    the compiled schemas of its route.
+
+    return:
+        (Request) request with the numeric fields of the body converted to Decimal
+    raises:
+        RequestValidationError: The request does not match the schemas.
+    """
+    body = request.body
+    if route.body is not None:
+        body = route.body(body)
+    # API Gateway sends None rather than an empty object
+    if route.path is not None:
+        route.path(request.path_params or {})
+    if route.query is not None:
+        route.query(request.query_string_params or {})
+    return request._replace(body=body)
 
 
 ################################################################################
@@ -146,17 +407,160 @@ def create_response(status_code=200, body=None, headers=None):
     ## used for the front end application.
     headers["Access-Control-Allow-Origin"] = "*"
 
+    serialized_body = to_json(body)
     retval = {
         "statusCode": status_code,
         "headers": headers,
-        "body": json.dumps(body, cls=CustomEncoder),
+        "body": serialized_body,
     }
 
-    logger.info("Response: ")
-    logger.info(json.dumps(retval))
+    # The body is only serialized once. The log filter truncates the message to
+    # log_max_chars, the body is cut first so a large one is not copied into it.
+    if logger.isEnabledFor(logging.INFO):
+        logger.info(
+            f"Response: {status_code} ({len(serialized_body)} characters) "
+            f"{serialized_body[:max_chars(logger)]}"
+        )
     return retval
 
 
+def to_json(obj):
+    """Serializes obj (e.g. DynamoDB items) to compact JSON"""
+    return json.dumps(obj, default=_json_default, separators=(",", ":"))
+
+
+def _json_default(obj):
+    """Converts the types returned by DynamoDB which are not JSON serializable"""
+    # Handle Decimal types which DynamoDB uses for numbers
+    if isinstance(obj, decimal.Decimal):
+        return float(obj)
+    if isinstance(obj, set):
+        return list(obj)
+    raise TypeError(f"Object of type {obj.__class__.__name__} is not JSON serializable")
+
+
+def _apply_conditional_get(event, response):
+    """Adds a strong ETag (hash of the serialized body) to successful GET responses and
+    replaces the response with 304 Not Modified when it matches If-None-Match.
+
+    Workspaces are per user, so the response may only be cached by the browser and
+    must be revalidated every time (Cache-Control: private, no-cache).
+
+    The compressed representations (see _compress_response) are different bytes,
+    so their ETag has the encoding as suffix ("<hash>-gzip", "<hash>-br").
+    """
+    if response.get("statusCode") != 200:
+        return response
+
+    etag = hashlib.sha256(response["body"].encode("utf-8")).hexdigest()
+    encoding = _response_encoding(event, response["body"])
+    if encoding is not None:
+        etag = f"{etag}-{encoding}"
+    etag = f'"{etag}"'
+    headers = {
+        "ETag": etag,
+        "Cache-Control": "private, no-cache",
+        "Access-Control-Expose-Headers": "ETag",
+        "Vary": "Accept-Encoding",
+    }
+
+    if_none_match = _get_header(event, "If-None-Match")
+    if if_none_match is not None:
+        client_etags = [t.strip() for t in if_none_match.split(",")]
+        # Weak comparison, as required for If-None-Match (RFC 7232)
+        client_etags = [t[2:] if t.startswith("W/") else t for t in client_etags]
+        if etag in client_etags or "*" in client_etags:
+            return {
+                "statusCode": 304,
+                "headers": {
+                    "Access-Control-Allow-Origin": "*",
+                    **headers,
+                },
+                "body": "",
+            }
+
+    response["headers"] = {**(response.get("headers") or {}), **headers}
+    return response
+
+
+def _compress_response(event, response):
+    """Compresses the body of large responses with brotli (when available) or gzip,
+    according to the Accept-Encoding header of the request. Compressed bodies are
+    returned base64 encoded, as required by the API Gateway proxy integration.
+    """
+    body = response.get("body")
+    if not body or response.get("isBase64Encoded"):
+        return response
+
+    body_bytes = body.encode("utf-8")
+    if len(body_bytes) < RESPONSE_COMPRESSION_MIN_BYTES:
+        return response
+
+    headers = {**(response.get("headers") or {}), "Vary": "Accept-Encoding"}
+    response["headers"] = headers
+
+    import base64
+    import gzip
+
+    encoding = _response_encoding(event, body)
+    if encoding == "br":
+        compressed = brotli.compress(body_bytes, quality=5)
+    elif encoding == "gzip":
+        compressed = gzip.compress(body_bytes, compresslevel=6)
+    else:
+        return response
+
+    headers["Content-Encoding"] = encoding
+    response["body"] = base64.b64encode(compressed).decode("ascii")
+    response["isBase64Encoded"] = True
+    return response
+
+
+def _response_encoding(event, body):
+    """Returns the Content-Encoding _compress_response gives to a response with this
+    (serialized) body: "br", "gzip" or None when it is not compressed."""
+    if not body or len(body.encode("utf-8")) < RESPONSE_COMPRESSION_MIN_BYTES:
+        return None
+    return _negotiate_encoding(_get_header(event, "Accept-Encoding"))
+
+
+def _negotiate_encoding(accept_encoding):
+    """Returns "br", "gzip" or None, the preferred encoding which is accepted (q > 0)."""
+    if not accept_encoding:
+        return None
+
+    accepted = {}
+    for value in accept_encoding.split(","):
+        name, _, params = value.strip().partition(";")
+        quality = 1.0
+        params = params.strip()
+        if params.startswith("q="):
+            try:
+                quality = float(params[2:])
+            except ValueError:
+                quality = 0.0
+        accepted[name.strip().lower()] = quality
+
+    default = accepted.get("*", 0.0)
+    candidates = (["br"] if brotli is not None else []) + ["gzip"]
+    best = None
+    for name in candidates:
+        quality = accepted.get(name, default)
+        if quality > 0 and (best is None or quality > best[0]):
+            best = (quality, name)
+    return best[1] if best else None
+
+
+def _get_header(event, name):
+    """Case insensitive lookup of a request header"""
+    headers = event.get("headers") or {}
+    name = name.lower()
+    for key, value in headers.items():
+        if key.lower() == name:
+            return value
+    return None
+
+
 ################################################################################
 
 ################################################################################
@@ -167,10 +571,8 @@ def _get_tokens(query_string_params, api_key):
     auth provider (Fence) and exchange it for access and id tokens using the client
     secret."""
 
-    try:
-        code = query_string_params["code"]
-    except Exception as e:
-        raise AssertionError("'code' is required query string parameter to get-tokens")
+    # Required by the query string schema of the route
+    code = query_string_params["code"]
 
     base_url = os.environ.get("auth_oidc_uri", None)
     grant_type = "authorization_code"
@@ -181,6 +583,9 @@ def _get_tokens(query_string_params, api_key):
     # Grab the client secret value from SecretsManager
     client_secret = get_secret(client_secret_name)
 
+    import base64
+    from urllib.request import Request, urlopen
+
     auth_string = f"{client_id}:{client_secret}".encode("utf-8")
     auth_b64 = base64.b64encode(auth_string).decode("utf-8")
 
@@ -188,7 +593,8 @@ def _get_tokens(query_string_params, api_key):
         base_url, grant_type, code, redirect_uri
     )
 
-    logger.info(f"Requesting tokens: {url}")
+    # Not the URL, its query string has the code
+    logger.info(f"Requesting tokens: {base_url}/oauth2/token ({grant_type})")
     req = Request(url, data={})
     req.add_header("Content-Type", "application/x-www-form-urlencoded")
     req.add_header("Authorization", f"Basic {auth_b64}")
@@ -212,12 +618,8 @@ def _get_tokens(query_string_params, api_key):
 def _refresh_tokens(body, api_key):
     """This takes a refresh_token in the body and returns a new set of tokens"""
 
-    try:
-        refresh_token = body["refresh_token"]
-    except Exception as e:
-        raise AssertionError(
-            "'refresh_token' not found in data provided to refresh tokens calls."
-        )
+    # Required by the body schema of the route
+    refresh_token = body["refresh_token"]
 
     base_url = os.environ.get("auth_oidc_uri", None)
     grant_type = "refresh_token"
@@ -227,13 +629,17 @@ def _refresh_tokens(body, api_key):
     # Grab the client secret value from SecretsManager
     client_secret = get_secret(client_secret_name)
 
+    import base64
+    from urllib.request import Request, urlopen
+
     auth_string = f"{client_id}:{client_secret}".encode("utf-8")
     auth_b64 = base64.b64encode(auth_string).decode("utf-8")
 
     url = "{}/oauth2/token?grant_type={}&refresh_token={}".format(
         base_url, grant_type, refresh_token
     )
-    logger.info(url)
+    # Not the URL, its query string has the refresh token
+    logger.info(f"Requesting tokens: {base_url}/oauth2/token ({grant_type})")
     req = Request(url, data={})
     req.add_header("Content-Type", "application/x-www-form-urlencoded")
     req.add_header("Authorization", f"Basic {auth_b64}")
@@ -262,12 +668,13 @@ def _refresh_tokens(body, api_key):
 
 ####################### Functions to handle API Method Calls ###################
 def _workspaces_post(body, email):
-    assert "workspace_type" in body
     workspace_type = body["workspace_type"]
 
     if workspace_type not in VALID_WORKSPACE_TYPES:
         raise ValueError(f"Invalid workspace_type: {workspace_type}")
 
+    import uuid
+
     workspace_request_id = str(uuid.uuid4())
 
     # Generate email address for root account
@@ -313,18 +720,13 @@ def _workspaces_post(body, email):
         item["hard-limit"] = decimal.Decimal(DEFAULT_STRIDES_CREDITS_AMOUNT * 0.9)
     item["total-usage"] = 0
 
-    # Get the dynamodb table name from SSM Parameter Store
-    dynamodb_table_name = _get_dynamodb_table_name()
-    dynamodb = boto3.resource("dynamodb")
-    table = dynamodb.Table(dynamodb_table_name)
-
-    table.put_item(Item=item)
+    _get_workspace_repository().put(item)
 
     ## Send request email
     if workspace_type == "STRIDES Credits":
-        EmailHelper.send_credits_workspace_request_email(item)
+        _get_email_helper().send_credits_workspace_request_email(item)
     elif workspace_type == "STRIDES Grant":
-        EmailHelper.send_grant_workspace_request_email(item)
+        _get_email_helper().send_grant_workspace_request_email(item)
 
     if workspace_type == "Direct Pay":
         return create_response(
@@ -345,9 +747,6 @@ def _workspace_provision(body, path_params):
         4. Store information in DynamoDB and set some Account
             defaults (soft limit, hard limit, strides credits)
     """
-    assert "workspace_id" in path_params
-    assert "account_id" in body
-
     user_services_email = os.environ.get("user_services_email", None)
     if user_services_email is None:
         raise ValueError("Could not find user services email.")
@@ -359,7 +758,10 @@ def _workspace_provision(body, path_params):
 
     # Grab the current status. Don't provision unless
     # the request is pending
-    status, email = _get_workspace_request_status_and_email(workspace_id)
+    try:
+        status, email = _get_workspace_request_status_and_email(workspace_id)
+    except WorkspaceNotFoundError as e:
+        return create_response(status_code=404, body={"message": str(e)})
     if status not in ["pending", "failed", "error"]:
         raise ValueError("Request must be in pending status to provision")
 
@@ -421,48 +823,20 @@ def _workspace_provision(body, path_params):
         else:
             raise e
 
-    # Get the dynamodb table name from SSM Parameter Store
-    dynamodb_table_name = _get_dynamodb_table_name()
-    dynamodb = boto3.resource("dynamodb")
-    table = dynamodb.Table(dynamodb_table_name)
-
-    update_expression = "set #apikey = :apikey, #snstopic = :snstopic, #requeststatus = :requeststatus, #accountid = :accountid, #provisiontime = :provisiontime"
-    expression_attribute_values = {
-        ":apikey": api_key,
-        ":snstopic": topic_arn,
-        ":requeststatus": "provisioning",
-        ":accountid": account_id,
-        ":provisiontime": int(datetime.now(timezone.utc).timestamp()),
+    values = {
+        "api-key": api_key,
+        "sns-topic": topic_arn,
+        "request_status": "provisioning",
+        "account_id": account_id,
+        "provision_time": int(datetime.now(timezone.utc).timestamp()),
     }
-    expression_attribute_names = {
-        "#apikey": "api-key",
-        "#snstopic": "sns-topic",
-        "#requeststatus": "request_status",
-        "#accountid": "account_id",
-        "#provisiontime": "provision_time",
-    }
-
     if strides_credits_amount is not None:
-        update_expression += ", #stridescredits = :stridescredits"
-        expression_attribute_names["#stridescredits"] = "strides-credits"
-        expression_attribute_values[":stridescredits"] = (
-            decimal.Decimal(strides_credits_amount),
-        )
+        values["strides-credits"] = (decimal.Decimal(strides_credits_amount),)
 
     try:
-        table_response = table.update_item(
-            Key={"bmh_workspace_id": workspace_id, "user_id": email},
-            UpdateExpression=update_expression,
-            ConditionExpression="attribute_exists(bmh_workspace_id)",
-            ExpressionAttributeValues=expression_attribute_values,
-            ExpressionAttributeNames=expression_attribute_names,
-            ReturnValues="ALL_NEW",
-        )
-    except ClientError as e:
-        if e.response["Error"]["Code"] == "ConditionalCheckFailedException":
-            raise Exception("Could not find Workspace " f"with id {workspace_id}")
-        else:
-            raise e
+        _get_workspace_repository().update(workspace_id, email, values)
+    except WorkspaceNotFoundError as e:
+        raise Exception(str(e))
 
     _start_sfn_workflow(workspace_id, api_key, account_id)
 
@@ -502,6 +876,8 @@ def _start_sfn_workflow(workspace_id, api_key, account_id):
     }
 
     state_machine_arn = os.environ.get("state_machine_arn")
+    import uuid
+
     execution_uuid = str(uuid.uuid4())
     execution_name = f"create-{workspace_id}_{execution_uuid}"
 
@@ -522,46 +898,30 @@ def _start_sfn_workflow(workspace_id, api_key, account_id):
 def _workspaces_get(path_params, email, query_string_params=None):
     """Will return a list of workspaces rows based the email
     of the user"""
-    dynamodb_table_name = _get_dynamodb_table_name()
-    dynamodb = boto3.resource("dynamodb")
-    table = dynamodb.Table(dynamodb_table_name)
-
-    # Use expression attributes because dashes are not
-    # allowed.
-
-    projection = ", ".join(
-        [
-            "#bmhworkspaceid",
-            "#nihaward",
-            "#requeststatus",
-            "#workspacetype",
-            "#totalusage",
-            "#stridescredits",
-            "#softlimit",
-            "#hardlimit",
-            "#directpaylimit",
-        ]
-    )
-
-    expression_attribute_names = {
-        "#bmhworkspaceid": "bmh_workspace_id",
-        "#nihaward": "nih_funded_award_number",
-        "#requeststatus": "request_status",
-        "#workspacetype": "workspace_type",
-        "#totalusage": "total-usage",
-        "#stridescredits": "strides-credits",
-        "#softlimit": "soft-limit",
-        "#hardlimit": "hard-limit",
-        "#directpaylimit": "direct_pay_limit",
-    }
+    repository = _get_workspace_repository()
 
     status_code = 200
     retval = []
 
+    changed_since = (query_string_params or {}).get("changed_since")
+    if changed_since is not None:
+        admin_all = (path_params or {}).get("workspace_id") == "admin_all"
+        message = None
+        if not changed_since.isdigit():
+            message = "changed_since must be a timestamp in milliseconds"
+        elif not admin_all and path_params:
+            message = "changed_since is only supported for lists"
+        elif not admin_all and not email:
+            message = "Required user"
+        if message is not None:
+            return create_response(status_code=400, body={"message": message})
+        return _workspaces_get_changed(
+            repository, None if admin_all else email, int(changed_since)
+        )
+
     if path_params is not None and "workspace_id" in path_params:
         if path_params["workspace_id"] == "admin_all":
-            response = table.scan()
-            retval = response.get("Items", [])
+            retval = list(repository.list_all())
             if len(retval) == 0:
                 status_code = 204  # No content, resource was found, but it's empty.
         else:
@@ -571,37 +931,118 @@ def _workspaces_get(path_params, email, query_string_params=None):
                     email = query_string_params["user"]
                 else:
                     raise Exception("Required `user` query parameter")
-            response = table.get_item(
-                Key={"bmh_workspace_id": path_params["workspace_id"], "user_id": email},
-                ProjectionExpression=projection,
-                ExpressionAttributeNames=expression_attribute_names,
+            # The cost breakdown is only returned for a single workspace, not for
+            # listings. It is a request detail, and still on the workspace item of
+            # the workspaces which were not migrated (scripts/split_workspace_details.py).
+            retval = repository.get(
+                path_params["workspace_id"],
+                email,
+                attributes=WORKSPACE_ATTRIBUTES + ["cost-breakdown"],
             )
-            retval = response.get("Item", None)
             if retval is None:
                 status_code = 404
+            else:
+                retval.update(
+                    repository.get_details(
+                        path_params["workspace_id"],
+                        email,
+                        attributes=["cost-breakdown"],
+                    )
+                )
 
     else:
-        response = table.query(
-            KeyConditionExpression=Key("user_id").eq(email),
-            ProjectionExpression=projection,
-            ExpressionAttributeNames=expression_attribute_names,
-        )
-
-        retval = response.get("Items", [])
+        retval = repository.list_by_user(email, attributes=WORKSPACE_ATTRIBUTES)
         if len(retval) == 0:
             status_code = 204  # No content, resource was found, but it's empty.
 
     return create_response(status_code=status_code, body=retval)
 
 
+def _workspaces_get_changed(repository, email, changed_since):
+    """Returns the workspaces modified after changed_since (epoch milliseconds), so
+    that polling clients do not have to fetch the full list to notice a change. The
+    changes of all the workspaces (admin_all) are read from the (sharded) changes
+    index, the changes of a user from the user's partition.
+
+    The workspaces have the same attributes as in the full listing: all of them for
+    admin_all, WORKSPACE_ATTRIBUTES (and last_modified) for a user.
+
+    args:
+        repository: WorkspaceRepository.
+        email: (string) Only return the workspaces of this user. None for all workspaces.
+        changed_since: (int) Timestamp in milliseconds.
+
+    return:
+        API response with {"workspaces": [...], "changed_until": <timestamp>}, where
+        changed_until should be used as changed_since by the next request.
+    """
+    # Taken before the query so that nothing written during the query is missed.
+    changed_until = max(
+        changed_since, _now_milliseconds() - CHANGES_INDEX_LAG_MILLISECONDS
+    )
+
+    items = repository.list_changed(
+        changed_since,
+        user_id=email,
+        attributes=None if email is None else WORKSPACE_ATTRIBUTES + ["last_modified"],
+    )
+
+    return create_response(
+        status_code=200, body={"workspaces": items, "changed_until": changed_until}
+    )
+
+
+def _workspaces_batch_get(body, email):
+    """Returns the workspaces of a list of workspace ids in a single request (with the
+    same attributes as the workspace listing), instead of one
+    GET /workspaces/{workspace_id} per workspace.
+
+    Like GET /workspaces/{workspace_id}, users only get their own workspaces.
+    Applications (client_credentials) may pass the user_id of each workspace,
+    otherwise it is looked up with the bmh_workspace_id index.
+
+    The body is {"workspaces": [{"workspace_id": <id>, "user_id": <optional>}, ...]}
+    and the response {"workspaces": [<workspace>, ...], "not_found": [<id>, ...]}
+    """
+    repository = _get_workspace_repository()
+
+    # Preserve the order of the request, without duplicates
+    workspace_ids = list(dict.fromkeys(w["workspace_id"] for w in body["workspaces"]))
+
+    # Email is None for requests made by an application using client_credentials.
+    if email:
+        user_ids = {workspace_id: email for workspace_id in workspace_ids}
+    else:
+        user_ids = {
+            w["workspace_id"]: w["user_id"]
+            for w in body["workspaces"]
+            if "user_id" in w
+        }
+        unresolved = [w for w in workspace_ids if w not in user_ids]
+        user_ids.update(repository.find_user_ids(unresolved))
+
+    keys = [
+        (workspace_id, user_ids[workspace_id])
+        for workspace_id in workspace_ids
+        if workspace_id in user_ids
+    ]
+    items = {
+        item["bmh_workspace_id"]: item
+        for item in repository.batch_get(keys, attributes=WORKSPACE_ATTRIBUTES)
+    }
+
+    return create_response(
+        status_code=200,
+        body={
+            "workspaces": [items[w] for w in workspace_ids if w in items],
+            "not_found": [w for w in workspace_ids if w not in items],
+        },
+    )
+
+
 def _workspaces_set_limits(body, path_params, user):
     logger.info(f"Called 'set limit': {body}")
 
-    # Validate body and path_params
-    assert "workspace_id" in path_params
-    assert "soft-limit" in body
-    assert "hard-limit" in body
-
     # User is None for requests made by an application using client_credentials.
     if not user:
         if "user" in body:
@@ -609,11 +1050,7 @@ def _workspaces_set_limits(body, path_params, user):
         else:
             raise Exception("Required `user` parameter in request body")
 
-    # Get the dynamodb table name from SSM Parameter Store
     workspace_id = path_params["workspace_id"]
-    dynamodb_table_name = _get_dynamodb_table_name()
-    dynamodb = boto3.resource("dynamodb")
-    table = dynamodb.Table(dynamodb_table_name)
 
     soft_limit = round(decimal.Decimal(body["soft-limit"]), 2)
     hard_limit = round(decimal.Decimal(body["hard-limit"]), 2)
@@ -622,50 +1059,28 @@ def _workspaces_set_limits(body, path_params, user):
         raise ValueError("Hard limit must be larger than soft limit")
 
     try:
-        update_expression = (
-            "SET "
-            "#soft = :soft, "
-            "#hard = :hard, "
-            "#limitupdatetime = :limitupdatetime, "
-            "#ecs = :ecs, "
-            "#local = :local, "
-            "#status = :status"
-        )
-        table_response = table.update_item(
-            Key={"bmh_workspace_id": workspace_id, "user_id": user},
-            UpdateExpression=update_expression,
-            ConditionExpression="attribute_exists(bmh_workspace_id)",
-            ExpressionAttributeValues={
-                ":soft": round(decimal.Decimal(body["soft-limit"]), 2),
-                ":hard": round(decimal.Decimal(body["hard-limit"]), 2),
-                ":limitupdatetime": int(datetime.now(timezone.utc).timestamp()),
-                ":ecs": bool(False),
-                ":local": bool(True),
-                ":status": "active",
-            },
-            ExpressionAttributeNames={
-                "#soft": "soft-limit",
-                "#hard": "hard-limit",
-                "#limitupdatetime": "limit_update_time",
-                "#ecs": "ecs",
-                "#local": "local",
-                "#status": "request_status",
+        attributes = _get_workspace_repository().update(
+            workspace_id,
+            user,
+            {
+                "soft-limit": soft_limit,
+                "hard-limit": hard_limit,
+                "limit_update_time": int(datetime.now(timezone.utc).timestamp()),
+                "ecs": bool(False),
+                "local": bool(True),
+                "request_status": "active",
             },
-            ReturnValues="ALL_NEW",
         )
-        logger.info(f"Table response: {table_response}")
-    except ClientError as e:
-        if e.response["Error"]["Code"] == "ConditionalCheckFailedException":
-            raise Exception("Could not find BMH Workspace " f"with id {workspace_id}")
-        else:
-            raise e
+        logger.info(f"Updated attributes: {attributes}")
+    except WorkspaceNotFoundError:
+        raise Exception("Could not find BMH Workspace " f"with id {workspace_id}")
 
-    if not "sns-topic" in table_response["Attributes"]:
+    if not "sns-topic" in attributes:
         logger.warning(f"SNS topic ARN does not exist yet.")
     else:
-        sns_topic_arn = table_response["Attributes"]["sns-topic"]
-        total_usage = table_response["Attributes"]["total-usage"]
-        workspace_type = table_response["Attributes"]["workspace_type"]
+        sns_topic_arn = attributes["sns-topic"]
+        total_usage = attributes["total-usage"]
+        workspace_type = attributes["workspace_type"]
         site_name = _get_site_info()
 
         subject = f"[{site_name}] Workspace : Soft and Hard limits updated"
@@ -695,7 +1110,7 @@ def _workspaces_set_limits(body, path_params, user):
             logger.error(f"SNS topic ARN exists but publishing SNS topic failed.")
             logger.error(e)
 
-    return create_response(status_code=200, body=table_response["Attributes"])
+    return create_response(status_code=200, body=attributes)
 
 
 def _workspaces_set_total_usage(body, path_params, api_key):
@@ -703,126 +1118,218 @@ def _workspaces_set_total_usage(body, path_params, api_key):
     This is expected to be called by a Gen3 Workspace Account and is not authenticated
     like the rest of the methods."""
 
-    # Validate inputs
-    assert "workspace_id" in path_params
-    assert "total-usage" in body
-    assert api_key is not None
+    if api_key is None:
+        return _api_key_required()
 
     # Where is the API Key? We should validate that
-    dynamodb_table_name = _get_dynamodb_table_name()
-    dynamodb_index_name = _get_dynamodb_index_name()
-    dynamodb = boto3.resource("dynamodb")
-    table = dynamodb.Table(dynamodb_table_name)
+    repository = _get_workspace_repository()
+    workspace_id = path_params["workspace_id"]
     total_usage = body["total-usage"]
 
     # Query the Global Secondary Index to get the User.
-    try:
-        index_response = table.query(
-            IndexName=dynamodb_index_name,
-            KeyConditionExpression=Key("bmh_workspace_id").eq(
-                path_params["workspace_id"]
-            ),
-            ReturnConsumedCapacity="NONE",
-        )
-    except ClientError as e:
-        if e.response["Error"]["Code"] == "ConditionalCheckFailedException":
-            return create_response(
-                status_code=400,
-                body={
-                    "message": f"Could not find Workspace with id {path_params['workspace_id']}"
-                },
-            )
-        else:
-            raise e
+    user_id = repository.find_user_id(workspace_id)
 
     ## TODO: Confirm that the API key matches the Workspace ID
 
+    if user_id is None:
+        return create_response(
+            status_code=404,
+            body={"message": f"Could not find Workspace with id {workspace_id}"},
+        )
+
+    # When a queue is configured (total_usage_queue_enabled), the update is applied
+    # asynchronously by total_usage_queue_handler. This absorbs the spike of updates
+    # sent when the Cost and Usage Reports of all the workspace accounts are
+    # refreshed. Callers must accept the 202 response.
+    queue_url = os.environ.get("total_usage_queue_url")
+    if queue_url:
+        _enqueue_total_usage(queue_url, workspace_id, user_id, total_usage)
+        return create_response(status_code=202, body={})
+
     # And now update the row.
-    items = index_response.get("Items", [])
-    assert len(items) == 1
-    workspace_id = items[0]["bmh_workspace_id"]
-    user_id = items[0]["user_id"]
-    formatted_total_usage = round(decimal.Decimal(total_usage), 2)
 
-    try:
-        table_response = table.update_item(
-            Key={"bmh_workspace_id": workspace_id, "user_id": user_id},
-            UpdateExpression="set #totalUsage = :totalUsage, #usageupdatetime = :usageupdatetime",
-            ConditionExpression="attribute_exists(bmh_workspace_id)",
-            ExpressionAttributeValues={
-                ":totalUsage": formatted_total_usage,
-                ":usageupdatetime": int(datetime.now(timezone.utc).timestamp()),
-            },
-            ExpressionAttributeNames={
-                "#totalUsage": "total-usage",
-                "#usageupdatetime": "usage_update_time",
+    _update_total_usage(repository, workspace_id, user_id, total_usage)
+
+    return create_response(status_code=200, body={})
+
+
+def _api_key_required():
+    """Response to the requests of the workspace accounts made without an API key"""
+    return create_response(status_code=403, body={"message": "An API key is required"})
+
+
+def _enqueue_total_usage(
+    queue_url, workspace_id, user_id, total_usage, reported_at=None, delay_seconds=0
+):
+    """Sends a total-usage update to the SQS queue. reported_at (epoch milliseconds,
+    defaults to now) is used by the consumer to keep the latest update of each
+    workspace. The message is delivered after delay_seconds (at most 900)."""
+    if reported_at is None:
+        reported_at = int(datetime.now(timezone.utc).timestamp() * 1000)
+    sqs = boto3.client("sqs")
+    sqs.send_message(
+        QueueUrl=queue_url,
+        MessageBody=json.dumps(
+            {
+                "workspace_id": workspace_id,
+                "user_id": user_id,
+                "total-usage": str(total_usage),
+                "reported_at": reported_at,
+            }
+        ),
+        DelaySeconds=delay_seconds,
+    )
+
+
+def _workspaces_set_total_usage_bulk(body, user):
+    """This function handles calls to update total-usage of many workspaces at once,
+    e.g. from central billing tooling. Limits are evaluated (and notifications sent)
+    exactly like PUT /workspaces/{workspace_id}/total-usage.
+
+    Only applications (client_credentials access tokens) may call this endpoint.
+
+    The body is {"workspaces": [{"workspace_id": <id>, "total-usage": <number>}, ...]}
+    and the response has one result per workspace, in the same order:
+    {"results": [{"workspace_id": <id>, "status": <200|400|404|500>, "message": <str>}]}
+    """
+
+    if user is not None:
+        return create_response(
+            status_code=403,
+            body={"message": "Only applications can update total-usage in bulk"},
+        )
+
+    if not isinstance(body, dict) or not isinstance(body.get("workspaces"), list):
+        return create_response(
+            status_code=400, body={"message": "workspaces must be a list"}
+        )
+    updates = body["workspaces"]
+    if len(updates) > MAX_BULK_TOTAL_USAGE_ITEMS:
+        return create_response(
+            status_code=400,
+            body={
+                "message": f"At most {MAX_BULK_TOTAL_USAGE_ITEMS} workspaces can be updated at once"
             },
-            ReturnValues="ALL_OLD",
         )
-        logger.info(f"Table response: {json.dumps(table_response, cls=CustomEncoder)}")
-    except ClientError as e:
-        if e.response["Error"]["Code"] == "ConditionalCheckFailedException":
-            raise Exception("Could not find Workspace " f"with id {workspace_id}")
-        else:
-            raise e
 
-    old_total_usage = table_response["Attributes"]["total-usage"]
-    soft_limit = table_response["Attributes"]["soft-limit"]
-    hard_limit = table_response["Attributes"]["hard-limit"]
-    workspace_type = table_response["Attributes"]["workspace_type"]
-    site_name = _get_site_info()
+    results = []
+    valid = {}
+    seen = set()
+    for update in updates:
+        workspace_id = update.get("workspace_id") if isinstance(update, dict) else None
+        result = {"workspace_id": workspace_id, "status": 200, "message": ""}
+        results.append(result)
+        try:
+            total_usage = _validate_bulk_total_usage(update, seen)
+        except RequestValidationError as e:
+            result.update(status=400, message=str(e))
+            continue
+        valid[workspace_id] = (total_usage, result)
+
+    repository = _get_workspace_repository()
+    user_ids = repository.find_user_ids(list(valid))
+
+    def update_total_usage(workspace_id):
+        total_usage, result = valid[workspace_id]
+        if workspace_id not in user_ids:
+            result.update(
+                status=404, message=f"Could not find Workspace with id {workspace_id}"
+            )
+            return
+        try:
+            old_attributes = _update_total_usage(
+                repository, workspace_id, user_ids[workspace_id], total_usage
+            )
+            if old_attributes is None:
+                result["message"] = "Unchanged"
+        except Exception as e:
+            logger.exception(e)
+            result.update(status=500, message=f"{type(e).__name__}: {str(e)}")
 
-    sns_topic_arn = table_response["Attributes"]["sns-topic"]
-    message = "Success"
-    if old_total_usage < hard_limit <= formatted_total_usage:
-        logger.info(
-            f"Surpassed the hard limit: {old_total_usage=} {formatted_total_usage=} {hard_limit=}"
-        )
+    if valid:
+        from concurrent.futures import ThreadPoolExecutor
 
-        subject = f"[{site_name}] Workspace : Total usage exceeds Hard limit"
-        message = f"""Total usage exceeds the set Hard limit for the following user in {site_name}.
-            Workspace info:
-            User ID : {user_id}
-            Workspace Type: {workspace_type}
-            workspace_id: {workspace_id}
-            Total Usage: {total_usage}
-            Soft Usage Limit: {soft_limit}
-            Hard Usage Limit: {hard_limit}
+        with ThreadPoolExecutor(
+            max_workers=min(BULK_MAX_WORKERS, len(valid))
+        ) as executor:
+            list(executor.map(update_total_usage, valid))
 
-            User services, please use this email template : https://docs.google.com/document/d/1BAkRsYlcJLyzGueVMEZ8xGiJgMd_yAzK6t5mmsiOW7E/edit?pli=1#heading=h.f36t295d0h33
-        """
-        attributes = {
-            "workspace_id": {"DataType": "String", "StringValue": workspace_id},
-            "user_id": {"DataType": "String", "StringValue": user_id},
-            "total_usage": {
-                "DataType": "String",
-                "StringValue": str(formatted_total_usage),
-            },
-            "hard_limit": {"DataType": "String", "StringValue": str(hard_limit)},
-        }
-        #  TODO: Publish to admin email instead of per user
-        _publish_to_sns_topic(sns_topic_arn, subject, message, attributes)
+    return create_response(status_code=200, body={"results": results})
 
-    elif old_total_usage < soft_limit <= formatted_total_usage:
-        logger.info(
-            f"Surpassed the soft limit: {old_total_usage=} {formatted_total_usage=} {soft_limit=}"
-        )
 
-        subject = f"[{site_name}] Workspace : Total usage exceeds Soft limit"
-        message = f"""Total usage exceeds the set Soft limit for the following user in {site_name}.
-            Workspace info:
-            User ID : {user_id}
-            Workspace Type: {workspace_type}
-            workspace_id: {workspace_id}
-            Total Usage: {total_usage}
-            Soft Usage Limit: {soft_limit}
-            Hard Usage Limit: {hard_limit}
+def _validate_bulk_total_usage(update, seen):
+    """Validates one workspace of PUT /workspaces/total-usage. A workspace_id which
+    appeared in a previous item is rejected (the first one is applied).
 
-            User services, please use this email template : https://docs.google.com/document/d/1BAkRsYlcJLyzGueVMEZ8xGiJgMd_yAzK6t5mmsiOW7E/edit?pli=1#heading=h.2c3nxovihdgc
+    args:
+        update (dict): {"workspace_id": <id>, "total-usage": <number>}
+        seen (set): workspace_ids of the previous items, updated.
 
-        """
-        #  TODO: Publish to admin email instead of per user
-        _publish_to_sns_topic(sns_topic_arn, subject, message)
+    return:
+        total_usage: the total-usage of the item.
+
+    raises:
+        RequestValidationError: the item is invalid.
+    """
+    if not isinstance(update, dict):
+        raise RequestValidationError("Each workspace must be an object")
+    workspace_id = update.get("workspace_id")
+    if not isinstance(workspace_id, str) or not workspace_id:
+        raise RequestValidationError("workspace_id is required")
+    if workspace_id in seen:
+        raise RequestValidationError("Duplicate workspace_id")
+    seen.add(workspace_id)
+    if "total-usage" not in update:
+        raise RequestValidationError("total-usage is required")
+    try:
+        decimal.Decimal(str(update["total-usage"]))
+    except decimal.InvalidOperation:
+        raise RequestValidationError("total-usage must be a number")
+    return update["total-usage"]
+
+
+def _workspaces_set_cost_breakdown(body, path_params, api_key):
+    """This function handles calls to update the per-month and per-service cost breakdown
+    of a workspace. Like total-usage, this is expected to be called by a Gen3 Workspace
+    Account (authenticated with an API Key).
+
+    The breakdown is stored with the request details of the workspace as a map of
+    {"YYYY-MM": {"<service>": cost}}, keeping only the most recent months."""
+
+    if api_key is None:
+        return _api_key_required()
+
+    # The body was validated with the schema of the route: months are YYYY-MM,
+    # so the most recent ones are the last in string order.
+
+    breakdown = body["cost-breakdown"]
+    formatted_breakdown = {}
+    for month in sorted(breakdown, reverse=True)[:MAX_COST_BREAKDOWN_MONTHS]:
+        services = breakdown[month]
+        formatted_breakdown[month] = {
+            service: round(decimal.Decimal(str(cost)), 2)
+            for service, cost in services.items()
+        }
+
+    repository = _get_workspace_repository()
+    workspace_id = path_params["workspace_id"]
+
+    # Query the Global Secondary Index to get the User.
+    user_id = repository.find_user_id(workspace_id)
+    if user_id is None:
+        return create_response(
+            status_code=404,
+            body={"message": f"Could not find Workspace with id {workspace_id}"},
+        )
+
+    repository.update_details(
+        workspace_id,
+        user_id,
+        {
+            "cost-breakdown": formatted_breakdown,
+            "cost_breakdown_update_time": int(datetime.now(timezone.utc).timestamp()),
+        },
+    )
 
     return create_response(status_code=200, body={})
 
@@ -830,10 +1337,6 @@ def _workspaces_set_total_usage(body, path_params, api_key):
 def _workspace_direct_pay_limit(body, path_params, user):
     logger.info(f"Called 'set limit': {body}")
 
-    # Validate body and path_params
-    assert "workspace_id" in path_params
-    assert "direct_pay_limit" in body
-
     # User is None for requests made by an application using client_credentials.
     if not user:
         if "user" in body:
@@ -841,32 +1344,8 @@ def _workspace_direct_pay_limit(body, path_params, user):
         else:
             raise Exception("Required `user` parameter in request body")
 
-    # Get the dynamodb table name from SSM Parameter Store
     workspace_id = path_params["workspace_id"]
-    dynamodb_table_name = _get_dynamodb_table_name()
-    dynamodb = boto3.resource("dynamodb")
-    table = dynamodb.Table(dynamodb_table_name)
-    projection = ", ".join(
-        [
-            "#bmhworkspaceid",
-            "#requeststatus",
-            "#workspacetype",
-            "#totalusage",
-            "#softlimit",
-            "#hardlimit",
-            "#directpaylimit",
-        ]
-    )
-
-    expression_attribute_names = {
-        "#bmhworkspaceid": "bmh_workspace_id",
-        "#requeststatus": "request_status",
-        "#workspacetype": "workspace_type",
-        "#totalusage": "total-usage",
-        "#softlimit": "soft-limit",
-        "#hardlimit": "hard-limit",
-        "#directpaylimit": "direct_pay_limit",
-    }
+    repository = _get_workspace_repository()
 
     try:
         direct_pay_limit = round(decimal.Decimal(body["direct_pay_limit"]), 2)
@@ -880,12 +1359,19 @@ def _workspace_direct_pay_limit(body, path_params, user):
         raise ValueError("Direct pay limit must be a positive number")
 
     try:
-        response = table.get_item(
-            Key={"bmh_workspace_id": workspace_id, "user_id": user},
-            ProjectionExpression=projection,
-            ExpressionAttributeNames=expression_attribute_names,
+        retval = repository.get(
+            workspace_id,
+            user,
+            attributes=[
+                "bmh_workspace_id",
+                "request_status",
+                "workspace_type",
+                "total-usage",
+                "soft-limit",
+                "hard-limit",
+                "direct_pay_limit",
+            ],
         )
-        retval = response.get("Item", None)
     except Exception as e:
         raise ValueError(
             "Could not find record with existing workspace_id and user. Error:" + str(e)
@@ -904,22 +1390,14 @@ def _workspace_direct_pay_limit(body, path_params, user):
         )
 
     try:
-        table_response = table.update_item(
-            Key={"bmh_workspace_id": workspace_id, "user_id": user},
-            UpdateExpression="set #direct = :direct",
-            ConditionExpression="attribute_exists(bmh_workspace_id)",
-            ExpressionAttributeValues={":direct": direct_pay_limit},
-            ExpressionAttributeNames={"#direct": "direct_pay_limit"},
-            ReturnValues="ALL_NEW",
+        attributes = repository.update(
+            workspace_id, user, {"direct_pay_limit": direct_pay_limit}
         )
-        logger.info(f"Table response: {table_response}")
-    except ClientError as e:
-        if e.response["Error"]["Code"] == "ConditionalCheckFailedException":
-            raise Exception("Could not find BMH Workspace " f"with id {workspace_id}")
-        else:
-            raise e
+        logger.info(f"Updated attributes: {attributes}")
+    except WorkspaceNotFoundError:
+        raise Exception("Could not find BMH Workspace " f"with id {workspace_id}")
 
-    return create_response(status_code=200, body=table_response["Attributes"])
+    return create_response(status_code=200, body=attributes)
 
 
 ################################################################################
@@ -927,40 +1405,165 @@ def _workspace_direct_pay_limit(body, path_params, user):
 
 ################################ Helper Methods ################################
 def _get_workspace_request_status_and_email(workspace_request_id):
-    # Get the dynamodb table name from SSM Parameter Store
-    dynamodb_table_name = _get_dynamodb_table_name()
-    dynamodb_index_name = _get_dynamodb_index_name()
-    dynamodb = boto3.resource("dynamodb")
-    table = dynamodb.Table(dynamodb_table_name)
+    repository = _get_workspace_repository()
 
-    retval = None
-    try:
-        response = table.query(
-            IndexName=dynamodb_index_name,
-            KeyConditionExpression=Key("bmh_workspace_id").eq(workspace_request_id),
-            ReturnConsumedCapacity="NONE",
-        )
-    except Exception as e:
-        raise e
-
-    items = response.get("Items", [])
-    assert len(items) == 1
     # TODO:
     # This (poc_email) is the right way, but need more testing
     # Need to add to dyanmodb INDEX?
     # Needed for RAS integration.
     # email = items[0]['poc_email']
-    email = items[0]["user_id"]
+    email = repository.find_user_id(workspace_request_id)
+    item = None
+    if email is not None:
+        item = repository.get(
+            workspace_request_id, email, attributes=["request_status"]
+        )
+    if item is None:
+        raise WorkspaceNotFoundError(
+            f"Could not find Workspace with id {workspace_request_id}"
+        )
+
+    return item["request_status"], email
+
+
+def _defer_total_usage(workspace_id, user_id, total_usage, reported_at, retry_after):
+    """Queues a total-usage update which was too recent to be written, to apply it
+    when usage_update_min_interval_seconds is over. A newer update of the workspace
+    stored in the meantime makes the consumer drop it (see reported_at)."""
+    queue_url = os.environ.get("total_usage_flush_queue_url")
+    if not queue_url:
+        logger.warning(
+            f"Dropped total-usage update of {workspace_id}: too recent and "
+            "total_usage_flush_queue_url is not set"
+        )
+        return
+    # SQS delays messages by at most 15 minutes, an update still too recent when it
+    # is delivered is deferred again
+    delay_seconds = min(900, max(1, math.ceil(retry_after)))
+    logger.info(
+        f"Deferred total-usage update of {workspace_id} by {delay_seconds} seconds"
+    )
+    _enqueue_total_usage(
+        queue_url,
+        workspace_id,
+        user_id,
+        total_usage,
+        reported_at=reported_at,
+        delay_seconds=delay_seconds,
+    )
+
+
+def _update_total_usage(
+    repository, workspace_id, user_id, total_usage, reported_at=None
+):
+    """Stores the total-usage of a workspace and publishes a message to the workspace
+    SNS topic when the new value crosses the soft or hard limit.
+
+    Nothing is written when the (rounded) value did not change. When the
+    usage_update_min_interval_seconds environment variable is set, updates received
+    less than that many seconds after the previous one are not written either,
+    unless they cross the soft or hard limit: they are sent to the queue of
+    total_usage_flush_queue_url, delayed until the interval is over, so the last
+    value of a burst is stored when it closes. Updates reported before the last
+    stored one (e.g. queued updates delivered out of order) are dropped.
+
+    args:
+        repository: WorkspaceRepository.
+        workspace_id: (string) bmh_workspace_id of an existing workspace.
+        user_id: (string) user_id of the workspace.
+        total_usage: (number or string) New total usage.
+        reported_at: (int) When the usage was reported, in epoch milliseconds.
+            Defaults to now.
+
+    return:
+        attributes (dict): The attributes of the workspace before the update, None
+            if the update was skipped.
+    """
+    formatted_total_usage = round(decimal.Decimal(total_usage), 2)
+    min_interval = int(os.environ.get("usage_update_min_interval_seconds", 0))
+    if reported_at is None:
+        reported_at = int(datetime.now(timezone.utc).timestamp() * 1000)
 
     try:
-        response = table.get_item(
-            Key={"bmh_workspace_id": workspace_request_id, "user_id": email},
-            ProjectionExpression="request_status",
+        old_attributes = repository.update_total_usage(
+            workspace_id,
+            user_id,
+            formatted_total_usage,
+            min_interval=min_interval,
+            reported_at=reported_at,
         )
-    except Exception as e:
-        raise ValueError()
+    except WorkspaceNotFoundError as e:
+        raise Exception(str(e))
+    except UpdateCoalescedError as e:
+        _defer_total_usage(
+            workspace_id, user_id, formatted_total_usage, reported_at, e.retry_after
+        )
+        return None
+    if old_attributes is None:
+        logger.info(
+            f"Skipped total-usage update of {workspace_id}: unchanged or out of date"
+        )
+        return None
+    logger.info(f"Previous attributes: {to_json(old_attributes)}")
+
+    old_total_usage = old_attributes["total-usage"]
+    soft_limit = old_attributes["soft-limit"]
+    hard_limit = old_attributes["hard-limit"]
+    workspace_type = old_attributes["workspace_type"]
+    site_name = _get_site_info()
+
+    sns_topic_arn = old_attributes["sns-topic"]
+    if old_total_usage < hard_limit <= formatted_total_usage:
+        logger.info(
+            f"Surpassed the hard limit: {old_total_usage=} {formatted_total_usage=} {hard_limit=}"
+        )
+
+        subject = f"[{site_name}] Workspace : Total usage exceeds Hard limit"
+        message = f"""Total usage exceeds the set Hard limit for the following user in {site_name}.
+            Workspace info:
+            User ID : {user_id}
+            Workspace Type: {workspace_type}
+            workspace_id: {workspace_id}
+            Total Usage: {total_usage}
+            Soft Usage Limit: {soft_limit}
+            Hard Usage Limit: {hard_limit}
 
-    return response["Item"]["request_status"], email
+            User services, please use this email template : https://docs.google.com/document/d/1BAkRsYlcJLyzGueVMEZ8xGiJgMd_yAzK6t5mmsiOW7E/edit?pli=1#heading=h.f36t295d0h33
+        """
+        attributes = {
+            "workspace_id": {"DataType": "String", "StringValue": workspace_id},
+            "user_id": {"DataType": "String", "StringValue": user_id},
+            "total_usage": {
+                "DataType": "String",
+                "StringValue": str(formatted_total_usage),
+            },
+            "hard_limit": {"DataType": "String", "StringValue": str(hard_limit)},
+        }
+        #  TODO: Publish to admin email instead of per user
+        _publish_to_sns_topic(sns_topic_arn, subject, message, attributes)
+
+    elif old_total_usage < soft_limit <= formatted_total_usage:
+        logger.info(
+            f"Surpassed the soft limit: {old_total_usage=} {formatted_total_usage=} {soft_limit=}"
+        )
+
+        subject = f"[{site_name}] Workspace : Total usage exceeds Soft limit"
+        message = f"""Total usage exceeds the set Soft limit for the following user in {site_name}.
+            Workspace info:
+            User ID : {user_id}
+            Workspace Type: {workspace_type}
+            workspace_id: {workspace_id}
+            Total Usage: {total_usage}
+            Soft Usage Limit: {soft_limit}
+            Hard Usage Limit: {hard_limit}
+
+            User services, please use this email template : https://docs.google.com/document/d/1BAkRsYlcJLyzGueVMEZ8xGiJgMd_yAzK6t5mmsiOW7E/edit?pli=1#heading=h.2c3nxovihdgc
+
+        """
+        #  TODO: Publish to admin email instead of per user
+        _publish_to_sns_topic(sns_topic_arn, subject, message)
+
+    return old_attributes
 
 
 #  TODO: Publish to admin email instead of per user
@@ -979,6 +1582,26 @@ def _get_dynamodb_index_name():
     return _get_param(os.environ["dynamodb_index_param_name"])
 
 
+def _get_dynamodb_changes_index_name():
+    return _get_param(os.environ["dynamodb_changes_index_param_name"])
+
+
+def _get_workspace_repository():
+    """The workspace_repository of the module when set, otherwise the DynamoDB
+    table whose name (and index names, when needed) are read from SSM."""
+    if workspace_repository is not None:
+        return workspace_repository
+    return DynamoDBWorkspaceRepository(
+        _get_dynamodb_table_name(),
+        index_name=_get_dynamodb_index_name,
+        changes_index_name=_get_dynamodb_changes_index_name,
+    )
+
+
+def _now_milliseconds():
+    return int(datetime.now(timezone.utc).timestamp() * 1000)
+
+
 def _get_dynamodb_table_name():
     return _get_param(os.environ["dynamodb_table_param_name"])
 
@@ -999,15 +1622,13 @@ def _get_site_info():
     return site_info.get(email_domain, None)
 
 
-# Helper class to convert a DynamoDB item to JSON.
-class CustomEncoder(json.JSONEncoder):
-    def default(self, obj):
-        if isinstance(obj, set):
-            return list(obj)
-        # Handle Decimal types which DynamoDB uses for numbers
-        if isinstance(obj, decimal.Decimal):
-            return float(obj)
-        return json.JSONEncoder.default(self, obj)
+def _get_email_helper():
+    """Imports EmailHelper on first use (only the POST /workspaces requests send
+    emails)"""
+    global EmailHelper
+    if EmailHelper is None:
+        from email_helper.email_helper import EmailHelper
+    return EmailHelper
 
 
 def get_secret(secret_name):
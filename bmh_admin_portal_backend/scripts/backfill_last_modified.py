@@ -0,0 +1,138 @@
+""" Backfill record_type, last_modified and changes_shard on Workspace items
+
+GET /workspaces/admin_all?changed_since=<timestamp> uses an index on changes_shard
+and last_modified, which are maintained (with record_type) on every write since
+they were introduced. This script sets them on the items written before that, so
+that they are also part of the index. last_modified is set from the most recent of
+the existing timestamps of the item (creation, provisioning, limit and usage
+updates).
+
+Items which already have the three attributes are not modified, so the script can
+be run more than once. changes_shard is also set again when it does not match the
+current number of shards (CHANGES_INDEX_SHARDS). Request details items (scripts/split_workspace_details.py)
+are not part of the index and are skipped.
+"""
+
+import boto3
+import argparse
+import logging
+import os
+import sys
+
+sys.path.insert(1, os.path.join(sys.path[0], ".."))
+sys.path.insert(1, os.path.join(sys.path[0], "..", "lambdas", "common_layer", "python"))
+from bmh_admin_portal_backend.bmh_admin_portal_config import BMHAdminPortalBackendConfig
+from bmh_common.workspace_repository import (
+    DETAILS_ID_PREFIX,
+    WORKSPACE_RECORD_TYPE,
+    changes_shard,
+)
+
+logger = logging.getLogger(__name__)
+logging.basicConfig(level=logging.INFO, format="%(message)s")
+
+# Existing timestamps (epoch seconds) of a workspace item
+TIMESTAMP_ATTRIBUTES = [
+    "creation_date",
+    "provision_time",
+    "limit_update_time",
+    "usage_update_time",
+    "cost_breakdown_update_time",
+]
+
+
+def main(args):
+
+    config = BMHAdminPortalBackendConfig.get_config()
+
+    table_name = _get_param(config["dynamodb_table_param_name"])
+    table = boto3.resource("dynamodb").Table(table_name)
+
+    names = {f"#{i}": name for i, name in enumerate(TIMESTAMP_ATTRIBUTES)}
+    names.update(
+        {
+            "#userid": "user_id",
+            "#workspaceid": "bmh_workspace_id",
+            "#lastmodified": "last_modified",
+            "#recordtype": "record_type",
+            "#changesshard": "changes_shard",
+        }
+    )
+    scan_kwargs = {
+        "ProjectionExpression": ", ".join(names),
+        "ExpressionAttributeNames": names,
+    }
+
+    updated = 0
+    while True:
+        response = table.scan(**scan_kwargs)
+        for item in response.get("Items", []):
+            if (
+                "last_modified" in item
+                and "record_type" in item
+                and item.get("changes_shard") == changes_shard(item["bmh_workspace_id"])
+            ):
+                continue
+            if item["bmh_workspace_id"].startswith(DETAILS_ID_PREFIX):
+                continue
+
+            last_modified = item.get("last_modified") or 1000 * max(
+                [int(item[name]) for name in TIMESTAMP_ATTRIBUTES if name in item]
+                or [0]
+            )
+            logger.info(
+                f"{item['bmh_workspace_id']} ({item['user_id']}): {last_modified=}"
+            )
+            if not args.dry_run:
+                table.update_item(
+                    Key={
+                        "bmh_workspace_id": item["bmh_workspace_id"],
+                        "user_id": item["user_id"],
+                    },
+                    UpdateExpression="set #lastmodified = if_not_exists(#lastmodified, :lastmodified), #recordtype = :recordtype, #changesshard = :changesshard",
+                    ConditionExpression="attribute_exists(bmh_workspace_id)",
+                    ExpressionAttributeValues={
+                        ":lastmodified": last_modified,
+                        ":recordtype": WORKSPACE_RECORD_TYPE,
+                        ":changesshard": changes_shard(item["bmh_workspace_id"]),
+                    },
+                    ExpressionAttributeNames={
+                        "#lastmodified": "last_modified",
+                        "#recordtype": "record_type",
+                        "#changesshard": "changes_shard",
+                    },
+                )
+            updated += 1
+
+        if "LastEvaluatedKey" not in response:
+            break
+        scan_kwargs["ExclusiveStartKey"] = response["LastEvaluatedKey"]
+
+    action = "Would update" if args.dry_run else "Updated"
+    logger.info(f"{action} {updated} items")
+
+
+def _get_param(param_name):
+    ssm = boto3.client("ssm")
+    try:
+        parameter = ssm.get_parameter(Name=param_name)
+    except Exception as e:
+        logger.error(
+            f"Error retrieving {param_name} from SSM Parameter Store. "
+            "Has the backend been deployed in this Account?"
+        )
+        raise e
+
+    return parameter["Parameter"]["Value"]
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(
+        description="Set record_type, last_modified and changes_shard on existing Workspace items"
+    )
+    parser.add_argument(
+        "--dry-run", action="store_true", help="Only log the items to update."
+    )
+
+    args = parser.parse_args()
+    main(args)
@@ -0,0 +1,130 @@
+""" Split existing Workspace items into a workspace item and a request details item
+
+Workspaces are stored as a small workspace item (keys, status, usage and limits)
+and a request details item in the same partition (the fields of the request form,
+the cost breakdown), see bmh_common/workspace_repository.py. This script moves the
+request details of the items written before that to their details item.
+
+Details which were already written to the details item (e.g. a more recent cost
+breakdown) are kept, and items without request details are not modified, so the
+script can be run more than once.
+"""
+
+import boto3
+import argparse
+import logging
+import os
+import sys
+
+sys.path.insert(1, os.path.join(sys.path[0], ".."))
+sys.path.insert(1, os.path.join(sys.path[0], "..", "lambdas", "common_layer", "python"))
+from bmh_admin_portal_backend.bmh_admin_portal_config import BMHAdminPortalBackendConfig
+from bmh_common.workspace_repository import (
+    DETAILS_ID_PREFIX,
+    DETAILS_RECORD_TYPE,
+    split_details,
+)
+
+logger = logging.getLogger(__name__)
+logging.basicConfig(level=logging.INFO, format="%(message)s")
+
+
+def main(args):
+
+    config = BMHAdminPortalBackendConfig.get_config()
+
+    table_name = _get_param(config["dynamodb_table_param_name"])
+    table = boto3.resource("dynamodb").Table(table_name)
+
+    split = 0
+    scan_kwargs = {}
+    while True:
+        response = table.scan(**scan_kwargs)
+        for item in response.get("Items", []):
+            if item["bmh_workspace_id"].startswith(DETAILS_ID_PREFIX):
+                continue
+            rows = split_details(item)
+            if len(rows) == 1:
+                continue
+
+            workspace_key, details = rows[0], rows[1]
+            moved = [
+                name
+                for name in details
+                if name not in ("bmh_workspace_id", "user_id", "record_type")
+            ]
+            logger.info(
+                f"{item['bmh_workspace_id']} ({item['user_id']}): {', '.join(moved)}"
+            )
+            if not args.dry_run:
+                split_workspace(table, workspace_key, details, moved)
+            split += 1
+
+        if "LastEvaluatedKey" not in response:
+            break
+        scan_kwargs["ExclusiveStartKey"] = response["LastEvaluatedKey"]
+
+    action = "Would split" if args.dry_run else "Split"
+    logger.info(f"{action} {split} items")
+
+
+def split_workspace(table, workspace, details, moved):
+    """Writes the moved attributes to the details item (unless they are already
+    set there), then removes them from the workspace item.
+
+    args:
+        table: DynamoDB Table resource.
+        workspace: (dict) Workspace item, or its keys.
+        details: (dict) Details item, from split_details.
+        moved: (list) Names of the attributes to move.
+    """
+    names = {f"#m{i}": name for i, name in enumerate(moved)}
+    table.update_item(
+        Key={
+            "bmh_workspace_id": details["bmh_workspace_id"],
+            "user_id": details["user_id"],
+        },
+        UpdateExpression="set "
+        + ", ".join(f"{n} = if_not_exists({n}, :m{i})" for i, n in enumerate(names))
+        + ", #recordtype = :recordtype",
+        ExpressionAttributeNames={**names, "#recordtype": "record_type"},
+        ExpressionAttributeValues={
+            **{f":m{i}": details[name] for i, name in enumerate(moved)},
+            ":recordtype": DETAILS_RECORD_TYPE,
+        },
+    )
+    table.update_item(
+        Key={
+            "bmh_workspace_id": workspace["bmh_workspace_id"],
+            "user_id": workspace["user_id"],
+        },
+        UpdateExpression="remove " + ", ".join(names),
+        ConditionExpression="attribute_exists(bmh_workspace_id)",
+        ExpressionAttributeNames=names,
+    )
+
+
+def _get_param(param_name):
+    ssm = boto3.client("ssm")
+    try:
+        parameter = ssm.get_parameter(Name=param_name)
+    except Exception as e:
+        logger.error(
+            f"Error retrieving {param_name} from SSM Parameter Store. "
+            "Has the backend been deployed in this Account?"
+        )
+        raise e
+
+    return parameter["Parameter"]["Value"]
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(
+        description="Move the request details of existing Workspace items to their details item"
+    )
+    parser.add_argument(
+        "--dry-run", action="store_true", help="Only log the items to split."
+    )
+
+    args = parser.parse_args()
+    main(args)
@@ -7,12 +7,19 @@ import json
 from collections import defaultdict
 import pytest
 import os
+import sys
 from unittest import mock
 from unittest.mock import MagicMock, patch
 
 import boto3
 from moto import mock_dynamodb
 
+# Modules of the common lambda layer are importable from /opt/python when deployed
+sys.path.insert(
+    0,
+    os.path.join(os.path.dirname(__file__), "..", "lambdas", "common_layer", "python"),
+)
+
 
 @pytest.fixture(autouse=True, scope="session")
 def setup_env_vars():
@@ -22,6 +29,7 @@ def setup_env_vars():
             "dynamodb_table_param_name": "testTable",
             "AWS_DEFAULT_REGION": "us-east-1",
             "dynamodb_index_param_name": "testIndex",
+            "dynamodb_changes_index_param_name": "testChangesIndex",
             "email_domain": "uchicago.edu",
             "occ_email_domain": "occ-data.org",
             "strides_credits_request_email": "occ_test@uchicago.edu",
@@ -35,34 +43,61 @@ def setup_env_vars():
         yield
 
 
+def pytest_addoption(parser):
+    parser.addoption(
+        "--scale-sizes",
+        default="1000",
+        help="Comma separated numbers of workspaces of the scale tests "
+        "(test_scale.py), e.g. 1000,10000,100000",
+    )
+
+
+def create_workspaces_table():
+    """Creates the workspaces table (testTable) and its indexes, like the
+    deployed bmh-workspace-table. Must be called with DynamoDB mocked."""
+    dynamodb = boto3.resource("dynamodb")
+    return dynamodb.create_table(
+        TableName="testTable",
+        GlobalSecondaryIndexes=[
+            {
+                "IndexName": "testIndex",
+                "KeySchema": [{"AttributeName": "bmh_workspace_id", "KeyType": "HASH"}],
+                "Projection": {"ProjectionType": "ALL"},
+                "ProvisionedThroughput": {
+                    "ReadCapacityUnits": 1,
+                    "WriteCapacityUnits": 1,
+                },
+            },
+            {
+                "IndexName": "testChangesIndex",
+                "KeySchema": [
+                    {"AttributeName": "changes_shard", "KeyType": "HASH"},
+                    {"AttributeName": "last_modified", "KeyType": "RANGE"},
+                ],
+                "Projection": {"ProjectionType": "ALL"},
+                "ProvisionedThroughput": {
+                    "ReadCapacityUnits": 1,
+                    "WriteCapacityUnits": 1,
+                },
+            },
+        ],
+        KeySchema=[
+            {"AttributeName": "user_id", "KeyType": "HASH"},
+            {"AttributeName": "bmh_workspace_id", "KeyType": "RANGE"},
+        ],
+        AttributeDefinitions=[
+            {"AttributeName": "user_id", "AttributeType": "S"},
+            {"AttributeName": "bmh_workspace_id", "AttributeType": "S"},
+            {"AttributeName": "changes_shard", "AttributeType": "S"},
+            {"AttributeName": "last_modified", "AttributeType": "N"},
+        ],
+        ProvisionedThroughput={"ReadCapacityUnits": 10, "WriteCapacityUnits": 10},
+    )
+
+
 @pytest.fixture()
 def dynamodb_table():
 
     with mock_dynamodb():
-        dynamodb = boto3.resource("dynamodb")
-        table = dynamodb.create_table(
-            TableName="testTable",
-            GlobalSecondaryIndexes=[
-                {
-                    "IndexName": "testIndex",
-                    "KeySchema": [
-                        {"AttributeName": "bmh_workspace_id", "KeyType": "HASH"}
-                    ],
-                    "Projection": {"ProjectionType": "ALL"},
-                    "ProvisionedThroughput": {
-                        "ReadCapacityUnits": 1,
-                        "WriteCapacityUnits": 1,
-                    },
-                }
-            ],
-            KeySchema=[
-                {"AttributeName": "user_id", "KeyType": "HASH"},
-                {"AttributeName": "bmh_workspace_id", "KeyType": "RANGE"},
-            ],
-            AttributeDefinitions=[
-                {"AttributeName": "user_id", "AttributeType": "S"},
-                {"AttributeName": "bmh_workspace_id", "AttributeType": "S"},
-            ],
-            ProvisionedThroughput={"ReadCapacityUnits": 10, "WriteCapacityUnits": 10},
-        )
+        table = create_workspaces_table()
         yield table
@@ -0,0 +1,103 @@
+from unittest import mock
+from unittest.mock import patch
+import pytest
+import uuid
+import decimal
+import boto3
+from moto import mock_s3
+from bmh_common.workspace_repository import DynamoDBWorkspaceRepository
+from lambdas.workspaces_api_resource import consolidated_usage_handler
+
+test_email_1 = "test1@uchicago.com"
+test_email_2 = "test2@uchicago.com"
+
+
+def _workspace(user_id, total_usage, account_id=None):
+    workspace_id = str(uuid.uuid4())
+    item = {
+        "workspace_request_id": workspace_id,
+        "bmh_workspace_id": workspace_id,
+        "user_id": user_id,
+        "workspace_type": "STRIDES Credits",
+        "request_status": "active",
+        "soft-limit": decimal.Decimal("160"),
+        "hard-limit": decimal.Decimal("200"),
+        "total-usage": decimal.Decimal(total_usage),
+        "sns-topic": "testTopic",
+    }
+    if account_id is not None:
+        item["account_id"] = account_id
+    return item
+
+
+def test_update_workspaces_total_usage(dynamodb_table):
+    changed = _workspace(test_email_1, "100", account_id="111111111111")
+    unchanged = _workspace(test_email_1, "50.5", account_id="222222222222")
+    not_provisioned = _workspace(test_email_2, "0")
+    for item in [changed, unchanged, not_provisioned]:
+        dynamodb_table.put_item(Item=item)
+
+    costs = {
+        "111111111111": decimal.Decimal("180.004"),
+        "222222222222": decimal.Decimal("50.50"),
+        "999999999999": decimal.Decimal("12"),
+    }
+
+    with patch.object(
+        consolidated_usage_handler.api, "_publish_to_sns_topic"
+    ) as mock_sns:
+        summary = consolidated_usage_handler.update_workspaces_total_usage(
+            DynamoDBWorkspaceRepository("testTable"), costs
+        )
+
+        # Soft limit was crossed for the changed workspace only
+        mock_sns.assert_called_once()
+        assert "Soft limit" in mock_sns.call_args[0][1]
+
+    assert summary == {
+        "updated": 1,
+        "unchanged": 1,
+        "failed": [],
+        "unmatched_accounts": ["999999999999"],
+    }
+
+    def total_usage(item):
+        return dynamodb_table.get_item(
+            Key={
+                "bmh_workspace_id": item["bmh_workspace_id"],
+                "user_id": item["user_id"],
+            }
+        )["Item"]["total-usage"]
+
+    assert total_usage(changed) == decimal.Decimal("180.00")
+    assert total_usage(unchanged) == decimal.Decimal("50.5")
+    assert total_usage(not_provisioned) == 0
+
+
+def test_aggregate_cost_by_account():
+    wr = pytest.importorskip("awswrangler")
+    pd = pytest.importorskip("pandas")
+
+    with mock_s3():
+        boto3.client("s3").create_bucket(Bucket="payer-cur")
+        path = "s3://payer-cur/cur/report/report"
+        for month in [1, 2]:
+            df = pd.DataFrame(
+                {
+                    "line_item_usage_account_id": ["111", "222", "111"],
+                    "line_item_unblended_cost": [1.25, 2.0, 0.5 * month],
+                    "line_item_product_code": ["AmazonEC2"] * 3,
+                    "year": ["2024"] * 3,
+                    "month": [str(month)] * 3,
+                }
+            )
+            wr.s3.to_parquet(
+                df, path=path, dataset=True, partition_cols=["year", "month"]
+            )
+
+        costs = consolidated_usage_handler.aggregate_cost_by_account(path)
+
+    assert costs == {
+        "111": decimal.Decimal("4.00"),
+        "222": decimal.Decimal("4.00"),
+    }
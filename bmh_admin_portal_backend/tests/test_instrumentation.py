@@ -0,0 +1,200 @@
+import json
+from unittest import mock
+
+import boto3
+import pytest
+from boto3.dynamodb.conditions import Key
+
+from bmh_common import instrumentation
+from lambdas.workspaces_api_resource import workspaces_api_resource_handler
+
+
+def _emf_documents(output):
+    """Parses the EMF lines printed on stdout (other lines are ignored)"""
+    documents = []
+    for line in output.splitlines():
+        try:
+            document = json.loads(line)
+        except ValueError:
+            continue
+        if isinstance(document, dict) and "_aws" in document:
+            documents.append(document)
+    return documents
+
+
+def _metric_names(document):
+    (directive,) = document["_aws"]["CloudWatchMetrics"]
+    return {metric["Name"]: metric["Unit"] for metric in directive["Metrics"]}
+
+
+@pytest.fixture(autouse=True)
+def reset_cold_start():
+    with mock.patch.object(instrumentation, "_cold_start", True):
+        yield
+
+
+def test_instrumented(dynamodb_table, capsys):
+    @instrumentation.instrumented
+    def handler(event, context):
+        instrumentation.set_route("GET /test")
+        table = boto3.resource("dynamodb").Table("testTable")
+        table.get_item(Key={"user_id": "a", "bmh_workspace_id": "1"})
+        table.get_item(Key={"user_id": "a", "bmh_workspace_id": "2"})
+        boto3.client("dynamodb").describe_table(TableName="testTable")
+        return {"statusCode": 200}
+
+    context = mock.MagicMock(aws_request_id="request-1")
+    handler({}, context)
+    handler({}, context)
+
+    documents = _emf_documents(capsys.readouterr().out)
+    # One invocation document and one per operation, per invocation
+    assert len(documents) == 6
+
+    invocation = documents[0]
+    assert invocation["_aws"]["CloudWatchMetrics"][0]["Namespace"] == "BRHAdminPortal"
+    assert invocation["_aws"]["CloudWatchMetrics"][0]["Dimensions"] == [
+        ["Function", "Route"]
+    ]
+    assert _metric_names(invocation) == {
+        "Duration": "Milliseconds",
+        "ColdStart": "Count",
+        "AwsCalls": "Count",
+        "AwsCallTime": "Milliseconds",
+        "ReadCapacityUnits": "None",
+        "WriteCapacityUnits": "None",
+    }
+    assert invocation["Route"] == "GET /test"
+    assert invocation["StatusCode"] == 200
+    assert invocation["RequestId"] == "request-1"
+    assert invocation["ColdStart"] == 1
+    assert invocation["AwsCalls"] == 3
+    assert invocation["Duration"] >= invocation["AwsCallTime"] > 0
+
+    describe, get_item = documents[1:3]
+    assert _metric_names(get_item) == {
+        "AwsCallLatency": "Milliseconds",
+        "AwsCallCount": "Count",
+        "AwsCallErrors": "Count",
+        "ReadCapacityUnits": "None",
+        "WriteCapacityUnits": "None",
+    }
+    assert get_item["_aws"]["CloudWatchMetrics"][0]["Dimensions"] == [
+        ["Function", "Route", "Service"],
+        ["Function", "Service", "Operation"],
+    ]
+    assert (get_item["Service"], get_item["Operation"]) == ("dynamodb", "GetItem")
+    assert get_item["Route"] == "GET /test"
+    assert get_item["AwsCallCount"] == 2
+    assert len(get_item["AwsCallLatency"]) == 2
+    assert get_item["AwsCallErrors"] == 0
+    assert describe["Operation"] == "DescribeTable"
+
+    # Only the first invocation is a cold start
+    assert documents[3]["ColdStart"] == 0
+
+
+def test_instrumented_errors(dynamodb_table, capsys):
+    @instrumentation.instrumented
+    def handler(event, context):
+        boto3.client("dynamodb").describe_table(TableName="doesNotExist")
+
+    with pytest.raises(Exception):
+        handler({}, None)
+
+    invocation, describe = _emf_documents(capsys.readouterr().out)
+    assert invocation["Route"] == instrumentation.UNKNOWN_ROUTE
+    assert invocation["StatusCode"] == "exception"
+    assert describe["AwsCallErrors"] == 1
+
+
+def test_instrumented_disabled(capsys):
+    @instrumentation.instrumented
+    def handler(event, context):
+        return "result"
+
+    with mock.patch.dict("os.environ", {"metrics_namespace": ""}):
+        assert handler({}, None) == "result"
+    assert _emf_documents(capsys.readouterr().out) == []
+
+
+def test_api_handler_route(capsys):
+    event = {
+        "resource": "/workspaces/{workspace_id}",
+        "path": "/workspaces/1",
+        "httpMethod": "GET",
+        "headers": None,
+        "body": None,
+        "pathParameters": {"workspace_id": "1"},
+        "queryStringParameters": None,
+        "requestContext": {"authorizer": {"user": "a"}, "identity": {"apiKey": None}},
+    }
+    with mock.patch.object(
+        workspaces_api_resource_handler,
+        "_workspaces_get",
+        return_value=workspaces_api_resource_handler.create_response(),
+    ):
+        workspaces_api_resource_handler.handler(event, None)
+
+    (invocation,) = _emf_documents(capsys.readouterr().out)
+    assert invocation["Route"] == "GET /workspaces/{workspace_id}"
+    assert invocation["StatusCode"] == 200
+
+
+def test_consumed_capacity(dynamodb_table, capsys):
+    dynamodb_table.put_item(Item={"user_id": "a", "bmh_workspace_id": "1"})
+
+    @instrumentation.instrumented
+    def handler(event, context):
+        instrumentation.set_route("PUT /test")
+        instrumentation.set_properties(WorkspaceId="1")
+        table = boto3.resource("dynamodb").Table("testTable")
+        # Explicitly disabled capacity is requested as well
+        table.get_item(
+            Key={"user_id": "a", "bmh_workspace_id": "1"},
+            ReturnConsumedCapacity="NONE",
+        )
+        table.query(
+            IndexName="testIndex",
+            KeyConditionExpression=Key("bmh_workspace_id").eq("1"),
+        )
+        response = table.update_item(
+            Key={"user_id": "a", "bmh_workspace_id": "1"},
+            UpdateExpression="set #limit = :limit",
+            ExpressionAttributeNames={"#limit": "soft-limit"},
+            ExpressionAttributeValues={":limit": 10},
+        )
+        assert "ConsumedCapacity" in response
+        boto3.client("dynamodb").batch_get_item(
+            RequestItems={
+                "testTable": {
+                    "Keys": [{"user_id": {"S": "a"}, "bmh_workspace_id": {"S": "1"}}]
+                }
+            }
+        )
+
+    handler({}, None)
+    documents = _emf_documents(capsys.readouterr().out)
+    invocation = documents[0]
+    by_operation = {d["Operation"]: d for d in documents[1:]}
+
+    assert invocation["WorkspaceId"] == "1"
+    assert _metric_names(invocation)["ReadCapacityUnits"] == "None"
+    assert invocation["ReadCapacityUnits"] == sum(
+        by_operation[op]["ReadCapacityUnits"]
+        for op in ["GetItem", "Query", "BatchGetItem"]
+    )
+    assert invocation["WriteCapacityUnits"] == (
+        by_operation["UpdateItem"]["WriteCapacityUnits"]
+    )
+    assert by_operation["GetItem"]["ReadCapacityUnits"] > 0
+    assert by_operation["GetItem"]["WriteCapacityUnits"] == 0
+    assert by_operation["UpdateItem"]["WriteCapacityUnits"] > 0
+    assert by_operation["BatchGetItem"]["ReadCapacityUnits"] > 0
+    assert set(by_operation["GetItem"]["CapacityUnitsByIndex"]) == {"testTable"}
+
+
+def test_consumed_capacity_not_requested_outside_invocations(dynamodb_table):
+    instrumentation.register_hooks()
+    response = dynamodb_table.get_item(Key={"user_id": "a", "bmh_workspace_id": "1"})
+    assert "ConsumedCapacity" not in response
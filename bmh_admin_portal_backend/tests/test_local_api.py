@@ -0,0 +1,53 @@
+import json
+
+import pytest
+
+from benchmarks.local_api import LocalApi, LocalAws, seed_workspaces
+
+
+@pytest.fixture(scope="module", params=[False, True], ids=["moto", "in_memory"])
+def local_api(request):
+    with LocalAws(in_memory=request.param) as aws:
+        workspaces = seed_workspaces(10, num_users=2, topic_arn=aws.topic_arn)
+        yield LocalApi(), workspaces
+
+
+def test_match(local_api):
+    api, _ = local_api
+    # Literal resources are preferred to path parameters
+    assert api.match("PUT", "/workspaces/total-usage") == (
+        "/workspaces/total-usage",
+        {},
+    )
+    assert api.match("PUT", "/workspaces/1/total-usage") == (
+        "/workspaces/{workspace_id}/total-usage",
+        {"workspace_id": "1"},
+    )
+    assert api.match("DELETE", "/workspaces/1") is None
+
+
+def test_invoke(local_api):
+    api, workspaces = local_api
+    user = workspaces[0]["user_id"]
+    authorization = {"Authorization": f"Bearer {api.issue_token(user=user)}"}
+
+    status_code, _, body, resource = api.invoke("GET", "/workspaces", authorization)
+    assert (status_code, resource) == (200, "/workspaces")
+    assert {w["bmh_workspace_id"] for w in json.loads(body)} == {
+        w["bmh_workspace_id"] for w in workspaces if w["user_id"] == user
+    }
+
+    workspace_id = workspaces[0]["bmh_workspace_id"]
+    status_code, _, _, _ = api.invoke(
+        "PUT",
+        f"/workspaces/{workspace_id}/limits",
+        authorization,
+        b'{"soft-limit": 10, "hard-limit": 20}',
+    )
+    assert status_code == 200
+
+    # Authentication of the deployed API
+    assert api.invoke("GET", "/workspaces")[0] == 401
+    assert api.invoke("GET", "/workspaces", {"Authorization": "Bearer x"})[0] == 401
+    assert api.invoke("PUT", f"/workspaces/{workspace_id}/total-usage")[0] == 403
+    assert api.invoke("GET", "/unknown", authorization)[0] == 403
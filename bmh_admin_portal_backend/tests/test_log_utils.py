@@ -0,0 +1,182 @@
+import json
+import logging
+from unittest import mock
+
+import pytest
+
+from bmh_common import log_utils
+
+
+API_EVENT = {
+    "resource": "/workspaces/{workspace_id}",
+    "path": "/workspaces/1",
+    "httpMethod": "PUT",
+    "headers": {"Authorization": "Bearer abc.def.ghi", "X-API-KEY": "key"},
+    "queryStringParameters": None,
+    "requestContext": {"requestId": "request-1", "identity": {"apiKey": "key"}},
+    "body": json.dumps({"refresh_token": "refresh", "soft-limit": 10}),
+}
+
+
+def test_redact():
+    redacted = log_utils.redact(API_EVENT)
+
+    assert redacted["headers"] == {"Authorization": "***", "X-API-KEY": "***"}
+    assert redacted["requestContext"]["identity"]["apiKey"] == "***"
+    # JSON bodies are redacted too
+    assert json.loads(redacted["body"]) == {"refresh_token": "***", "soft-limit": 10}
+    assert redacted["path"] == "/workspaces/1"
+    # The event is not modified
+    assert API_EVENT["headers"]["Authorization"] == "Bearer abc.def.ghi"
+
+    assert log_utils.redact("token: Bearer abc.def") == "token: Bearer ***"
+    assert log_utils.redact({"custom": "x"}, fields={"custom"}) == {"custom": "***"}
+
+
+def test_redact_text():
+    text = json.dumps(API_EVENT)
+    redacted = log_utils.redact_text(text)
+
+    assert "abc.def.ghi" not in redacted
+    assert '"X-API-KEY": "***"' in redacted
+    # Escaped JSON of the body
+    assert '\\"refresh_token\\": \\"***\\"' in redacted
+    assert "refresh\\" not in redacted.replace("refresh_token", "")
+    assert log_utils.redact_text("{'access_token': 'abc'}") == "{'access_token': '***'}"
+
+
+def test_redact_query_string():
+    url = "https://auth/oauth2/token?grant_type=refresh_token&refresh_token=SECRETVAL"
+    assert log_utils.redact_text(url) == (
+        "https://auth/oauth2/token?grant_type=refresh_token&refresh_token=***"
+    )
+    # The authorization code, and the parameters which are not the last one
+    assert log_utils.redact_text(
+        "Requesting tokens: https://auth/token?code=abc&redirect_uri=https://portal"
+    ) == ("Requesting tokens: https://auth/token?code=***&redirect_uri=https://portal")
+    assert log_utils.redact("/path?API-KEY=key;x=1") == "/path?API-KEY=***;x=1"
+    # Not a parameter of a query string
+    assert log_utils.redact_text("grant_type=refresh_token") == (
+        "grant_type=refresh_token"
+    )
+
+
+def test_summarize_event():
+    assert log_utils.summarize_event(API_EVENT) == {
+        "httpMethod": "PUT",
+        "resource": "/workspaces/{workspace_id}",
+        "path": "/workspaces/1",
+        "requestId": "request-1",
+        "body_length": len(API_EVENT["body"]),
+    }
+    assert log_utils.summarize_event(
+        {"Records": [{"EventSource": "aws:sns"}, {"EventSource": "aws:sns"}]}
+    ) == {"records": 2, "event_source": "aws:sns"}
+    assert log_utils.summarize_event({"action": "email", "workspace_id": "1"}) == {
+        "action": "email",
+        "workspace_id": "1",
+    }
+
+
+def test_log_event(caplog):
+    logger = logging.getLogger("test_log_event")
+    with caplog.at_level("INFO"):
+        log_utils.log_event(logger, API_EVENT)
+        with mock.patch.dict("os.environ", {"log_full_payloads": "true"}):
+            log_utils.log_event(logger, API_EVENT)
+
+    summary, full = [r.getMessage() for r in caplog.records]
+    assert "headers" not in summary
+    assert json.loads(summary[len("Event: ") :])["requestId"] == "request-1"
+    assert json.loads(full[len("Event: ") :])["headers"]["Authorization"] == "***"
+
+
+def test_log_event_base64_body(caplog):
+    import base64
+
+    event = {
+        "httpMethod": "PUT",
+        "resource": "/auth/refresh-tokens",
+        "body": base64.b64encode(b'{"refresh_token": "secret"}').decode(),
+        "isBase64Encoded": True,
+    }
+    logger = logging.getLogger("test_log_event_base64_body")
+    with caplog.at_level("INFO"), mock.patch.dict(
+        "os.environ", {"log_full_payloads": "true"}
+    ):
+        log_utils.log_event(logger, event)
+
+    (full,) = [r.getMessage() for r in caplog.records]
+    logged = json.loads(full[len("Event: ") :])
+    assert json.loads(logged["body"]) == {"refresh_token": "***"}
+    assert not logged["isBase64Encoded"]
+
+
+def test_log_filter():
+    log_filter = log_utils.LogFilter(
+        sample_rates={logging.DEBUG: 0, logging.INFO: 1}, max_chars=20
+    )
+
+    def record(level, msg, *args):
+        return logging.LogRecord("test", level, __file__, 1, msg, args, None)
+
+    assert not log_filter.filter(record(logging.DEBUG, "dropped"))
+
+    kept = record(logging.INFO, "%s", '{"token": "secret"}')
+    assert log_filter.filter(kept)
+    assert kept.getMessage() == '{"token": "***"}'
+
+    long = record(logging.WARNING, "x" * 30)
+    assert log_filter.filter(long)
+    assert long.getMessage() == "x" * 20 + "... [10 more characters]"
+
+    with mock.patch.object(log_utils.random, "random", return_value=0.5):
+        sampled = log_utils.LogFilter(sample_rates={logging.INFO: 0.1})
+        assert not sampled.filter(record(logging.INFO, "dropped"))
+        sampled = log_utils.LogFilter(sample_rates={logging.INFO: 0.9})
+        assert sampled.filter(record(logging.INFO, "kept"))
+
+
+def test_log_filter_from_environment():
+    with mock.patch.dict(
+        "os.environ",
+        {
+            "log_sample_rates": "debug=0, INFO=0.25",
+            "log_max_chars": "100",
+            "log_redact_fields": "nih_funded_award_number",
+        },
+    ):
+        log_filter = log_utils.LogFilter.from_environment()
+
+    assert log_filter.sample_rates == {logging.DEBUG: 0, logging.INFO: 0.25}
+    assert log_filter.max_chars == 100
+    assert "nih_funded_award_number" in log_filter.fields
+    assert "refresh_token" in log_filter.fields
+
+    with pytest.raises(ValueError):
+        log_utils.parse_sample_rates("VERBOSE=1")
+    with pytest.raises(ValueError):
+        log_utils.parse_sample_rates("INFO=2")
+
+
+def test_get_logger():
+    logger = log_utils.get_logger("test_get_logger")
+    log_utils.get_logger("test_get_logger")
+    assert len(logger.filters) == 1
+    assert log_utils.max_chars(logger) == logger.filters[0].max_chars
+    assert log_utils.max_chars(logging.getLogger("other")) == (
+        log_utils.DEFAULT_MAX_CHARS
+    )
+
+
+def test_get_logger_redacts_token_urls(caplog):
+    logger = log_utils.get_logger("test_get_logger_redacts_token_urls")
+    with caplog.at_level("INFO"):
+        logger.info(
+            "https://auth/oauth2/token?grant_type=refresh_token&refresh_token=%s",
+            "SECRETVAL",
+        )
+
+    (message,) = [r.getMessage() for r in caplog.records]
+    assert "SECRETVAL" not in message
+    assert message.endswith("&refresh_token=***")
@@ -0,0 +1,74 @@
+from unittest import mock
+
+import boto3
+from moto import mock_s3
+
+from bmh_common import profiling
+
+
+def _event(headers=None, user="admin@example.com"):
+    return {
+        "httpMethod": "GET",
+        "resource": "/workspaces",
+        "headers": headers,
+        "requestContext": {"authorizer": {"user": user}},
+    }
+
+
+def _work(event, context):
+    return sum(i * i for i in range(1000))
+
+
+def test_profiled_disabled():
+    with mock.patch.dict(
+        "os.environ", {"profile_sample_rate": "", "profile_users": ""}
+    ):
+        # The handler is returned as is
+        assert profiling.profiled(_work) is _work
+
+
+def test_profiled_sample_rate(caplog):
+    with mock.patch.dict("os.environ", {"profile_sample_rate": "1"}):
+        handler = profiling.profiled(_work)
+
+    with caplog.at_level("INFO"):
+        assert handler(_event(), None) == _work(None, None)
+
+    (summary,) = [r.getMessage() for r in caplog.records]
+    assert summary.startswith("Profile of GET /workspaces (top 30 functions")
+    assert "_work" in summary
+    assert "test_profiling.py" in summary
+
+
+def test_profiled_header(caplog):
+    with mock.patch.dict(
+        "os.environ", {"profile_users": "admin@example.com, other@example.com"}
+    ):
+        handler = profiling.profiled(_work)
+
+    with caplog.at_level("INFO"):
+        handler(_event(), None)
+        handler(_event({"X-Profile": "true"}, user="user@example.com"), None)
+        assert not caplog.records
+
+        handler(_event({"X-Profile": "true"}), None)
+        assert len(caplog.records) == 1
+
+
+@mock_s3
+def test_profiled_s3():
+    s3 = boto3.client("s3")
+    s3.create_bucket(Bucket="profiles-bucket")
+    with mock.patch.dict(
+        "os.environ",
+        {"profile_sample_rate": "1", "profile_s3_bucket": "profiles-bucket"},
+    ):
+        handler = profiling.profiled(_work)
+
+    handler(_event(), mock.MagicMock(aws_request_id="request-1"))
+
+    (key,) = [
+        o["Key"] for o in s3.list_objects_v2(Bucket="profiles-bucket")["Contents"]
+    ]
+    assert key.startswith("profiles/local/")
+    assert key.endswith("/request-1.prof")
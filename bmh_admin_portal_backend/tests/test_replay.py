@@ -0,0 +1,101 @@
+import base64
+import json
+import logging
+from unittest import mock
+
+from bmh_common import log_utils
+from benchmarks import replay
+from benchmarks.local_api import LocalApiServer, LocalAws, put_workspaces
+
+
+def _event(method, resource, path, user=None, api_key=None, body=None, **params):
+    return {
+        "resource": resource,
+        "path": path,
+        "httpMethod": method,
+        "headers": {"Authorization": "Bearer secret-token", "Cookie": "a=b"},
+        "pathParameters": params or None,
+        "queryStringParameters": None,
+        "body": base64.b64encode(json.dumps(body).encode()).decode() if body else None,
+        "isBase64Encoded": bool(body),
+        "requestContext": {
+            "authorizer": {"user": user} if user else None,
+            "identity": {"apiKey": api_key, "sourceIp": "10.0.0.1"},
+            "requestId": "request",
+        },
+    }
+
+
+EVENTS = [
+    _event("GET", "/workspaces", "/workspaces", user="a@example.org"),
+    _event(
+        "GET",
+        "/workspaces/{workspace_id}",
+        "/workspaces/w1",
+        user="a@example.org",
+        workspace_id="w1",
+    ),
+    _event(
+        "PUT",
+        "/workspaces/{workspace_id}/total-usage",
+        "/workspaces/w2/total-usage",
+        api_key="secret-key",
+        body={"total-usage": 10},
+        workspace_id="w2",
+    ),
+    _event(
+        "PUT",
+        "/auth/refresh-tokens",
+        "/auth/refresh-tokens",
+        api_key="secret-key",
+        body={"refresh_token": "secret-refresh-token"},
+    ),
+]
+
+
+def _logged_records(caplog):
+    logger = logging.getLogger("test_replay")
+    with caplog.at_level("INFO"), mock.patch.dict(
+        "os.environ", {"log_full_payloads": "true"}
+    ):
+        for event in EVENTS:
+            log_utils.log_event(logger, event)
+        # Summaries and truncated events can not be replayed
+        log_utils.log_event(logger, EVENTS[0])
+    messages = [r.getMessage() for r in caplog.records]
+    messages[-1] = log_utils.summarize_event(EVENTS[0])
+    messages[-1] = f"Event: {json.dumps(messages[-1])}"
+    messages.append(messages[0][:100])
+    return [(1000 * i, message) for i, message in enumerate(messages)]
+
+
+def test_extract_events(caplog):
+    events, counts = replay.extract_events(_logged_records(caplog))
+
+    assert counts == {"extracted": 4, "summaries": 1, "truncated": 1}
+    serialized = json.dumps(events)
+    for secret in ("secret-token", "secret-key", "secret-refresh-token", "10.0.0.1"):
+        assert secret not in serialized
+    assert [e["timestamp"] for e in events] == [0, 1000, 2000, 3000]
+    assert json.loads(events[3]["event"]["body"]) == {"refresh_token": "***"}
+
+
+def test_replay(caplog):
+    events, _ = replay.extract_events(_logged_records(caplog))
+    items = replay.replay_workspaces(events, workspaces_per_user=2)
+    assert {(i["user_id"], i["bmh_workspace_id"]) for i in items} >= {
+        ("a@example.org", "w1"),
+    }
+    assert "w2" in {i["bmh_workspace_id"] for i in items}
+
+    with LocalAws() as aws, LocalApiServer() as server:
+        put_workspaces(items, aws.topic_arn)
+        results, _ = replay.replay(server.api.api_handler, events, speed=0)
+
+    assert [r["status"] for r in results] == [200, 200, 200, 200]
+    assert [r["route"] for r in results][-1] == "PUT /auth/refresh-tokens"
+
+    changes = replay.status_changes(
+        results, [dict(r, status=500) if i == 1 else r for i, r in enumerate(results)]
+    )
+    assert changes == [(1, "GET /workspaces/{workspace_id}", 200, 500)]
@@ -0,0 +1,107 @@
+import decimal
+
+import pytest
+
+from lambdas.workspaces_api_resource.request_validation import (
+    RequestValidationError,
+    compile_schema,
+)
+
+LIMITS = compile_schema(
+    {
+        "type": "object",
+        "required": ["soft-limit", "hard-limit"],
+        "properties": {
+            "soft-limit": {"format": "decimal", "minimum": 0},
+            "hard-limit": {"format": "decimal", "minimum": 0},
+            "user": {"type": "string"},
+        },
+    }
+)
+
+
+def test_decimal_coercion():
+    body = LIMITS({"soft-limit": "50.5", "hard-limit": 100, "other": True})
+    assert body == {
+        "soft-limit": decimal.Decimal("50.5"),
+        "hard-limit": decimal.Decimal("100"),
+        "other": True,
+    }
+    assert isinstance(body["hard-limit"], decimal.Decimal)
+
+
+@pytest.mark.parametrize(
+    "body, message",
+    [
+        (None, "body must be of type object"),
+        ({"soft-limit": 1}, "body.hard-limit is required"),
+        ({"soft-limit": "abc", "hard-limit": 1}, "body.soft-limit must be a number"),
+        ({"soft-limit": True, "hard-limit": 1}, "body.soft-limit must be a number"),
+        ({"soft-limit": "NaN", "hard-limit": 1}, "body.soft-limit must be a finite"),
+        ({"soft-limit": 1, "hard-limit": -1}, "body.hard-limit must be at least 0"),
+        ({"soft-limit": 1, "hard-limit": 2, "user": 3}, "body.user must be of type"),
+    ],
+)
+def test_errors(body, message):
+    with pytest.raises(RequestValidationError) as e:
+        LIMITS(body)
+    assert str(e.value).startswith(message)
+
+
+def test_arrays_and_nested_objects():
+    validate = compile_schema(
+        {
+            "type": "object",
+            "properties": {
+                "workspaces": {
+                    "type": "array",
+                    "maxItems": 2,
+                    "items": {
+                        "type": "object",
+                        "required": ["workspace_id"],
+                        "additionalProperties": False,
+                        "properties": {"workspace_id": {"enum": ["1", "2"]}},
+                    },
+                },
+                "costs": {"additionalProperties": {"format": "decimal"}},
+                "since": {"type": "string", "pattern": "^[0-9]+$"},
+            },
+        },
+        name="query",
+    )
+    assert validate({"costs": {"a": 1.5}}) == {"costs": {"a": decimal.Decimal("1.5")}}
+
+    for value, message in [
+        ({"workspaces": [{}] * 3}, "query.workspaces must have at most 2 items"),
+        ({"workspaces": [{"workspace_id": "1"}, {}]}, "query.workspaces[1].workspace"),
+        ({"workspaces": [{"workspace_id": "3"}]}, "query.workspaces[0].workspace_id"),
+        ({"workspaces": [{"workspace_id": "1", "a": 1}]}, "query.workspaces[0].a is"),
+        ({"costs": {"a": "b"}}, "query.costs.a must be a number"),
+        ({"since": "12a"}, "query.since must match"),
+    ]:
+        with pytest.raises(RequestValidationError) as e:
+            validate(value)
+        assert str(e.value).startswith(message)
+
+
+def test_property_names():
+    validate = compile_schema(
+        {
+            "type": "object",
+            "propertyNames": {"pattern": "^[0-9]{4}-[0-9]{2}$"},
+            "additionalProperties": {"format": "decimal"},
+        }
+    )
+    assert validate({"2024-01": "1"}) == {"2024-01": decimal.Decimal("1")}
+    assert validate({}) == {}
+
+    with pytest.raises(RequestValidationError) as e:
+        validate({"2024-01": 1, "2024-1": 2})
+    assert str(e.value).startswith("body property name 2024-1 must match")
+
+
+def test_unsupported_schema():
+    with pytest.raises(ValueError):
+        compile_schema({"type": "object", "oneOf": []})
+    with pytest.raises(ValueError):
+        compile_schema({"format": "date-time"})
@@ -0,0 +1,187 @@
+"""
+Behaviour and timing of the code paths which depend on the size of the workspaces
+table, with a table of synthetic workspaces (benchmarks/synthetic_workspaces.py).
+
+The sizes are set with --scale-sizes (1000 by default):
+    poetry run pytest tests/test_scale.py -s --scale-sizes 1000,10000,100000
+
+The timings are printed (with -s) and recorded as properties of the tests
+(--junitxml). They are not asserted, since they depend on the machine. They are
+those of moto, whose scans get slower with every page (the table is read again
+up to the start key), so compare them between runs rather than with DynamoDB.
+"""
+
+import json
+import random
+import statistics
+import time
+
+import boto3
+import pytest
+from moto import mock_dynamodb, mock_sns, mock_ssm
+
+from benchmarks.synthetic_workspaces import generate_workspaces
+from bmh_common.workspace_repository import DynamoDBWorkspaceRepository, split_details
+from lambdas.step_functions_handler.src.db.client import DBClient
+from lambdas.workspaces_api_resource import workspaces_api_resource_handler
+
+from .conftest import create_workspaces_table
+
+WORKSPACES_PER_USER = 3
+ROUNDS = 3
+
+
+def pytest_generate_tests(metafunc):
+    if "scale_table" in metafunc.fixturenames:
+        sizes = [
+            int(size) for size in metafunc.config.getoption("scale_sizes").split(",")
+        ]
+        metafunc.parametrize("scale_table", sizes, indirect=True, scope="module")
+
+
+@pytest.fixture(scope="module")
+def scale_table(request):
+    """Table of request.param synthetic workspaces (with 12 months of cost
+    breakdown), split into workspace and request details items, returns
+    (table, items)"""
+    with mock_dynamodb(), mock_ssm(), mock_sns():
+        ssm = boto3.client("ssm")
+        for name in ["testTable", "testIndex", "testChangesIndex"]:
+            ssm.put_parameter(Name=name, Value=name, Type="String")
+        topic_arn = boto3.client("sns").create_topic(Name="workspaces")["TopicArn"]
+
+        table = create_workspaces_table()
+        items = generate_workspaces(
+            request.param,
+            num_users=max(1, request.param // WORKSPACES_PER_USER),
+            cost_breakdown_months=12,
+        )
+        start = time.perf_counter()
+        with table.batch_writer() as batch:
+            for item in items:
+                item["sns-topic"] = topic_arn
+                for row in split_details(item):
+                    batch.put_item(Item=row)
+        print(
+            f"\n{request.param} workspaces written in {time.perf_counter() - start:.1f} s"
+        )
+        yield table, items
+
+
+def _timed(record_property, name, function, rounds=ROUNDS):
+    """Calls function rounds times, records and prints the best and median
+    times (ms), and returns the result of the last call"""
+    times = []
+    for _ in range(rounds):
+        start = time.perf_counter()
+        result = function()
+        times.append((time.perf_counter() - start) * 1000)
+    record_property(f"{name}_min_ms", round(min(times), 2))
+    record_property(f"{name}_median_ms", round(statistics.median(times), 2))
+    print(
+        f"\n{name}: min {min(times):.1f} ms, median {statistics.median(times):.1f} ms"
+    )
+    return result
+
+
+def test_workspaces_get_user(scale_table, record_property):
+    table, items = scale_table
+    user = items[0]["user_id"]
+
+    response = _timed(
+        record_property,
+        f"workspaces_get_user_{len(items)}",
+        lambda: workspaces_api_resource_handler._workspaces_get(None, user),
+    )
+
+    assert response["statusCode"] == 200
+    expected = {i["bmh_workspace_id"] for i in items if i["user_id"] == user}
+    assert {w["bmh_workspace_id"] for w in json.loads(response["body"])} == expected
+
+
+def test_workspaces_get_admin_all(scale_table, record_property):
+    table, items = scale_table
+
+    response = _timed(
+        record_property,
+        f"workspaces_get_admin_all_{len(items)}",
+        lambda: workspaces_api_resource_handler._workspaces_get(
+            {"workspace_id": "admin_all"}, items[0]["user_id"]
+        ),
+        rounds=1,
+    )
+
+    # More than one page (1 MB) of results
+    body = json.loads(response["body"])
+    assert len(body) == len(items)
+
+
+def test_first_available_subnet_id(scale_table, record_property):
+    table, items = scale_table
+    client = DBClient()
+
+    subnet_id = _timed(
+        record_property,
+        f"first_available_subnet_id_{len(items)}",
+        client._get_first_available_subnet_id,
+        rounds=1,
+    )
+
+    # The synthetic workspaces use the subnets 1 to len(items)
+    assert subnet_id == len(items) + 1
+
+
+def test_update_total_usage(scale_table, record_property):
+    table, items = scale_table
+    rng = random.Random(0)
+    workspaces = rng.sample(items, min(50, len(items)))
+    repository = DynamoDBWorkspaceRepository("testTable")
+
+    def update():
+        for workspace in workspaces:
+            workspaces_api_resource_handler._update_total_usage(
+                repository,
+                workspace["bmh_workspace_id"],
+                workspace["user_id"],
+                str(round(rng.uniform(0, 1000), 2)),
+            )
+
+    _timed(record_property, f"update_total_usage_50_of_{len(items)}", update)
+
+    workspace = workspaces[0]
+    stored = table.get_item(
+        Key={
+            "user_id": workspace["user_id"],
+            "bmh_workspace_id": workspace["bmh_workspace_id"],
+        }
+    )["Item"]
+    assert stored["usage_update_time"] > workspace["usage_update_time"]
+
+
+def test_update_total_usage_bulk(scale_table, record_property):
+    table, items = scale_table
+    rng = random.Random(1)
+    # Above USER_LOOKUP_SCAN_THRESHOLD, the users are found with a scan of
+    # the index
+    workspaces = rng.sample(items, min(200, len(items)))
+    body = {
+        "workspaces": [
+            {
+                "workspace_id": w["bmh_workspace_id"],
+                "total-usage": str(round(rng.uniform(0, 1000), 2)),
+            }
+            for w in workspaces
+        ]
+    }
+
+    response = _timed(
+        record_property,
+        f"update_total_usage_bulk_200_of_{len(items)}",
+        lambda: workspaces_api_resource_handler._workspaces_set_total_usage_bulk(
+            body, None
+        ),
+        rounds=1,
+    )
+
+    results = json.loads(response["body"])["results"]
+    assert {r["status"] for r in results} == {200}
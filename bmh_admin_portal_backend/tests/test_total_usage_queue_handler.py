@@ -0,0 +1,237 @@
+from unittest import mock
+from unittest.mock import patch
+import pytest
+import uuid
+import decimal
+import json
+import os
+import boto3
+from moto import mock_sqs
+from moto.sqs import models as moto_sqs_models
+from lambdas.workspaces_api_resource import workspaces_api_resource_handler
+from lambdas.workspaces_api_resource import total_usage_queue_handler
+
+api_key = "testKey"  # pragma: allowlist secret
+test_email_1 = "test1@uchicago.com"
+
+
+def _record(message_id, workspace_id, total_usage, reported_at):
+    return {
+        "messageId": message_id,
+        "body": json.dumps(
+            {
+                "workspace_id": workspace_id,
+                "total-usage": total_usage,
+                "reported_at": reported_at,
+            }
+        ),
+    }
+
+
+def test_dedupe_updates():
+    records = [
+        _record("1", "ws-1", "10", 1000),
+        _record("2", "ws-1", "30", 3000),
+        _record("3", "ws-1", "20", 2000),
+        _record("4", "ws-2", "5", 1000),
+        {"messageId": "5", "body": "not json"},
+        _record("6", "ws-3", "not a number", 1000),
+    ]
+
+    latest, failures = total_usage_queue_handler.dedupe_updates(records)
+
+    assert latest["ws-1"]["total-usage"] == "30"
+    assert latest["ws-1"]["message_id"] == "2"
+    assert latest["ws-2"]["total-usage"] == "5"
+    assert set(latest) == {"ws-1", "ws-2"}
+    assert failures == ["5", "6"]
+
+
+@pytest.fixture
+def table_names():
+    # The queue handler imports the API handler as a top level module
+    patches = [
+        mock.patch.object(module, name, return_value=value)
+        for module in [workspaces_api_resource_handler, total_usage_queue_handler.api]
+        for name, value in [
+            ("_get_dynamodb_table_name", "testTable"),
+            ("_get_dynamodb_index_name", "testIndex"),
+        ]
+    ]
+    for patcher in patches:
+        patcher.start()
+    yield
+    for patcher in patches:
+        patcher.stop()
+
+
+def test_total_usage_is_enqueued_and_applied(dynamodb_table, table_names):
+    workspace_id = str(uuid.uuid4())
+    dynamodb_table.put_item(
+        Item={
+            "workspace_request_id": workspace_id,
+            "bmh_workspace_id": workspace_id,
+            "user_id": test_email_1,
+            "workspace_type": "STRIDES Credits",
+            "request_status": "active",
+            "soft-limit": decimal.Decimal("160"),
+            "hard-limit": decimal.Decimal("200"),
+            "total-usage": decimal.Decimal("100"),
+            "sns-topic": "testSNSTopic",
+        }
+    )
+
+    with mock_sqs():
+        sqs = boto3.client("sqs")
+        queue_url = sqs.create_queue(QueueName="total-usage")["QueueUrl"]
+
+        with mock.patch.dict(os.environ, {"total_usage_queue_url": queue_url}):
+            for total_usage in ["150", "170"]:
+                resp = workspaces_api_resource_handler._workspaces_set_total_usage(
+                    {"total-usage": total_usage},
+                    {"workspace_id": workspace_id},
+                    api_key,
+                )
+                assert resp["statusCode"] == 202
+
+            # Unknown workspaces are not enqueued
+            resp = workspaces_api_resource_handler._workspaces_set_total_usage(
+                {"total-usage": "10"}, {"workspace_id": str(uuid.uuid4())}, api_key
+            )
+            assert resp["statusCode"] == 404
+
+        # Nothing was written synchronously
+        item = dynamodb_table.get_item(
+            Key={"bmh_workspace_id": workspace_id, "user_id": test_email_1}
+        )["Item"]
+        assert item["total-usage"] == 100
+
+        messages = sqs.receive_message(QueueUrl=queue_url, MaxNumberOfMessages=10)[
+            "Messages"
+        ]
+        assert len(messages) == 2
+
+    records = [{"messageId": m["MessageId"], "body": m["Body"]} for m in messages]
+    # Both updates were sent within the same millisecond, make the order explicit
+    for i, record in enumerate(records):
+        body = json.loads(record["body"])
+        body["reported_at"] += i
+        record["body"] = json.dumps(body)
+    assert all(json.loads(r["body"])["user_id"] == test_email_1 for r in records)
+    # Enqueued without user_id, e.g. before the API added it
+    records.append(_record("unknown", str(uuid.uuid4()), "10", 0))
+
+    with patch.object(
+        total_usage_queue_handler.api, "_publish_to_sns_topic"
+    ) as mock_sns:
+        resp = total_usage_queue_handler.handler({"Records": records}, None)
+
+        # Only the last update was applied, crossing the soft limit once
+        mock_sns.assert_called_once()
+
+        assert resp == {"batchItemFailures": []}
+        item = dynamodb_table.get_item(
+            Key={"bmh_workspace_id": workspace_id, "user_id": test_email_1}
+        )["Item"]
+        assert item["total-usage"] == 170
+
+        # An older update delivered in a later batch is dropped
+        mock_sns.reset_mock()
+        late = _record("late", workspace_id, "120", int(item["usage_reported_at"]) - 1)
+        resp = total_usage_queue_handler.handler({"Records": [late]}, None)
+        mock_sns.assert_not_called()
+
+    assert resp == {"batchItemFailures": []}
+    item = dynamodb_table.get_item(
+        Key={"bmh_workspace_id": workspace_id, "user_id": test_email_1}
+    )["Item"]
+    assert item["total-usage"] == 170
+
+
+def test_last_coalesced_total_usage_is_applied(dynamodb_table, table_names):
+    workspace_id = str(uuid.uuid4())
+    key = {"bmh_workspace_id": workspace_id, "user_id": test_email_1}
+    dynamodb_table.put_item(
+        Item={
+            **key,
+            "workspace_request_id": workspace_id,
+            "workspace_type": "STRIDES Credits",
+            "request_status": "active",
+            "soft-limit": decimal.Decimal("160"),
+            "hard-limit": decimal.Decimal("200"),
+            "total-usage": decimal.Decimal("100"),
+            "sns-topic": "testSNSTopic",
+        }
+    )
+
+    with mock_sqs(), patch.object(
+        total_usage_queue_handler.api, "_publish_to_sns_topic"
+    ):
+        sqs = boto3.client("sqs")
+        queue_url = sqs.create_queue(QueueName="total-usage")["QueueUrl"]
+        environment = {
+            "usage_update_min_interval_seconds": "3600",
+            "total_usage_flush_queue_url": queue_url,
+        }
+
+        with mock.patch.dict(os.environ, environment):
+            # A burst: only the first update is written right away
+            for total_usage in ["110", "120", "130"]:
+                resp = workspaces_api_resource_handler._workspaces_set_total_usage(
+                    {"total-usage": total_usage},
+                    {"workspace_id": workspace_id},
+                    api_key,
+                )
+                assert resp["statusCode"] == 200
+            assert dynamodb_table.get_item(Key=key)["Item"]["total-usage"] == 110
+
+            # The others wait in the queue until the interval is over
+            attributes = sqs.get_queue_attributes(
+                QueueUrl=queue_url, AttributeNames=["All"]
+            )["Attributes"]
+            assert attributes["ApproximateNumberOfMessagesDelayed"] == "2"
+            assert "Messages" not in sqs.receive_message(QueueUrl=queue_url)
+
+            # An hour later
+            dynamodb_table.update_item(
+                Key=key,
+                UpdateExpression="SET usage_update_time = usage_update_time - :hour",
+                ExpressionAttributeValues={":hour": 3600},
+            )
+            later = moto_sqs_models.unix_time_millis() + 3600 * 1000
+            with patch.object(moto_sqs_models, "unix_time_millis", return_value=later):
+                messages = sqs.receive_message(
+                    QueueUrl=queue_url, MaxNumberOfMessages=10
+                )["Messages"]
+            assert len(messages) == 2
+
+            records = [
+                {"messageId": m["MessageId"], "body": m["Body"]} for m in messages
+            ]
+            resp = total_usage_queue_handler.handler({"Records": records}, None)
+
+    assert resp == {"batchItemFailures": []}
+    assert dynamodb_table.get_item(Key=key)["Item"]["total-usage"] == 130
+
+
+def test_failed_updates_are_reported(dynamodb_table):
+    records = [_record("1", "ws-1", "10", 1000), _record("2", "ws-2", "10", 1000)]
+
+    def fail_ws_1(repository, update):
+        if update["workspace_id"] == "ws-1":
+            raise Exception("Throttled")
+
+    with mock.patch.object(
+        total_usage_queue_handler.api,
+        "_get_dynamodb_table_name",
+        return_value="testTable",
+    ), mock.patch.object(
+        total_usage_queue_handler.api,
+        "_get_dynamodb_index_name",
+        return_value="testIndex",
+    ), mock.patch.object(
+        total_usage_queue_handler, "apply_update", side_effect=fail_ws_1
+    ):
+        resp = total_usage_queue_handler.handler({"Records": records}, None)
+
+    assert resp == {"batchItemFailures": [{"itemIdentifier": "1"}]}
@@ -9,6 +9,9 @@ import boto3
 from boto3.dynamodb.conditions import Key
 from botocore.exceptions import ClientError
 from boto3.dynamodb import table
+from bmh_common import workspace_repository
+from bmh_common.log_utils import LogFilter
+from bmh_common.workspace_repository import DynamoDBWorkspaceRepository, details_id
 from lambdas.workspaces_api_resource import workspaces_api_resource_handler
 from moto import mock_apigateway, mock_sns, mock_lambda, mock_iam
 
@@ -266,6 +269,62 @@ def test_workspaces_post_direct_pay(dynamodb_table):
         )
 
 
+def test_workspaces_post_request_details(dynamodb_table):
+    os.environ["email_domain"] = "uchicago.edu"
+    body = {
+        "workspace_type": "STRIDES Credits",
+        "scientific_poc": "Researcher Name",
+        "project_short_title": "Title",
+        "summary_and_justification": "A long justification",
+        "attestation": True,
+    }
+    with patch(
+        "lambdas.workspaces_api_resource.workspaces_api_resource_handler.EmailHelper"
+    ) as mock_email_client:
+        with patch.object(
+            workspaces_api_resource_handler, "_get_dynamodb_table_name"
+        ) as mock_get_table_name:
+            mock_get_table_name.return_value = "testTable"
+            resp = workspaces_api_resource_handler._workspaces_post(
+                dict(body), test_email_1
+            )
+            assert resp["statusCode"] == 200
+
+            # The request email has every field
+            (item,) = mock_email_client.send_credits_workspace_request_email.call_args[
+                0
+            ]
+            assert item["summary_and_justification"] == "A long justification"
+
+            # The fields of the form which are not listed are request details
+            items = dynamodb_table.query(
+                KeyConditionExpression=Key("user_id").eq(test_email_1)
+            )["Items"]
+            assert len(items) == 2
+            workspace, details = items
+            workspace_id = workspace["bmh_workspace_id"]
+            assert details["bmh_workspace_id"] == details_id(workspace_id)
+            assert workspace["scientific_poc"] == "Researcher Name"
+            assert workspace["total-usage"] == 0
+            assert "project_short_title" not in workspace
+            assert "summary_and_justification" not in workspace
+            assert details["project_short_title"] == "Title"
+            assert details["attestation"] is True
+            assert "total-usage" not in details
+
+            # Listings only return the workspace items
+            resp = workspaces_api_resource_handler._workspaces_get(None, test_email_1)
+            assert [w["bmh_workspace_id"] for w in json.loads(resp["body"])] == [
+                workspace_id
+            ]
+            resp = workspaces_api_resource_handler._workspaces_get(
+                {"workspace_id": "admin_all"}, None
+            )
+            assert [w["bmh_workspace_id"] for w in json.loads(resp["body"])] == [
+                workspace_id
+            ]
+
+
 def test_workspace_provision(dynamodb_table):
 
     # Mock the Dynamodb table with an exiting workspace records
@@ -346,17 +405,8 @@ def test_workspace_provision_failures():
                 workspaces_api_resource_handler._workspace_provision(body, path_params)
             os.environ["user_services_email"] = test_user_services_email
 
-            # Send path_params without workspace_id -- verify for AssertionError
-            body = {"account_id": "testAccount"}
-            path_params = {}
-            with pytest.raises(AssertionError):
-                workspaces_api_resource_handler._workspace_provision(body, path_params)
-
-            # Send body without account_id -- verify for AssertionError
-            body = {}
-            path_params = {"workspace_id": "testId"}
-            with pytest.raises(AssertionError):
-                workspaces_api_resource_handler._workspace_provision(body, path_params)
+            # Missing workspace_id or account_id: rejected by the route schemas, see
+            # test_handler_rejects_invalid_requests
 
             # Mock `_get_workspace_request_status_and_email` method to return a value which is not 'pending','failed','error'
             #   verify for a ValueError
@@ -560,31 +610,8 @@ def test_workspaces_set_limits(dynamodb_table):
             dynamodb_table.put_item(Item=item2)
 
             # Failure responses#
-            # Send path_params without workspace_id -- verify for AssertionError
-            body = {"soft-limit": "160", "hard-limit": "200"}
-            path_params = {}
-            with pytest.raises(AssertionError):
-                workspaces_api_resource_handler._workspaces_set_limits(
-                    body, path_params, test_email_1
-                )
-            # Direct pay: end path_params without workspace_id -- verify for AssertionError
-            with pytest.raises(AssertionError):
-                workspaces_api_resource_handler._workspaces_set_limits(
-                    body, path_params, test_email_3
-                )
-
-            # Send body without soft-limit (also hard-limit) -- verify for AssertionError
-            body = {}
-            path_params = {"workspace_id": id1}
-            with pytest.raises(AssertionError):
-                workspaces_api_resource_handler._workspaces_set_limits(
-                    body, path_params, test_email_1
-                )
-            # Direct pay: Send body without soft-limit (also hard-limit) -- verify for AssertionError
-            with pytest.raises(AssertionError):
-                workspaces_api_resource_handler._workspaces_set_limits(
-                    body, {"workspace_id": id2}, test_email_3
-                )
+            # Missing workspace_id or limits: rejected by the route schemas, see
+            # test_handler_rejects_invalid_requests
 
             # Send body without soft-limit >= hard-limit -- verify for ValueError
             body = {"soft-limit": "200", "hard-limit": "160"}
@@ -674,31 +701,17 @@ def test_workspaces_set_total_usage(dynamodb_table):
             mock_get_index_name.return_value = "testIndex"
 
             # Failure responses#
-            # Send path_params without workspace_id -- verify for AssertionError
-            body = {"total-usage": "200"}
-            path_params = {}
-            with pytest.raises(AssertionError):
-                workspaces_api_resource_handler._workspaces_set_total_usage(
-                    body, path_params, api_key
-                )
-
+            # Missing workspace_id or total-usage: rejected by the route schemas, see
+            # test_handler_rejects_invalid_requests
             id1 = str(uuid.uuid4())
 
-            # Send body without total-usage -- verify for AssertionError
-            body = {}
-            path_params = {"workspace_id": id1}
-            with pytest.raises(AssertionError):
-                workspaces_api_resource_handler._workspaces_set_total_usage(
-                    body, path_params, api_key
-                )
-
-            # Invoke the method without an `api_key` -- verify for ValueError
+            # Invoke the method without an `api_key` -- 403
             body = {"total-usage": "200"}
             path_params = {"workspace_id": id1}
-            with pytest.raises(AssertionError):
-                workspaces_api_resource_handler._workspaces_set_total_usage(
-                    body, path_params, None
-                )
+            resp = workspaces_api_resource_handler._workspaces_set_total_usage(
+                body, path_params, None
+            )
+            assert resp["statusCode"] == 403
 
             # Success Response#
 
@@ -800,3 +813,791 @@ def test_workspaces_set_total_usage_db_error():
                 workspaces_api_resource_handler._workspaces_set_total_usage(
                     body, path_params, api_key
                 )
+
+
+def test_unknown_workspace_not_found(dynamodb_table):
+    with mock.patch.object(
+        workspaces_api_resource_handler,
+        "_get_dynamodb_table_name",
+        return_value="testTable",
+    ), mock.patch.object(
+        workspaces_api_resource_handler,
+        "_get_dynamodb_index_name",
+        return_value="testIndex",
+    ):
+        path_params = {"workspace_id": str(uuid.uuid4())}
+        resp = workspaces_api_resource_handler._workspaces_set_total_usage(
+            {"total-usage": "200"}, path_params, api_key
+        )
+        assert resp["statusCode"] == 404
+        resp = workspaces_api_resource_handler._workspace_provision(
+            {"account_id": "testAccount"}, path_params
+        )
+        assert resp["statusCode"] == 404
+
+
+def test_workspaces_set_cost_breakdown(dynamodb_table):
+
+    with mock.patch.object(
+        workspaces_api_resource_handler, "_get_dynamodb_table_name"
+    ) as mock_get_table_name:
+        with mock.patch.object(
+            workspaces_api_resource_handler, "_get_dynamodb_index_name"
+        ) as mock_get_index_name:
+            mock_get_table_name.return_value = "testTable"
+            mock_get_index_name.return_value = "testIndex"
+
+            id1 = str(uuid.uuid4())
+
+            # Failure responses#
+            # Invalid bodies are rejected by the route schema, see
+            # test_handler_rejects_invalid_requests
+            body = {"cost-breakdown": {"2024-01": {"AmazonEC2": 1.5}}}
+            resp = workspaces_api_resource_handler._workspaces_set_cost_breakdown(
+                body, {"workspace_id": id1}, None
+            )
+            assert resp["statusCode"] == 403
+
+            # Workspace does not exist -- 404
+            body = {"cost-breakdown": {"2024-01": {"AmazonEC2": 1.5}}}
+            resp = workspaces_api_resource_handler._workspaces_set_cost_breakdown(
+                body, {"workspace_id": id1}, api_key
+            )
+            assert resp["statusCode"] == 404
+
+            # Success Response#
+            # A workspace created before the split of the request details, with
+            # an older breakdown on the workspace item
+            item1 = {
+                "workspace_request_id": id1,
+                "user_id": test_email_1,
+                "bmh_workspace_id": id1,
+                "request_status": "active",
+                "total-usage": decimal.Decimal("100"),
+                "cost-breakdown": {"2022-01": {"AmazonEC2": 1}},
+            }
+            dynamodb_table.put_item(Item=item1)
+
+            # Only the most recent months are stored.
+            breakdown = {
+                f"2023-{month:02d}": {"AmazonEC2": 10.123, "other": 1}
+                for month in range(1, 13)
+            }
+            breakdown["2024-01"] = {"AmazonEC2": 120.521, "AmazonS3": 10.3}
+            resp = workspaces_api_resource_handler._workspaces_set_cost_breakdown(
+                {"cost-breakdown": breakdown}, {"workspace_id": id1}, api_key
+            )
+            assert resp["statusCode"] == 200
+
+            # The breakdown is stored with the request details
+            item = dynamodb_table.get_item(
+                Key={"bmh_workspace_id": details_id(id1), "user_id": test_email_1}
+            )["Item"]
+            stored = item["cost-breakdown"]
+            assert (
+                len(stored) == workspaces_api_resource_handler.MAX_COST_BREAKDOWN_MONTHS
+            )
+            assert "2023-01" not in stored
+            assert stored["2024-01"]["AmazonEC2"] == decimal.Decimal("120.52")
+            assert "cost_breakdown_update_time" in item
+
+            # The breakdown is returned for a single workspace
+            resp = workspaces_api_resource_handler._workspaces_get(
+                {"workspace_id": id1}, test_email_1
+            )
+            assert json.loads(resp["body"])["cost-breakdown"]["2024-01"] == {
+                "AmazonEC2": 120.52,
+                "AmazonS3": 10.3,
+            }
+
+
+@pytest.mark.parametrize("scan_threshold", [100, 0])
+def test_workspaces_set_total_usage_bulk(dynamodb_table, scan_threshold):
+    def workspace(user_id, total_usage):
+        workspace_id = str(uuid.uuid4())
+        item = {
+            "workspace_request_id": workspace_id,
+            "bmh_workspace_id": workspace_id,
+            "user_id": user_id,
+            "workspace_type": "STRIDES Credits",
+            "request_status": "active",
+            "soft-limit": decimal.Decimal("160"),
+            "hard-limit": decimal.Decimal("200"),
+            "sns-topic": "testSNSTopic",
+            "total-usage": decimal.Decimal(total_usage),
+        }
+        dynamodb_table.put_item(Item=item)
+        return workspace_id
+
+    over_hard_limit = workspace(test_email_1, "100")
+    over_soft_limit = workspace(test_email_2, "100")
+    under_limits = workspace(test_email_2, "10")
+    unknown = str(uuid.uuid4())
+
+    body = {
+        "workspaces": [
+            {"workspace_id": over_hard_limit, "total-usage": 250},
+            {"workspace_id": over_soft_limit, "total-usage": "170.555"},
+            {"workspace_id": under_limits, "total-usage": 20},
+            {"workspace_id": unknown, "total-usage": 20},
+            {"workspace_id": under_limits, "total-usage": 30},
+            {"workspace_id": "bad-usage", "total-usage": "abc"},
+            {"total-usage": 20},
+            {"workspace_id": "no-usage"},
+            "not an object",
+        ]
+    }
+
+    with mock.patch.object(
+        workspaces_api_resource_handler,
+        "_get_dynamodb_table_name",
+        return_value="testTable",
+    ), mock.patch.object(
+        workspaces_api_resource_handler,
+        "_get_dynamodb_index_name",
+        return_value="testIndex",
+    ), mock.patch.object(
+        workspace_repository,
+        "USER_LOOKUP_SCAN_THRESHOLD",
+        scan_threshold,
+    ), patch.object(
+        workspaces_api_resource_handler, "_publish_to_sns_topic"
+    ) as mock_sns:
+        # Users can not call the bulk endpoint
+        resp = workspaces_api_resource_handler._workspaces_set_total_usage_bulk(
+            body, test_email_1
+        )
+        assert resp["statusCode"] == 403
+
+        resp = workspaces_api_resource_handler._workspaces_set_total_usage_bulk(
+            {"workspaces": "not a list"}, None
+        )
+        assert resp["statusCode"] == 400
+
+        resp = workspaces_api_resource_handler._workspaces_set_total_usage_bulk(
+            body, None
+        )
+
+        subjects = sorted(call[0][1] for call in mock_sns.call_args_list)
+        assert len(subjects) == 2
+        assert "Hard limit" in subjects[0] and "Soft limit" in subjects[1]
+
+    assert resp["statusCode"] == 200
+    results = json.loads(resp["body"])["results"]
+    assert [r["status"] for r in results] == [200, 200, 200, 404] + [400] * 5
+    assert results[4]["message"] == "Duplicate workspace_id"
+    assert results[7]["message"] == "total-usage is required"
+
+    def total_usage(workspace_id, user_id):
+        return dynamodb_table.get_item(
+            Key={"bmh_workspace_id": workspace_id, "user_id": user_id}
+        )["Item"]["total-usage"]
+
+    assert total_usage(over_hard_limit, test_email_1) == 250
+    assert total_usage(over_soft_limit, test_email_2) == decimal.Decimal("170.56")
+    assert total_usage(under_limits, test_email_2) == 20
+
+
+def test_update_total_usage_skips_unchanged_and_coalesces(dynamodb_table):
+    workspace_id = str(uuid.uuid4())
+    key = {"bmh_workspace_id": workspace_id, "user_id": test_email_1}
+    dynamodb_table.put_item(
+        Item={
+            **key,
+            "workspace_request_id": workspace_id,
+            "workspace_type": "STRIDES Credits",
+            "request_status": "active",
+            "soft-limit": decimal.Decimal("160"),
+            "hard-limit": decimal.Decimal("200"),
+            "sns-topic": "testSNSTopic",
+            "total-usage": decimal.Decimal("100"),
+        }
+    )
+    repository = DynamoDBWorkspaceRepository("testTable")
+
+    def update(total_usage):
+        return workspaces_api_resource_handler._update_total_usage(
+            repository, workspace_id, test_email_1, total_usage
+        )
+
+    with patch.object(
+        workspaces_api_resource_handler, "_publish_to_sns_topic"
+    ) as mock_sns:
+        # Same rounded value: nothing is written
+        assert update("100.001") is None
+        assert "usage_update_time" not in dynamodb_table.get_item(Key=key)["Item"]
+
+        assert update("110")["total-usage"] == 100
+
+        with mock.patch.dict(os.environ, {"usage_update_min_interval_seconds": "3600"}):
+            # Changed, but updated less than an hour ago (dropped without
+            # total_usage_flush_queue_url, see test_total_usage_queue_handler)
+            assert update("120") is None
+            assert dynamodb_table.get_item(Key=key)["Item"]["total-usage"] == 110
+
+            # Crossing a limit is never coalesced
+            assert update("170")["total-usage"] == 110
+            mock_sns.assert_called_once()
+
+        # Missing workspaces still fail
+        with pytest.raises(Exception, match="Could not find Workspace"):
+            workspaces_api_resource_handler._update_total_usage(
+                repository, str(uuid.uuid4()), test_email_1, "10"
+            )
+
+
+def test_workspaces_batch_get(dynamodb_table):
+    def workspace(user_id):
+        workspace_id = str(uuid.uuid4())
+        dynamodb_table.put_item(
+            Item={
+                "workspace_request_id": workspace_id,
+                "bmh_workspace_id": workspace_id,
+                "user_id": user_id,
+                "workspace_type": "STRIDES Credits",
+                "request_status": "active",
+                "soft-limit": decimal.Decimal("160"),
+                "hard-limit": decimal.Decimal("200"),
+                "total-usage": decimal.Decimal("10"),
+                "sns-topic": "testSNSTopic",
+            }
+        )
+        return workspace_id
+
+    user_1_workspaces = [workspace(test_email_1) for _ in range(3)]
+    user_2_workspace = workspace(test_email_2)
+    unknown = str(uuid.uuid4())
+
+    requested = user_1_workspaces + [user_2_workspace, unknown, user_1_workspaces[0]]
+    body = {"workspaces": [{"workspace_id": w} for w in requested]}
+
+    with mock.patch.object(
+        workspaces_api_resource_handler,
+        "_get_dynamodb_table_name",
+        return_value="testTable",
+    ), mock.patch.object(
+        workspaces_api_resource_handler,
+        "_get_dynamodb_index_name",
+        return_value="testIndex",
+    ), mock.patch.object(
+        workspace_repository, "BATCH_GET_CHUNK_SIZE", 2
+    ):
+        # Users only get their own workspaces
+        resp = workspaces_api_resource_handler._workspaces_batch_get(body, test_email_1)
+        assert resp["statusCode"] == 200
+        retval = json.loads(resp["body"])
+        assert [w["bmh_workspace_id"] for w in retval["workspaces"]] == (
+            user_1_workspaces
+        )
+        assert retval["not_found"] == [user_2_workspace, unknown]
+        # Standard projection, no user_id or sns-topic
+        assert set(retval["workspaces"][0]) == {
+            "bmh_workspace_id",
+            "request_status",
+            "workspace_type",
+            "total-usage",
+            "soft-limit",
+            "hard-limit",
+        }
+
+        # Applications can get any workspace, with or without the user_id
+        body["workspaces"][3]["user_id"] = test_email_2
+        resp = workspaces_api_resource_handler._workspaces_batch_get(body, None)
+        retval = json.loads(resp["body"])
+        assert [w["bmh_workspace_id"] for w in retval["workspaces"]] == (
+            user_1_workspaces + [user_2_workspace]
+        )
+        assert retval["not_found"] == [unknown]
+
+
+def test_workspaces_get_changed_since(dynamodb_table):
+    with mock.patch.object(
+        workspaces_api_resource_handler,
+        "_get_dynamodb_table_name",
+        return_value="testTable",
+    ), mock.patch.object(
+        workspaces_api_resource_handler,
+        "_get_dynamodb_changes_index_name",
+        return_value="testChangesIndex",
+    ), mock.patch.object(
+        workspaces_api_resource_handler, "_now_milliseconds"
+    ) as mock_now, mock.patch.object(
+        workspace_repository, "_now_milliseconds", mock_now
+    ):
+
+        def workspace(user_id, last_modified):
+            workspace_id = str(uuid.uuid4())
+            mock_now.return_value = last_modified
+            dynamodb_table.put_item(
+                Item={
+                    "bmh_workspace_id": workspace_id,
+                    "user_id": user_id,
+                    "request_status": "pending",
+                    "workspace_type": "Direct Pay",
+                    "hard-limit": decimal.Decimal("200"),
+                    "soft-limit": decimal.Decimal("160"),
+                    "total-usage": decimal.Decimal("0"),
+                    "direct_pay_limit": decimal.Decimal("0"),
+                    "sns-topic": "testSNSTopic",
+                }
+            )
+            # Writes through the API maintain record_type and last_modified
+            with patch.object(
+                workspaces_api_resource_handler, "_get_site_info"
+            ), patch.object(workspaces_api_resource_handler, "_publish_to_sns_topic"):
+                workspaces_api_resource_handler._update_total_usage(
+                    DynamoDBWorkspaceRepository("testTable"),
+                    workspace_id,
+                    user_id,
+                    "10",
+                )
+            return workspace_id
+
+        old = workspace(test_email_1, 1000)
+        changed_1 = workspace(test_email_1, 3000)
+        changed_2 = workspace(test_email_2, 4000)
+        # Written before last_modified was maintained, not part of the index
+        dynamodb_table.put_item(
+            Item={"bmh_workspace_id": str(uuid.uuid4()), "user_id": test_email_1}
+        )
+
+        mock_now.return_value = 100_000
+
+        resp = workspaces_api_resource_handler._workspaces_get(
+            None, test_email_1, {"changed_since": "2000"}
+        )
+        assert resp["statusCode"] == 200
+        retval = json.loads(resp["body"])
+        assert [w["bmh_workspace_id"] for w in retval["workspaces"]] == [changed_1]
+        assert retval["workspaces"][0]["last_modified"] == 3000
+        assert "user_id" not in retval["workspaces"][0]
+        assert retval["changed_until"] == 100_000 - 5000
+
+        resp = workspaces_api_resource_handler._workspaces_get(
+            {"workspace_id": "admin_all"}, test_email_1, {"changed_since": "0"}
+        )
+        retval = json.loads(resp["body"])
+        assert [w["bmh_workspace_id"] for w in retval["workspaces"]] == [
+            old,
+            changed_1,
+            changed_2,
+        ]
+
+        # The changes can be merged into the full listings: same rows
+        resp = workspaces_api_resource_handler._workspaces_get(
+            {"workspace_id": "admin_all"}, test_email_1
+        )
+        listing = {w["bmh_workspace_id"]: w for w in json.loads(resp["body"])}
+        for changed in retval["workspaces"]:
+            assert changed == listing[changed["bmh_workspace_id"]]
+            assert {"user_id", "sns-topic"} <= set(changed)
+
+        resp = workspaces_api_resource_handler._workspaces_get(None, test_email_1)
+        listing = {w["bmh_workspace_id"]: w for w in json.loads(resp["body"])}
+        resp = workspaces_api_resource_handler._workspaces_get(
+            None, test_email_1, {"changed_since": "0"}
+        )
+        for changed in json.loads(resp["body"])["workspaces"]:
+            assert set(changed) == set(listing[changed["bmh_workspace_id"]]) | {
+                "last_modified"
+            }
+
+        # Nothing changed
+        resp = workspaces_api_resource_handler._workspaces_get(
+            None, test_email_1, {"changed_since": "99000"}
+        )
+        retval = json.loads(resp["body"])
+        assert retval == {"workspaces": [], "changed_until": 99000}
+
+        for path_params, email, changed_since in [
+            (None, test_email_1, "yesterday"),
+            ({"workspace_id": changed_1}, test_email_1, "0"),
+            (None, None, "0"),
+        ]:
+            resp = workspaces_api_resource_handler._workspaces_get(
+                path_params, email, {"changed_since": changed_since}
+            )
+            assert resp["statusCode"] == 400
+
+
+def test_workspaces_get_etag():
+    def event(headers=None):
+        return {
+            "resource": "/workspaces",
+            "path": "/workspaces",
+            "httpMethod": "GET",
+            "headers": headers,
+            "pathParameters": None,
+            "queryStringParameters": None,
+            "requestContext": {
+                "authorizer": {"user": test_email_1},
+                "identity": {"apiKey": None},
+            },
+        }
+
+    workspaces = [{"bmh_workspace_id": "1", "total-usage": decimal.Decimal("1.5")}]
+    with mock.patch.object(
+        workspaces_api_resource_handler,
+        "_workspaces_get",
+        side_effect=lambda *args: workspaces_api_resource_handler.create_response(
+            body=workspaces
+        ),
+    ):
+        resp = workspaces_api_resource_handler.handler(event(), None)
+        assert resp["statusCode"] == 200
+        etag = resp["headers"]["ETag"]
+        assert etag.startswith('"') and etag.endswith('"')
+        assert resp["headers"]["Cache-Control"] == "private, no-cache"
+
+        # Same content, header names are case insensitive
+        resp = workspaces_api_resource_handler.handler(
+            event({"if-none-match": f'"other", W/{etag}'}), None
+        )
+        assert resp["statusCode"] == 304
+        assert resp["body"] == ""
+        assert resp["headers"]["ETag"] == etag
+
+        # Content changed
+        workspaces[0]["total-usage"] = decimal.Decimal("2")
+        resp = workspaces_api_resource_handler.handler(
+            event({"If-None-Match": etag}), None
+        )
+        assert resp["statusCode"] == 200
+        assert resp["headers"]["ETag"] != etag
+        assert json.loads(resp["body"])[0]["total-usage"] == 2
+
+        # The ETag of a compressed response is specific to its encoding
+        with mock.patch.object(
+            workspaces_api_resource_handler, "RESPONSE_COMPRESSION_MIN_BYTES", 1
+        ), mock.patch.object(workspaces_api_resource_handler, "brotli", None):
+            identity = workspaces_api_resource_handler.handler(event(), None)
+            resp = workspaces_api_resource_handler.handler(
+                event({"Accept-Encoding": "gzip"}), None
+            )
+            assert resp["headers"]["Content-Encoding"] == "gzip"
+            assert (
+                resp["headers"]["ETag"] == identity["headers"]["ETag"][:-1] + '-gzip"'
+            )
+            assert resp["headers"]["Vary"] == "Accept-Encoding"
+
+            resp = workspaces_api_resource_handler.handler(
+                event(
+                    {
+                        "Accept-Encoding": "gzip",
+                        "If-None-Match": identity["headers"]["ETag"],
+                    }
+                ),
+                None,
+            )
+            assert resp["statusCode"] == 200
+            gzip_etag = resp["headers"]["ETag"]
+            resp = workspaces_api_resource_handler.handler(
+                event({"Accept-Encoding": "gzip", "If-None-Match": gzip_etag}), None
+            )
+            assert resp["statusCode"] == 304
+            assert resp["headers"]["Vary"] == "Accept-Encoding"
+
+
+def test_response_compression():
+    import base64
+    import gzip
+
+    def event(headers=None, body=None, is_base64_encoded=False):
+        return {
+            "resource": "/workspaces",
+            "path": "/workspaces",
+            "httpMethod": "GET",
+            "headers": headers,
+            "body": body,
+            "isBase64Encoded": is_base64_encoded,
+            "pathParameters": None,
+            "queryStringParameters": None,
+            "requestContext": {
+                "authorizer": {"user": test_email_1},
+                "identity": {"apiKey": None},
+            },
+        }
+
+    workspaces = [
+        {"bmh_workspace_id": str(i), "total-usage": decimal.Decimal(i)}
+        for i in range(200)
+    ]
+    with mock.patch.object(
+        workspaces_api_resource_handler,
+        "_workspaces_get",
+        side_effect=lambda *args: workspaces_api_resource_handler.create_response(
+            body=workspaces
+        ),
+    ), mock.patch.object(workspaces_api_resource_handler, "brotli", None):
+        # Not accepted by the client
+        resp = workspaces_api_resource_handler.handler(event(), None)
+        assert "Content-Encoding" not in resp["headers"]
+        assert not resp.get("isBase64Encoded")
+        uncompressed = resp["body"]
+
+        resp = workspaces_api_resource_handler.handler(
+            event({"Accept-Encoding": "gzip, deflate, br"}), None
+        )
+        assert resp["isBase64Encoded"]
+        assert resp["headers"]["Content-Encoding"] == "gzip"
+        assert resp["headers"]["Vary"] == "Accept-Encoding"
+        assert gzip.decompress(base64.b64decode(resp["body"])).decode() == uncompressed
+        assert len(base64.b64decode(resp["body"])) < len(uncompressed)
+
+        # Small responses are not compressed
+        with mock.patch.object(
+            workspaces_api_resource_handler,
+            "RESPONSE_COMPRESSION_MIN_BYTES",
+            len(uncompressed) + 1,
+        ):
+            resp = workspaces_api_resource_handler.handler(
+                event({"Accept-Encoding": "gzip"}), None
+            )
+            assert "Content-Encoding" not in resp["headers"]
+
+        # Base64 encoded request bodies are decoded
+        with mock.patch.object(
+            workspaces_api_resource_handler, "_workspaces_post"
+        ) as mock_post:
+            post_event = event(
+                body=base64.b64encode(b'{"workspace_type": "Direct Pay"}').decode(),
+                is_base64_encoded=True,
+            )
+            post_event["httpMethod"] = "POST"
+            mock_post.return_value = workspaces_api_resource_handler.create_response()
+            workspaces_api_resource_handler.handler(post_event, None)
+            mock_post.assert_called_once_with(
+                {"workspace_type": "Direct Pay"}, test_email_1
+            )
+
+
+@pytest.mark.parametrize(
+    "accept_encoding, brotli_available, expected",
+    [
+        (None, True, None),
+        ("identity", True, None),
+        ("gzip", True, "gzip"),
+        ("gzip, br", True, "br"),
+        ("gzip, br", False, "gzip"),
+        ("br;q=0.5, gzip;q=0.8", True, "gzip"),
+        ("gzip;q=0, *", False, None),
+        ("*", True, "br"),
+    ],
+)
+def test_negotiate_encoding(accept_encoding, brotli_available, expected):
+    with mock.patch.object(
+        workspaces_api_resource_handler,
+        "brotli",
+        MagicMock() if brotli_available else None,
+    ):
+        assert (
+            workspaces_api_resource_handler._negotiate_encoding(accept_encoding)
+            == expected
+        )
+
+
+def test_create_response_serializes_once(caplog):
+    body = [
+        {
+            "bmh_workspace_id": "1",
+            "total-usage": decimal.Decimal("1.5"),
+            "tags": {"a"},
+            "description": "x" * 100,
+        }
+    ]
+    (log_filter,) = [
+        f
+        for f in workspaces_api_resource_handler.logger.filters
+        if isinstance(f, LogFilter)
+    ]
+    with mock.patch.object(log_filter, "max_chars", 50), caplog.at_level("INFO"):
+        resp = workspaces_api_resource_handler.create_response(body=body)
+
+    assert json.loads(resp["body"]) == [
+        {
+            "bmh_workspace_id": "1",
+            "total-usage": 1.5,
+            "tags": ["a"],
+            "description": "x" * 100,
+        }
+    ]
+    # Compact separators
+    assert ", " not in resp["body"]
+
+    log = [
+        r.getMessage() for r in caplog.records if r.getMessage().startswith("Response")
+    ]
+    assert len(log) == 1
+    # Truncated by the log filter, to log_max_chars like the other messages
+    message = f"Response: 200 ({len(resp['body'])} characters) {resp['body'][:50]}"
+    assert log[0] == message[:50] + f"... [{len(message) - 50} more characters]"
+
+    with pytest.raises(TypeError):
+        workspaces_api_resource_handler.to_json({"a": object()})
+
+
+@pytest.mark.parametrize(
+    "resource, method, path_params, query_string_params, body, message",
+    [
+        ("/workspaces", "POST", None, None, {}, "body.workspace_type is required"),
+        (
+            "/workspaces",
+            "POST",
+            None,
+            None,
+            {"workspace_type": "Other"},
+            "body.workspace_type must be one of",
+        ),
+        (
+            "/workspaces",
+            "GET",
+            None,
+            {"changed_since": "yesterday"},
+            None,
+            "query.changed_since must match",
+        ),
+        (
+            "/workspaces/{workspace_id}/limits",
+            "PUT",
+            {"workspace_id": "1"},
+            None,
+            {"soft-limit": "a lot", "hard-limit": 100},
+            "body.soft-limit must be a number",
+        ),
+        (
+            "/workspaces/{workspace_id}/limits",
+            "PUT",
+            {"workspace_id": "1"},
+            None,
+            {},
+            "body.soft-limit is required",
+        ),
+        (
+            "/workspaces/{workspace_id}/total-usage",
+            "PUT",
+            None,
+            None,
+            {"total-usage": 1},
+            "path.workspace_id is required",
+        ),
+        (
+            "/workspaces/{workspace_id}/total-usage",
+            "PUT",
+            {"workspace_id": "1"},
+            None,
+            {"total-usage": "abc"},
+            "body.total-usage must be a number",
+        ),
+        (
+            "/workspaces/{workspace_id}/provision",
+            "POST",
+            {"workspace_id": "1"},
+            None,
+            {},
+            "body.account_id is required",
+        ),
+        (
+            "/workspaces/{workspace_id}/cost-breakdown",
+            "PUT",
+            {"workspace_id": "1"},
+            None,
+            {},
+            "body.cost-breakdown is required",
+        ),
+        (
+            "/workspaces/{workspace_id}/cost-breakdown",
+            "PUT",
+            {"workspace_id": "1"},
+            None,
+            {"cost-breakdown": [1, 2]},
+            "body.cost-breakdown must be of type object",
+        ),
+        (
+            "/workspaces/{workspace_id}/cost-breakdown",
+            "PUT",
+            {"workspace_id": "1"},
+            None,
+            {"cost-breakdown": {"January 2024": {"AmazonEC2": 1}}},
+            "body.cost-breakdown property name January 2024 must match the pattern",
+        ),
+        (
+            "/workspaces/{workspace_id}/cost-breakdown",
+            "PUT",
+            {"workspace_id": "1"},
+            None,
+            {"cost-breakdown": {"2024-13": {"AmazonEC2": 1}}},
+            "body.cost-breakdown property name 2024-13 must match the pattern",
+        ),
+        (
+            "/workspaces/{workspace_id}/cost-breakdown",
+            "PUT",
+            {"workspace_id": "1"},
+            None,
+            {"cost-breakdown": {"2024-01": 1}},
+            "body.cost-breakdown.2024-01 must be of type object",
+        ),
+        (
+            "/workspaces/batch-get",
+            "POST",
+            None,
+            None,
+            {"workspaces": [{"user_id": test_email_1}]},
+            "body.workspaces[0].workspace_id is required",
+        ),
+    ],
+)
+def test_handler_rejects_invalid_requests(
+    resource, method, path_params, query_string_params, body, message
+):
+    event = {
+        "resource": resource,
+        "path": resource,
+        "httpMethod": method,
+        "headers": None,
+        "body": json.dumps(body) if body is not None else None,
+        "pathParameters": path_params,
+        "queryStringParameters": query_string_params,
+        "requestContext": {
+            "authorizer": {"user": test_email_1},
+            "identity": {"apiKey": api_key},
+        },
+    }
+    # Rejected before any AWS client is created
+    with mock.patch.object(
+        workspaces_api_resource_handler.boto3, "resource"
+    ) as mock_resource, mock.patch.object(
+        workspaces_api_resource_handler.boto3, "client"
+    ) as mock_client:
+        resp = workspaces_api_resource_handler.handler(event, None)
+
+    assert resp["statusCode"] == 400
+    assert json.loads(resp["body"])["message"].startswith(message)
+    mock_resource.assert_not_called()
+    mock_client.assert_not_called()
+
+
+def test_handler_coerces_numeric_fields():
+    event = {
+        "resource": "/workspaces/{workspace_id}/limits",
+        "path": "/workspaces/1/limits",
+        "httpMethod": "PUT",
+        "headers": None,
+        "body": json.dumps({"soft-limit": "50", "hard-limit": 100.5}),
+        "pathParameters": {"workspace_id": "1"},
+        "queryStringParameters": None,
+        "requestContext": {
+            "authorizer": {"user": test_email_1},
+            "identity": {"apiKey": None},
+        },
+    }
+    with mock.patch.object(
+        workspaces_api_resource_handler, "_workspaces_set_limits"
+    ) as mock_set_limits:
+        mock_set_limits.return_value = workspaces_api_resource_handler.create_response()
+        workspaces_api_resource_handler.handler(event, None)
+
+    mock_set_limits.assert_called_once_with(
+        {"soft-limit": decimal.Decimal("50"), "hard-limit": decimal.Decimal("100.5")},
+        {"workspace_id": "1"},
+        test_email_1,
+    )
@@ -0,0 +1,392 @@
+"""
+The same tests run against both implementations of the workspace repository, the
+DynamoDB one (with moto) and the in-memory one, so that they keep the same semantics.
+"""
+
+import decimal
+import time
+import uuid
+from unittest import mock
+from unittest.mock import MagicMock
+
+import pytest
+from botocore.exceptions import ClientError
+from moto import mock_dynamodb
+
+from bmh_common import workspace_repository
+from bmh_common.workspace_repository import (
+    DynamoDBWorkspaceRepository,
+    InMemoryWorkspaceRepository,
+    UpdateCoalescedError,
+    WorkspaceNotFoundError,
+)
+
+from .conftest import create_workspaces_table
+
+test_email_1 = "test1@uchicago.com"
+test_email_2 = "test2@uchicago.com"
+
+
+@pytest.fixture(params=["dynamodb", "memory"])
+def repository(request):
+    if request.param == "memory":
+        yield InMemoryWorkspaceRepository()
+        return
+    with mock_dynamodb():
+        create_workspaces_table()
+        yield DynamoDBWorkspaceRepository(
+            "testTable", index_name="testIndex", changes_index_name="testChangesIndex"
+        )
+
+
+def _workspace(repository, user_id, **attributes):
+    workspace_id = str(uuid.uuid4())
+    repository.put(
+        {
+            "bmh_workspace_id": workspace_id,
+            "user_id": user_id,
+            "workspace_type": "STRIDES Credits",
+            "request_status": "active",
+            "soft-limit": decimal.Decimal("160"),
+            "hard-limit": decimal.Decimal("200"),
+            "total-usage": 100,
+            **attributes,
+        }
+    )
+    return workspace_id
+
+
+def test_put_and_get(repository):
+    before = int(time.time() * 1000)
+    workspace_id = _workspace(repository, test_email_1)
+
+    item = repository.get(workspace_id, test_email_1)
+    # Numbers are returned as Decimal, and writes are stamped
+    assert item["total-usage"] == 100
+    assert isinstance(item["total-usage"], decimal.Decimal)
+    assert item["record_type"] == "workspace"
+    assert item["last_modified"] >= before
+
+    # Items are copies
+    item["request_status"] = "changed"
+    assert repository.get(workspace_id, test_email_1)["request_status"] == "active"
+
+    assert repository.get(
+        workspace_id, test_email_1, attributes=["total-usage", "soft-limit", "nope"]
+    ) == {"total-usage": 100, "soft-limit": 160}
+    assert repository.get(workspace_id, test_email_2) is None
+
+
+def test_find_user_ids(repository):
+    workspace_1 = _workspace(repository, test_email_1)
+    workspace_2 = _workspace(repository, test_email_2)
+    shared = _workspace(repository, test_email_1)
+    repository.put({"bmh_workspace_id": shared, "user_id": test_email_2})
+    unknown = str(uuid.uuid4())
+
+    assert repository.find_user_id(workspace_1) == test_email_1
+    # Not found, or not unique
+    assert repository.find_user_id(unknown) is None
+    assert repository.find_user_id(shared) is None
+
+    expected = {workspace_1: test_email_1, workspace_2: test_email_2}
+    workspace_ids = [workspace_1, workspace_2, shared, unknown]
+    assert repository.find_user_ids(workspace_ids) == expected
+    # With a scan of the index
+    with mock.patch.object(workspace_repository, "USER_LOOKUP_SCAN_THRESHOLD", 1):
+        assert repository.find_user_ids(workspace_ids) == expected
+    assert repository.find_user_ids([]) == {}
+
+
+def test_list(repository):
+    user_1_workspaces = sorted(_workspace(repository, test_email_1) for _ in range(3))
+    provisioned = _workspace(repository, test_email_2, account_id="111111111111")
+
+    items = repository.list_by_user(
+        test_email_1, attributes=["bmh_workspace_id", "total-usage"]
+    )
+    assert [item["bmh_workspace_id"] for item in items] == user_1_workspaces
+    assert set(items[0]) == {"bmh_workspace_id", "total-usage"}
+    assert repository.list_by_user("nobody") == []
+
+    assert len(list(repository.list_all())) == 4
+    assert list(
+        repository.list_all(
+            attributes=["bmh_workspace_id", "account_id"], having=["account_id"]
+        )
+    ) == [{"bmh_workspace_id": provisioned, "account_id": "111111111111"}]
+
+
+def test_list_changed(repository):
+    with mock.patch.object(workspace_repository, "_now_milliseconds") as mock_now:
+        mock_now.return_value = 1000
+        _workspace(repository, test_email_1)
+        mock_now.return_value = 3000
+        changed_1 = _workspace(repository, test_email_1)
+        mock_now.return_value = 2000
+        changed_2 = _workspace(repository, test_email_2)
+
+    items = repository.list_changed(
+        1500, attributes=["bmh_workspace_id", "last_modified"]
+    )
+    assert items == [
+        {"bmh_workspace_id": changed_2, "last_modified": 2000},
+        {"bmh_workspace_id": changed_1, "last_modified": 3000},
+    ]
+    items = repository.list_changed(1500, user_id=test_email_1)
+    assert [item["bmh_workspace_id"] for item in items] == [changed_1]
+    with mock.patch.object(workspace_repository, "_now_milliseconds") as mock_now:
+        mock_now.return_value = 2500
+        changed_3 = _workspace(repository, test_email_1)
+    # Read from the user's partition, still sorted by last_modified
+    items = repository.list_changed(
+        1500, user_id=test_email_1, attributes=["bmh_workspace_id"]
+    )
+    assert items == [{"bmh_workspace_id": changed_3}, {"bmh_workspace_id": changed_1}]
+    assert repository.list_changed(1500, user_id="nobody") == []
+
+
+def test_list_changed_shards(repository):
+    with mock.patch.object(workspace_repository, "_now_milliseconds") as mock_now:
+        workspace_ids = []
+        for last_modified in range(1000, 0, -50):
+            mock_now.return_value = last_modified
+            workspace_ids.append(_workspace(repository, test_email_1))
+
+    items = repository.list_changed(
+        0, attributes=["bmh_workspace_id", "changes_shard", "last_modified"]
+    )
+    # Spread over the shards, merged by last_modified
+    assert len({item["changes_shard"] for item in items}) > 1
+    assert [item["bmh_workspace_id"] for item in items] == workspace_ids[::-1]
+    assert items[0]["changes_shard"] == workspace_repository.changes_shard(
+        workspace_ids[-1]
+    )
+
+
+def test_batch_get(repository):
+    workspace_ids = [_workspace(repository, test_email_1) for _ in range(3)]
+    keys = [(workspace_id, test_email_1) for workspace_id in workspace_ids]
+    keys.append((workspace_ids[0], test_email_2))
+    keys.append((str(uuid.uuid4()), test_email_1))
+
+    with mock.patch.object(workspace_repository, "BATCH_GET_CHUNK_SIZE", 2):
+        items = repository.batch_get(keys, attributes=["bmh_workspace_id"])
+
+    assert sorted(items, key=lambda item: item["bmh_workspace_id"]) == [
+        {"bmh_workspace_id": workspace_id} for workspace_id in sorted(workspace_ids)
+    ]
+
+
+def test_update(repository):
+    workspace_id = _workspace(repository, test_email_1)
+
+    attributes = repository.update(
+        workspace_id, test_email_1, {"request_status": "provisioning", "subnet": 3}
+    )
+    assert attributes["request_status"] == "provisioning"
+    assert attributes["subnet"] == 3
+    assert attributes["total-usage"] == 100
+    assert repository.get(workspace_id, test_email_1) == attributes
+
+    with pytest.raises(WorkspaceNotFoundError, match="Could not find Workspace"):
+        repository.update(workspace_id, test_email_2, {"request_status": "active"})
+    assert repository.get(workspace_id, test_email_2) is None
+
+
+def test_update_total_usage(repository):
+    workspace_id = _workspace(repository, test_email_1)
+
+    def update(total_usage, min_interval=0):
+        return repository.update_total_usage(
+            workspace_id,
+            test_email_1,
+            decimal.Decimal(total_usage),
+            min_interval=min_interval,
+        )
+
+    def stored():
+        return repository.get(workspace_id, test_email_1)
+
+    # Unchanged: nothing is written
+    assert update("100") is None
+    assert "usage_update_time" not in stored()
+
+    old = update("110")
+    assert old["total-usage"] == 100 and "usage_update_time" not in old
+    assert stored()["total-usage"] == 110
+    assert stored()["usage_update_time"] > 0
+
+    # Changed, but updated less than an hour ago: to be applied again later
+    with pytest.raises(UpdateCoalescedError) as e:
+        update("120", min_interval=3600)
+    assert 3500 < e.value.retry_after <= 3600
+    assert stored()["total-usage"] == 110
+    # Crossing a limit is never coalesced
+    assert update("170", min_interval=3600)["total-usage"] == 110
+    assert stored()["total-usage"] == 170
+
+    with pytest.raises(WorkspaceNotFoundError):
+        repository.update_total_usage(
+            str(uuid.uuid4()), test_email_1, decimal.Decimal("1")
+        )
+
+
+def test_update_total_usage_reported_at(repository):
+    workspace_id = _workspace(repository, test_email_1)
+
+    def update(total_usage, reported_at):
+        return repository.update_total_usage(
+            workspace_id,
+            test_email_1,
+            decimal.Decimal(total_usage),
+            reported_at=reported_at,
+        )
+
+    def stored():
+        return repository.get(workspace_id, test_email_1)
+
+    assert update("110", 2000)["total-usage"] == 100
+    assert stored()["usage_reported_at"] == 2000
+    # Reported before the stored update: dropped
+    assert update("105", 1000) is None
+    assert update("105", 2000) is None
+    assert stored()["total-usage"] == 110
+
+    # Unchanged, but more recent: older updates are still dropped after it
+    assert update("110", 3000) is None
+    assert stored()["usage_reported_at"] == 3000
+    assert update("120", 2500) is None
+    assert stored()["total-usage"] == 110
+    assert update("120", 4000)["usage_reported_at"] == 3000
+    assert stored()["total-usage"] == 120
+
+    # Too recent: usage_reported_at is not recorded, so that the update can be
+    # applied when the interval is over
+    with pytest.raises(UpdateCoalescedError):
+        repository.update_total_usage(
+            workspace_id,
+            test_email_1,
+            decimal.Decimal("130"),
+            min_interval=3600,
+            reported_at=5000,
+        )
+    assert stored()["usage_reported_at"] == 4000
+
+
+def test_request_details(repository):
+    with mock.patch.object(workspace_repository, "_now_milliseconds") as mock_now:
+        mock_now.return_value = 2000
+        workspace_id = _workspace(
+            repository,
+            test_email_1,
+            project_short_title="Title",
+            summary_and_justification="Justification",
+        )
+    other = _workspace(repository, test_email_1)
+
+    # The workspace item only has HOT_ATTRIBUTES
+    item = repository.get(workspace_id, test_email_1)
+    assert "project_short_title" not in item
+    assert set(item) <= workspace_repository.HOT_ATTRIBUTES
+    assert repository.get_details(workspace_id, test_email_1) == {
+        "project_short_title": "Title",
+        "summary_and_justification": "Justification",
+    }
+    assert repository.get_details(
+        workspace_id, test_email_1, attributes=["project_short_title"]
+    ) == {"project_short_title": "Title"}
+    assert repository.get_details(other, test_email_1) == {}
+
+    # Lookups and listings do not see the details items
+    assert repository.find_user_id(workspace_id) == test_email_1
+    assert [
+        item["bmh_workspace_id"] for item in repository.list_by_user(test_email_1)
+    ] == sorted([workspace_id, other])
+    assert len(list(repository.list_all())) == 2
+    assert list(repository.list_all(having=["project_short_title"])) == []
+    assert [item["bmh_workspace_id"] for item in repository.list_changed(1000)] == [
+        workspace_id,
+        other,
+    ]
+
+    # Details are updated, or created for workspaces which have none
+    details = repository.update_details(
+        other, test_email_1, {"cost-breakdown": {"2024-01": {"AmazonEC2": 1}}}
+    )
+    assert details == {"cost-breakdown": {"2024-01": {"AmazonEC2": 1}}}
+    repository.update_details(
+        workspace_id, test_email_1, {"project_short_title": "New"}
+    )
+    assert (
+        repository.get_details(workspace_id, test_email_1)["project_short_title"]
+        == "New"
+    )
+    assert "cost-breakdown" not in repository.get(other, test_email_1)
+
+
+def test_put_writes_details_atomically():
+    with mock_dynamodb():
+        create_workspaces_table()
+        repository = DynamoDBWorkspaceRepository("testTable")
+        workspace_id = _workspace(repository, test_email_1, keywords="k")
+
+        # The details item is too large: the workspace item is not written either
+        with pytest.raises(ClientError):
+            _workspace(repository, test_email_1, keywords="k" * 500 * 1024)
+        assert [
+            item["bmh_workspace_id"] for item in repository.list_by_user(test_email_1)
+        ] == [workspace_id]
+
+
+def test_split_details():
+    item = {
+        "bmh_workspace_id": "1",
+        "user_id": "a",
+        "total-usage": 1,
+        # Written by PUT /workspaces/{workspace_id}/limits on the workspace item
+        "local": True,
+        "keywords": "k",
+    }
+    assert workspace_repository.split_details(item) == [
+        {"bmh_workspace_id": "1", "user_id": "a", "total-usage": 1, "local": True},
+        {
+            "bmh_workspace_id": "~details#1",
+            "user_id": "a",
+            "record_type": "workspace_details",
+            "keywords": "k",
+        },
+    ]
+    assert workspace_repository.split_details(
+        {"bmh_workspace_id": "1", "user_id": "a"}
+    ) == [{"bmh_workspace_id": "1", "user_id": "a"}]
+
+
+def test_in_memory_rejects_floats_like_boto3():
+    repository = InMemoryWorkspaceRepository()
+    with pytest.raises(TypeError):
+        repository.put({"bmh_workspace_id": "1", "user_id": "a", "total-usage": 1.5})
+
+
+def test_batch_get_retries_unprocessed_keys():
+    keys = [{"bmh_workspace_id": str(i), "user_id": test_email_1} for i in range(3)]
+    dynamodb = MagicMock()
+    dynamodb.batch_get_item.side_effect = [
+        {
+            "Responses": {"testTable": [keys[0]]},
+            "UnprocessedKeys": {"testTable": {"Keys": keys[1:]}},
+        },
+        {"Responses": {"testTable": keys[1:]}, "UnprocessedKeys": {}},
+    ]
+    repository = DynamoDBWorkspaceRepository("testTable", dynamodb=dynamodb)
+
+    with mock.patch.object(workspace_repository.time, "sleep"):
+        items = repository.batch_get(
+            [(key["bmh_workspace_id"], key["user_id"]) for key in keys]
+        )
+
+    assert items == keys
+    assert dynamodb.batch_get_item.call_count == 2
+    assert dynamodb.batch_get_item.call_args[1]["RequestItems"] == {
+        "testTable": {"Keys": keys[1:]}
+    }
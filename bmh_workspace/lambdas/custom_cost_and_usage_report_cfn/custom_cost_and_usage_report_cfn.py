@@ -15,6 +15,9 @@ logger = logging.getLogger(__name__)
 logging.basicConfig(level=logging.INFO, format="%(message)s")
 logger.setLevel(logging.INFO)
 
+# Reused across invocations of the same container
+http = urllib3.PoolManager(timeout=urllib3.Timeout(connect=5.0, read=30.0))
+
 
 def handler(event, context):
 
@@ -26,6 +29,16 @@ def handler(event, context):
     except Exception as e:
         logger.exception(e)
         _respond_failed(event, context, {"error": str(e)})
+        return
+
+    definition_hash = _hash_report_definition(report_definition)
+
+    # The physical resource id must not change on Update, otherwise CloudFormation
+    # considers the resource replaced and sends a Delete for the "old" one, which
+    # has the same ReportName.
+    physical_resource_id = event.get(
+        "PhysicalResourceId", report_definition["ReportName"]
+    )
 
     client = boto3.client("cur")
 
@@ -43,10 +56,13 @@ def handler(event, context):
     elif event["RequestType"] == "Update":
         logger.info("Updating resource")
         try:
-            response = _update_cur(event, context, client, report_definition)
+            if _is_unchanged(event, definition_hash):
+                logger.info(f"Report definition unchanged ({definition_hash})")
+            else:
+                response = _update_cur(event, context, client, report_definition)
         except Exception as e:
             logger.exception(e)
-            _respond_failed(event, context, {"error": str(e)})
+            _respond_failed(event, context, {"error": str(e)}, physical_resource_id)
             raise e
 
     elif event["RequestType"] == "Delete":
@@ -55,7 +71,7 @@ def handler(event, context):
             response = _delete_cur(event, context, client, report_definition)
         except Exception as e:
             logger.exception(e)
-            _respond_failed(event, context, {"error": str(e)})
+            _respond_failed(event, context, {"error": str(e)}, physical_resource_id)
             raise e
 
     else:
@@ -66,7 +82,9 @@ def handler(event, context):
 
     logger.info(f"Response: {response}")
     logger.info(f"Responding success!")
-    _respond_success(event, context, {})
+    _respond_success(
+        event, context, {"DefinitionHash": definition_hash}, physical_resource_id
+    )
 
 
 def _create_cur(event, context, client, report_definition):
@@ -95,12 +113,31 @@ def _delete_cur(event, context, client, report_definition):
     return response
 
 
-def _respond_success(event, context, data):
-    send(event, context, "SUCCESS", data)
+def _respond_success(event, context, data, physical_resource_id=None):
+    send(event, context, "SUCCESS", data, physical_resource_id)
 
 
-def _respond_failed(event, context, data):
-    send(event, context, "FAILED", data)
+def _respond_failed(event, context, data, physical_resource_id=None):
+    send(event, context, "FAILED", data, physical_resource_id)
+
+
+def _hash_report_definition(report_definition):
+    """Returns a sha256 of the report definition which does not depend on key order"""
+    canonical = json.dumps(report_definition, sort_keys=True, separators=(",", ":"))
+    return hashlib.sha256(canonical.encode("utf-8")).hexdigest()
+
+
+def _is_unchanged(event, definition_hash):
+    """Whether the definition of an Update is the same as the one previously deployed.
+    Properties which are not part of the report definition (e.g. ServiceToken) are
+    ignored.
+    """
+    try:
+        old_definition = _parse_resource_properties(event["OldResourceProperties"])
+    except Exception as e:
+        logger.warning(f"Could not parse OldResourceProperties: {e}")
+        return False
+    return _hash_report_definition(old_definition) == definition_hash
 
 
 def _parse_resource_properties(input_data):
@@ -139,8 +176,6 @@ def send(
     noEcho=False,
     reason=None,
 ):
-    http = urllib3.PoolManager()
-
     responseUrl = event["ResponseURL"]
 
     responseBody = {
@@ -0,0 +1,111 @@
+import json
+from unittest import mock
+
+import pytest
+
+import custom_cost_and_usage_report_cfn as cfn
+
+PROPERTIES = {
+    "ServiceToken": "arn:aws:lambda:us-east-1:123456789012:function:cur-cfn",
+    "ReportName": "BRH-CUR-test",
+    "Compression": "Parquet",
+    "Format": "Parquet",
+    "ReportVersioning": "OVERWRITE_REPORT",
+    "S3Bucket": "cur-bucket",
+    "S3Prefix": "cur_reports",
+    "S3Region": "us-east-1",
+    "TimeUnit": "MONTHLY",
+}
+
+
+def _event(request_type, properties, old_properties=None, physical_resource_id=None):
+    event = {
+        "RequestType": request_type,
+        "ResponseURL": "https://cloudformation-custom-resource-response.example.com",
+        "StackId": "stack-id",
+        "RequestId": "request-id",
+        "LogicalResourceId": "CostUsageReportDefinition",
+        "ResourceProperties": properties,
+    }
+    if old_properties is not None:
+        event["OldResourceProperties"] = old_properties
+    if physical_resource_id is not None:
+        event["PhysicalResourceId"] = physical_resource_id
+    return event
+
+
+def _context():
+    return mock.MagicMock(log_stream_name="2024/01/01/[$LATEST]abcdef")
+
+
+@pytest.fixture
+def cur_client():
+    client = mock.MagicMock()
+    with mock.patch.object(cfn.boto3, "client", return_value=client):
+        yield client
+
+
+@pytest.fixture
+def http():
+    with mock.patch.object(cfn, "http") as http:
+        yield http
+
+
+def _response_body(http):
+    return json.loads(http.request.call_args[1]["body"])
+
+
+def test_create(cur_client, http):
+    cfn.handler(_event("Create", PROPERTIES), _context())
+
+    cur_client.put_report_definition.assert_called_once()
+    body = _response_body(http)
+    assert body["Status"] == "SUCCESS"
+    assert body["PhysicalResourceId"] == "BRH-CUR-test"
+    assert body["Data"]["DefinitionHash"] == cfn._hash_report_definition(
+        cfn._parse_resource_properties(PROPERTIES)
+    )
+
+
+def test_update_unchanged_is_a_no_op(cur_client, http):
+    # Same definition, different key order and a new ServiceToken
+    old_properties = dict(reversed(list(PROPERTIES.items())))
+    old_properties[
+        "ServiceToken"
+    ] = "arn:aws:lambda:us-east-1:123456789012:function:old"
+
+    cfn.handler(
+        _event("Update", PROPERTIES, old_properties, "existing-id"), mock.MagicMock()
+    )
+
+    cur_client.modify_report_definition.assert_not_called()
+    body = _response_body(http)
+    assert body["Status"] == "SUCCESS"
+    assert body["PhysicalResourceId"] == "existing-id"
+
+
+def test_update_changed(cur_client, http):
+    properties = dict(PROPERTIES, TimeUnit="DAILY")
+
+    cfn.handler(
+        _event("Update", properties, PROPERTIES, "existing-id"), mock.MagicMock()
+    )
+
+    cur_client.modify_report_definition.assert_called_once()
+    assert (
+        cur_client.modify_report_definition.call_args[1]["ReportDefinition"]["TimeUnit"]
+        == "DAILY"
+    )
+    body = _response_body(http)
+    assert body["Status"] == "SUCCESS"
+    assert body["PhysicalResourceId"] == "existing-id"
+
+
+def test_invalid_properties(cur_client, http):
+    properties = dict(PROPERTIES)
+    del properties["ReportName"]
+
+    cfn.handler(_event("Create", properties), _context())
+
+    cur_client.put_report_definition.assert_not_called()
+    assert _response_body(http)["Status"] == "FAILED"
@@ -8,8 +8,10 @@ import boto3
 import os
 import logging
 import json
-import urllib.request
+import random
+import time
 
+import urllib3
 import awswrangler as wr
 import pandas as pd
 
@@ -19,17 +21,39 @@ logger.setLevel(logging.INFO)
 COST_COL = "line_item_unblended_cost"
 START_DATE_COL = "bill_billing_period_start_date"
 END_DATE_COL = "bill_billing_period_end_date"
+PRODUCT_CODE_COL = "line_item_product_code"
+
+# Services outside of the top N (by total cost) are summed into this bucket
+OTHER_SERVICES_KEY = "other"
+DEFAULT_BREAKDOWN_TOP_N = 5
 
 OUTPUT_SUMMARY_PREFIX = "parsed_reports"
 
+# Portal API calls are retried with exponential backoff and full jitter, CUR refreshes
+# land at roughly the same time in every workspace account and should not retry in lockstep.
+PORTAL_MAX_ATTEMPTS = 6
+PORTAL_BACKOFF_BASE_SECONDS = 0.5
+PORTAL_BACKOFF_MAX_SECONDS = 20
+PORTAL_RETRY_STATUS_CODES = {429, 500, 502, 503, 504}
+
+# Created once per container so connections are reused across invocations.
+http = urllib3.PoolManager(
+    timeout=urllib3.Timeout(connect=5.0, read=30.0),
+    retries=False,
+)
+
+# SSM parameter values, cached for the lifetime of the container.
+_ssm_param_cache = {}
+
 
 def handler(event, context):
     """This lambda function is meant to handle any change to the Cost and Usage Parquet Reports.
     It should be triggered from an S3 object creation event on files with the suffix 'parquet'.
     These files are automatically written by AWS Cost and Usage reports and will create individual files
     for each month of cost. The function has the following 2 responsibilities:
-        1. Parse all the parquet files under the prefix to get total usage/cost.
-        2. Update the BMH Portal with this total (via the BMH Portal API)
+        1. Parse all the parquet files under the prefix to get total usage/cost, as well as a
+            per-month and per-service breakdown of that cost.
+        2. Update the BMH Portal with this total and breakdown (via the BMH Portal API)
     """
     logger.info(event)
 
@@ -39,42 +63,143 @@ def handler(event, context):
 
     # Parse all the parquet files at this path
     path = "/".join(["s3:/", bucket_name, reports_prefix, reports_name, reports_name])
-    df = wr.s3.read_parquet(path=path, dataset=True)
+    # Only the columns used below are read, the rest of the report is never loaded.
+    df = wr.s3.read_parquet(
+        path=path,
+        dataset=True,
+        columns=[COST_COL, START_DATE_COL, PRODUCT_CODE_COL],
+    )
 
-    # This will get the cost per month, but we just need the total of all months
-    # sum_df = df.groupby(['year','month']).agg({COST_COL: 'sum'})
     total = df[COST_COL].sum()
     logger.info(f"Total Cost: {total}")
 
+    top_n = int(os.environ.get("cost_breakdown_top_n", DEFAULT_BREAKDOWN_TOP_N))
+    breakdown = compute_cost_breakdown(df, top_n=top_n)
+    logger.info(f"Cost Breakdown: {breakdown}")
+
     update_portal(total)
+    update_portal_cost_breakdown(breakdown)
+
+
+def compute_cost_breakdown(df, top_n=DEFAULT_BREAKDOWN_TOP_N):
+    """Groups the cost by billing month and service (line_item_product_code).
+    Only the top_n services (by total cost over all months) are kept, the remaining
+    services are summed into a single 'other' bucket.
+
+    return:
+        breakdown (dict): {"YYYY-MM": {"<product code>": cost, ...}, ...}
+    """
+    if df.empty:
+        return {}
+
+    months = pd.to_datetime(df[START_DATE_COL]).dt.to_period("M")
+
+    # Product codes are few and repeated, group on them as categories
+    # (the parquet columns are usually dictionary encoded, which pandas reads as such).
+    services = df[PRODUCT_CODE_COL].astype("category")
+    if OTHER_SERVICES_KEY not in services.cat.categories:
+        services = services.cat.add_categories([OTHER_SERVICES_KEY])
+    services = services.fillna(OTHER_SERVICES_KEY)
+
+    service_totals = df[COST_COL].groupby(services, observed=True).sum()
+    top_services = service_totals.nlargest(top_n).index
+    services = services.where(services.isin(top_services), OTHER_SERVICES_KEY)
+
+    grouped = df[COST_COL].groupby([months, services], observed=True).sum().round(2)
+
+    breakdown = {}
+    for (month, service), cost in grouped.items():
+        if cost == 0:
+            continue
+        breakdown.setdefault(str(month), {})[service] = float(cost)
+    return breakdown
 
 
 def update_portal(total):
     """Will send an https request to the update total usage endopint
     of the BMH Portal API"""
-    base_uri = _get_ssm_param(os.environ["brh_portal_uri"])
-    workspace_id = _get_ssm_param(os.environ["workspace_id"])
-    api_key = _get_ssm_param(os.environ["api_key"])
+    _put_to_portal("total-usage", {"total-usage": round(total, 2)})
 
-    headers = {"Content-Type": "application/json; charset=utf-8", "x-api-key": api_key}
-    uri = "/".join([base_uri, "workspaces", workspace_id, "total-usage"])
-    str_data = json.dumps({"total-usage": round(total, 2)})
 
-    logger.info(f"PUT {uri} [{str_data}]")
+def update_portal_cost_breakdown(breakdown):
+    """Will send an https request to the update cost breakdown endpoint
+    of the BMH Portal API.
+
+    Best effort: failures are logged and not raised. The total usage was already
+    pushed, failing the invocation would only push it again on retry, and portals
+    deployed before the endpoint existed answer 403/404."""
+    try:
+        _put_to_portal("cost-breakdown", {"cost-breakdown": breakdown})
+    except Exception:
+        logger.exception("Could not update the cost breakdown")
 
-    byte_data = str_data.encode("utf-8")
-    req = urllib.request.Request(uri, data=byte_data, headers=headers, method="PUT")
 
-    # This should throw an exception on most errors
-    resp = urllib.request.urlopen(req)
+def _put_to_portal(resource, data):
+    """PUT the json encoded data to /workspaces/{workspace_id}/{resource}.
 
-    if resp.status != 200:
-        raise Exception(
-            f"Error setting total-usage [{workspace_id=}, Status Code: {resp.status}]"
-        )
+    Throttling (429), server errors (5xx) and connection errors are retried with
+    exponential backoff and full jitter. If all attempts fail an exception is raised,
+    so the (asynchronous) lambda invocation is retried instead of the update being lost.
+    """
+    base_uri, workspace_id, api_key = _get_ssm_params(
+        [
+            os.environ["brh_portal_uri"],
+            os.environ["workspace_id"],
+            os.environ["api_key"],
+        ]
+    )
+
+    headers = {"Content-Type": "application/json; charset=utf-8", "x-api-key": api_key}
+    uri = "/".join([base_uri, "workspaces", workspace_id, resource])
+    str_data = json.dumps(data)
 
+    logger.info(f"PUT {uri} [{str_data}]")
+
+    byte_data = str_data.encode("utf-8")
 
-def _get_ssm_param(param_name):
-    ssm = boto3.client("ssm")
-    param_info = ssm.get_parameter(Name=param_name)
-    return param_info["Parameter"]["Value"]
+    error = None
+    for attempt in range(PORTAL_MAX_ATTEMPTS):
+        if attempt > 0:
+            delay = random.uniform(
+                0,
+                min(
+                    PORTAL_BACKOFF_MAX_SECONDS,
+                    PORTAL_BACKOFF_BASE_SECONDS * 2**attempt,
+                ),
+            )
+            logger.info(f"Retrying PUT {uri} in {delay:.2f}s ({error})")
+            time.sleep(delay)
+
+        try:
+            resp = http.request("PUT", uri, body=byte_data, headers=headers)
+        except urllib3.exceptions.HTTPError as e:
+            error = e
+            continue
+
+        # 202 when the portal queues the update
+        if resp.status in (200, 202):
+            return resp
+
+        error = f"Status Code: {resp.status}"
+        if resp.status in (401, 403):
+            # The parameters may have changed (e.g. API Key rotation).
+            _ssm_param_cache.clear()
+        if resp.status not in PORTAL_RETRY_STATUS_CODES:
+            break
+
+    raise Exception(f"Error setting {resource} [{workspace_id=}, {error}]")
+
+
+def _get_ssm_params(param_names):
+    """Returns the values of the given SSM parameters (in the same order),
+    fetching all the uncached ones with a single get_parameters call."""
+    missing = [name for name in param_names if name not in _ssm_param_cache]
+    if missing:
+        ssm = boto3.client("ssm")
+        response = ssm.get_parameters(Names=missing)
+        if response.get("InvalidParameters"):
+            raise ValueError(f"Invalid SSM parameters: {response['InvalidParameters']}")
+        for param in response["Parameters"]:
+            _ssm_param_cache[param["Name"]] = param["Value"]
+
+    return [_ssm_param_cache[name] for name in param_names]
@@ -0,0 +1,180 @@
+""" Benchmark of the Cost and Usage Report parser
+
+Reports the wall time and peak RSS of parse_cost_and_usage_lambda.handler on
+synthetic CUR datasets (see cur_generator.py) of increasing size. Each size runs
+in its own interpreter so the peak RSS of one run does not hide the next one, and
+the dataset is generated before the measured process starts.
+
+    $ cd bmh_workspace/lambdas/parse_cost_and_usage_lambda
+    $ python -m tests.benchmark_handler --rows 10000 1000000 10000000
+
+With --target local (default) the dataset is written to a temporary directory and
+the S3 read is redirected to it. With --target moto the dataset is written to a
+mocked S3 bucket in the measured process, so the reported peak RSS also includes
+the bytes held by moto (shown as "baseline").
+
+The portal is never called, update_portal and update_portal_cost_breakdown are
+replaced with no-ops.
+"""
+
+import argparse
+import json
+import os
+import resource
+import subprocess
+import sys
+import tempfile
+import time
+from unittest import mock
+
+DEFAULT_ROWS = [10_000, 1_000_000, 10_000_000]
+BUCKET_NAME = "brh-cur-benchmark"
+
+
+def _peak_rss_mb():
+    # ru_maxrss is in kilobytes on Linux
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+
+
+def _env():
+    from .cur_generator import DEFAULT_PREFIX, DEFAULT_REPORT_NAME
+
+    return {
+        "AWS_DEFAULT_REGION": "us-east-1",
+        "cur_bucket_name": BUCKET_NAME,
+        "cur_prefix": DEFAULT_PREFIX,
+        "cur_report_name": DEFAULT_REPORT_NAME,
+    }
+
+
+def _run_handler(local_root=None):
+    """Runs the handler (in this process) and returns the measurements"""
+    import awswrangler as wr
+    import pandas as pd
+
+    import parse_cost_and_usage_lambda
+
+    patches = [
+        mock.patch.object(parse_cost_and_usage_lambda, "update_portal"),
+        mock.patch.object(parse_cost_and_usage_lambda, "update_portal_cost_breakdown"),
+    ]
+    if local_root is not None:
+
+        def read_local_parquet(path, dataset=False, columns=None, **kwargs):
+            return pd.read_parquet(
+                path.replace(f"s3://{BUCKET_NAME}", local_root), columns=columns
+            )
+
+        patches.append(mock.patch.object(wr.s3, "read_parquet", read_local_parquet))
+
+    for patch in patches:
+        patch.start()
+
+    baseline_rss = _peak_rss_mb()
+    start = time.perf_counter()
+    parse_cost_and_usage_lambda.handler({}, None)
+    wall_time = time.perf_counter() - start
+
+    for patch in patches:
+        patch.stop()
+
+    return {
+        "wall_time_s": wall_time,
+        "baseline_rss_mb": baseline_rss,
+        "peak_rss_mb": _peak_rss_mb(),
+    }
+
+
+def run_one(args):
+    """Entry point of the measured subprocess, prints the result as json"""
+    from .cur_generator import write_cur_dataset
+
+    os.environ.update(_env())
+
+    if args.target == "moto":
+        import boto3
+        from moto import mock_s3
+
+        with mock_s3():
+            boto3.client("s3").create_bucket(Bucket=BUCKET_NAME)
+            write_cur_dataset(
+                f"s3://{BUCKET_NAME}",
+                num_rows=args.run_one,
+                months=args.months,
+                num_extra_columns=args.extra_columns,
+            )
+            result = _run_handler()
+    else:
+        result = _run_handler(local_root=args.workdir)
+
+    print(json.dumps(result))
+
+
+def main(args):
+    print(
+        f"{'rows':>12} {'target':>7} {'wall time (s)':>14} "
+        f"{'baseline (MB)':>14} {'peak RSS (MB)':>14}"
+    )
+    for rows in args.rows:
+        with tempfile.TemporaryDirectory() as workdir:
+            if args.target == "local":
+                # Generate the dataset in a separate process, it is not measured.
+                subprocess.run(
+                    [
+                        sys.executable,
+                        "-m",
+                        "tests.cur_generator",
+                        workdir,
+                        "--rows",
+                        str(rows),
+                        "--months",
+                        str(args.months),
+                        "--extra-columns",
+                        str(args.extra_columns),
+                    ],
+                    check=True,
+                    stdout=subprocess.DEVNULL,
+                )
+
+            proc = subprocess.run(
+                [
+                    sys.executable,
+                    "-m",
+                    "tests.benchmark_handler",
+                    "--run-one",
+                    str(rows),
+                    "--workdir",
+                    workdir,
+                    "--target",
+                    args.target,
+                    "--months",
+                    str(args.months),
+                    "--extra-columns",
+                    str(args.extra_columns),
+                ],
+                check=True,
+                capture_output=True,
+                text=True,
+            )
+
+        result = json.loads(proc.stdout.strip().splitlines()[-1])
+        print(
+            f"{rows:>12} {args.target:>7} {result['wall_time_s']:>14.2f} "
+            f"{result['baseline_rss_mb']:>14.0f} {result['peak_rss_mb']:>14.0f}"
+        )
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__.split("\n")[1])
+    parser.add_argument("--rows", type=int, nargs="+", default=DEFAULT_ROWS)
+    parser.add_argument("--months", type=int, default=12)
+    parser.add_argument("--extra-columns", type=int, default=20)
+    parser.add_argument("--target", choices=["local", "moto"], default="local")
+    parser.add_argument("--run-one", type=int, help=argparse.SUPPRESS)
+    parser.add_argument("--workdir", help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.run_one is not None:
+        run_one(args)
+    else:
+        main(args)
@@ -0,0 +1,51 @@
+"""
+Conf Test for the Cost and Usage Report parser test suite
+"""
+
+import os
+from unittest import mock
+
+import boto3
+import pytest
+from moto import mock_s3, mock_ssm
+
+CUR_BUCKET_NAME = "brh-cur-123456789012-brh-infrastructure-cur"
+
+
+@pytest.fixture(autouse=True, scope="session")
+def setup_env_vars():
+    with mock.patch.dict(
+        os.environ,
+        {
+            "AWS_DEFAULT_REGION": "us-east-1",
+            "cur_bucket_name": CUR_BUCKET_NAME,
+            "cur_prefix": "cur_reports",
+            "cur_report_name": "BRH-CUR-brh-infrastructure-cur",
+            "brh_portal_uri": "/brh/portal_uri-brh-infrastructure-cur",
+            "workspace_id": "/brh/workspace_id-brh-infrastructure-cur",
+            "api_key": "/brh/portal_api_key-brh-infrastructure-cur",
+        },
+    ):
+        yield
+
+
+@pytest.fixture()
+def cur_bucket():
+    with mock_s3():
+        s3 = boto3.client("s3")
+        s3.create_bucket(Bucket=CUR_BUCKET_NAME)
+        yield f"s3://{CUR_BUCKET_NAME}"
+
+
+@pytest.fixture()
+def portal_params():
+    with mock_ssm():
+        ssm = boto3.client("ssm")
+        values = {
+            os.environ["brh_portal_uri"]: "https://portal.example.org/api",
+            os.environ["workspace_id"]: "test-workspace-id",
+            os.environ["api_key"]: "testKey",  # pragma: allowlist secret
+        }
+        for name, value in values.items():
+            ssm.put_parameter(Name=name, Value=value, Type="String")
+        yield values
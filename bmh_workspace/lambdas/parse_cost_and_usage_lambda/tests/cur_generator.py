@@ -0,0 +1,230 @@
+""" Synthetic Cost and Usage Report (CUR) datasets
+
+Writes parquet datasets shaped like the ones AWS Cost and Usage Reports deliver
+(same column names and types, one folder per billing period) either to a local
+directory or to an S3 bucket (e.g. mocked with moto). Used by the unit tests and
+the benchmark of parse_cost_and_usage_lambda.
+
+    $ python -m tests.cur_generator /tmp/cur --rows 1000000 --months 6
+"""
+
+import argparse
+import io
+import os
+from datetime import datetime, timedelta
+
+import boto3
+import numpy as np
+import pyarrow as pa
+import pyarrow.compute as pc
+import pyarrow.parquet as pq
+
+DEFAULT_REPORT_NAME = "BRH-CUR-brh-infrastructure-cur"
+DEFAULT_PREFIX = "cur_reports"
+
+# (product code, usage types, relative weight of the product in the report)
+# fmt: off
+PRODUCTS = [
+    ("AmazonEC2", ["BoxUsage:t3.medium", "EBS:VolumeUsage.gp3", "DataTransfer-Out-Bytes"], 40),
+    ("AmazonS3", ["TimedStorage-ByteHrs", "Requests-Tier1", "Requests-Tier2"], 20),
+    ("AmazonEKS", ["AmazonEKS-Hours:perCluster"], 8),
+    ("AWSLambda", ["Lambda-GB-Second", "Request"], 8),
+    ("AmazonCloudWatch", ["CW:MetricMonitorUsage", "DataProcessing-Bytes"], 6),
+    ("AmazonVPC", ["VpcEndpoint-Hours", "NatGateway-Hours"], 6),
+    ("AmazonRDS", ["InstanceUsage:db.t3.micro", "RDS:GP2-Storage"], 4),
+    ("AmazonDynamoDB", ["ReadRequestUnits", "WriteRequestUnits"], 3),
+    ("AWSSecretsManager", ["AWSSecretsManager-Secrets"], 2),
+    ("AmazonSNS", ["Requests-Tier1"], 1),
+    ("AWSCostExplorer", ["APIRequest"], 1),
+    ("AmazonECR", ["TimedStorage-ByteHrs"], 1),
+]
+# fmt: on
+REGIONS = ["us-east-1", "us-east-2", "us-west-2"]
+LINE_ITEM_TYPES = ["Usage", "Usage", "Usage", "Tax", "Credit"]
+
+
+def generate_cur_table(
+    num_rows,
+    billing_period_start,
+    num_extra_columns=0,
+    account_id="123456789012",
+    seed=0,
+):
+    """Returns a pyarrow Table with num_rows CUR line items for the billing period
+    (month) starting at billing_period_start.
+
+    args:
+        num_rows: (int) Number of line items.
+        billing_period_start: (datetime) First day of the billing period.
+        num_extra_columns: (int) Additional string columns (resource tags), CUR reports
+            often contain dozens of columns the parser never reads.
+        account_id: (string) Usage/payer account id.
+        seed: (int) Seed for the random generator.
+    """
+    rng = np.random.default_rng(seed)
+    period_end = (billing_period_start + timedelta(days=32)).replace(day=1)
+    period_seconds = int((period_end - billing_period_start).total_seconds())
+
+    weights = np.array([p[2] for p in PRODUCTS], dtype=float)
+    product_idx = rng.choice(len(PRODUCTS), size=num_rows, p=weights / weights.sum())
+    product_codes = np.array([p[0] for p in PRODUCTS], dtype=object)[product_idx]
+    usage_types = np.array([rng.choice(p[1]) for p in PRODUCTS], dtype=object)[
+        product_idx
+    ]
+
+    usage_start = np.datetime64(billing_period_start, "s") + rng.integers(
+        0, period_seconds - 3600, size=num_rows
+    ).astype("timedelta64[s]")
+    usage_amount = rng.exponential(2.0, size=num_rows)
+    rate = rng.choice([0.0, 0.0004, 0.023, 0.0416, 0.10], size=num_rows)
+    cost = np.round(usage_amount * rate, 8)
+
+    columns = {
+        "identity_line_item_id": pa.array(
+            rng.integers(0, 2**62, size=num_rows).astype(str)
+        ),
+        "bill_bill_type": pa.array(np.full(num_rows, "Anniversary", dtype=object)),
+        "bill_payer_account_id": pa.array(np.full(num_rows, account_id, dtype=object)),
+        "bill_billing_period_start_date": pa.array(
+            np.full(num_rows, np.datetime64(billing_period_start, "ms"))
+        ),
+        "bill_billing_period_end_date": pa.array(
+            np.full(num_rows, np.datetime64(period_end, "ms"))
+        ),
+        "line_item_usage_account_id": pa.array(
+            np.full(num_rows, account_id, dtype=object)
+        ),
+        "line_item_line_item_type": pa.array(
+            rng.choice(np.array(LINE_ITEM_TYPES, dtype=object), size=num_rows)
+        ),
+        "line_item_usage_start_date": pa.array(usage_start.astype("datetime64[ms]")),
+        "line_item_usage_end_date": pa.array(
+            (usage_start + np.timedelta64(3600, "s")).astype("datetime64[ms]")
+        ),
+        "line_item_product_code": pa.array(product_codes).dictionary_encode(),
+        "line_item_usage_type": pa.array(usage_types).dictionary_encode(),
+        "line_item_usage_amount": pa.array(usage_amount),
+        "line_item_currency_code": pa.array(np.full(num_rows, "USD", dtype=object)),
+        "line_item_unblended_rate": pa.array(rate.astype(str)),
+        "line_item_unblended_cost": pa.array(cost),
+        "line_item_blended_cost": pa.array(cost),
+        "product_region": pa.array(
+            rng.choice(np.array(REGIONS, dtype=object), size=num_rows)
+        ),
+    }
+    for i in range(num_extra_columns):
+        columns[f"resource_tags_user_tag_{i}"] = pa.array(
+            rng.choice(np.array(["", "gen3", "workspace"], dtype=object), size=num_rows)
+        )
+
+    return pa.table(columns)
+
+
+def write_cur_dataset(
+    destination,
+    num_rows=10_000,
+    months=3,
+    first_month=datetime(2024, 1, 1),
+    rows_per_file=1_000_000,
+    num_extra_columns=0,
+    partitioned=True,
+    report_name=DEFAULT_REPORT_NAME,
+    prefix=DEFAULT_PREFIX,
+    seed=0,
+):
+    """Writes a CUR-shaped parquet dataset and returns its expected totals.
+
+    Files are written to <destination>/<prefix>/<report_name>/<report_name>/, the same
+    layout CUR uses (and the path the parser reads), partitioned by
+    year=<YYYY>/month=<M> when partitioned is set.
+
+    args:
+        destination: (string) Local directory, or an S3 URI ("s3://bucket") to write to.
+        num_rows: (int) Total number of line items, spread evenly over the months.
+        months: (int) Number of billing periods.
+        rows_per_file: (int) Maximum number of rows per parquet file.
+        num_extra_columns: (int) See generate_cur_table.
+        partitioned: (bool) Whether to write year/month partitions.
+
+    return:
+        dict: {"path": dataset path, "total": total cost, "monthly_totals": {"YYYY-MM": cost}}
+    """
+    s3_bucket = None
+    if destination.startswith("s3://"):
+        s3_bucket = destination[len("s3://") :].strip("/")
+        s3 = boto3.client("s3")
+
+    dataset_path = "/".join([destination.rstrip("/"), prefix, report_name, report_name])
+
+    total = 0.0
+    monthly_totals = {}
+    month_start = first_month
+    for month in range(months):
+        month_rows = num_rows // months + (1 if month < num_rows % months else 0)
+        partition = (
+            f"year={month_start.year}/month={month_start.month}" if partitioned else ""
+        )
+
+        for part, offset in enumerate(range(0, month_rows, rows_per_file)):
+            table = generate_cur_table(
+                min(rows_per_file, month_rows - offset),
+                month_start,
+                num_extra_columns=num_extra_columns,
+                seed=seed + month * 1000 + part,
+            )
+            cost = float(pc.sum(table["line_item_unblended_cost"]).as_py())
+            total += cost
+            month_key = month_start.strftime("%Y-%m")
+            monthly_totals[month_key] = monthly_totals.get(month_key, 0.0) + cost
+
+            file_name = (
+                f"{report_name}-{month_start:%Y%m}-{part + 1:05d}.snappy.parquet"
+            )
+            key = "/".join(p for p in [partition, file_name] if p)
+
+            if s3_bucket is not None:
+                buffer = io.BytesIO()
+                pq.write_table(table, buffer, compression="snappy")
+                s3.put_object(
+                    Bucket=s3_bucket,
+                    Key="/".join([prefix, report_name, report_name, key]),
+                    Body=buffer.getvalue(),
+                )
+            else:
+                file_path = os.path.join(dataset_path, key)
+                os.makedirs(os.path.dirname(file_path), exist_ok=True)
+                pq.write_table(table, file_path, compression="snappy")
+
+        month_start = (month_start + timedelta(days=32)).replace(day=1)
+
+    return {"path": dataset_path, "total": total, "monthly_totals": monthly_totals}
+
+
+def main(args):
+    result = write_cur_dataset(
+        args.destination,
+        num_rows=args.rows,
+        months=args.months,
+        rows_per_file=args.rows_per_file,
+        num_extra_columns=args.extra_columns,
+        partitioned=not args.no_partitions,
+        report_name=args.report_name,
+        prefix=args.prefix,
+        seed=args.seed,
+    )
+    print(f"Wrote {args.rows} rows to {result['path']}")
+    print(f"Total cost: {result['total']:.2f}")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__.split("\n")[1])
+    parser.add_argument("destination", help="Local directory or s3://bucket")
+    parser.add_argument("--rows", type=int, default=10_000)
+    parser.add_argument("--months", type=int, default=3)
+    parser.add_argument("--rows-per-file", type=int, default=1_000_000)
+    parser.add_argument("--extra-columns", type=int, default=0)
+    parser.add_argument("--no-partitions", action="store_true")
+    parser.add_argument("--report-name", default=DEFAULT_REPORT_NAME)
+    parser.add_argument("--prefix", default=DEFAULT_PREFIX)
+    parser.add_argument("--seed", type=int, default=0)
+    main(parser.parse_args())
@@ -0,0 +1,194 @@
+from unittest import mock
+from unittest.mock import MagicMock, patch
+
+import pandas as pd
+import pytest
+import urllib3
+
+import parse_cost_and_usage_lambda
+from .cur_generator import write_cur_dataset
+
+
+@pytest.fixture(autouse=True)
+def clear_ssm_param_cache():
+    parse_cost_and_usage_lambda._ssm_param_cache.clear()
+    yield
+    parse_cost_and_usage_lambda._ssm_param_cache.clear()
+
+
+def _response(status):
+    response = MagicMock()
+    response.status = status
+    return response
+
+
+def test_handler(cur_bucket):
+    dataset = write_cur_dataset(cur_bucket, num_rows=3000, months=3, rows_per_file=700)
+
+    with patch.object(
+        parse_cost_and_usage_lambda, "update_portal"
+    ) as mock_update_portal, patch.object(
+        parse_cost_and_usage_lambda, "update_portal_cost_breakdown"
+    ) as mock_update_breakdown:
+        parse_cost_and_usage_lambda.handler({}, None)
+
+    total = mock_update_portal.call_args[0][0]
+    assert total == pytest.approx(dataset["total"])
+
+    breakdown = mock_update_breakdown.call_args[0][0]
+    assert set(breakdown) == set(dataset["monthly_totals"])
+    for month, services in breakdown.items():
+        assert len(services) <= parse_cost_and_usage_lambda.DEFAULT_BREAKDOWN_TOP_N + 1
+        assert sum(services.values()) == pytest.approx(
+            dataset["monthly_totals"][month], abs=0.1
+        )
+
+
+def test_handler_unpartitioned_dataset(cur_bucket):
+    dataset = write_cur_dataset(cur_bucket, num_rows=500, months=2, partitioned=False)
+
+    with patch.object(
+        parse_cost_and_usage_lambda, "update_portal"
+    ) as mock_update_portal, patch.object(
+        parse_cost_and_usage_lambda, "update_portal_cost_breakdown"
+    ):
+        parse_cost_and_usage_lambda.handler({}, None)
+
+    assert mock_update_portal.call_args[0][0] == pytest.approx(dataset["total"])
+
+
+def test_compute_cost_breakdown():
+    df = pd.DataFrame(
+        {
+            parse_cost_and_usage_lambda.COST_COL: [1.0, 2.0, 3.0, 0.5, 7.0, 0.0],
+            parse_cost_and_usage_lambda.START_DATE_COL: pd.to_datetime(
+                ["2024-01-01"] * 3 + ["2024-02-01"] * 3
+            ),
+            parse_cost_and_usage_lambda.PRODUCT_CODE_COL: [
+                "AmazonEC2",
+                "AmazonS3",
+                "AWSLambda",
+                None,
+                "AmazonEC2",
+                "AWSLambda",
+            ],
+        }
+    )
+
+    # AmazonEC2 (8) and AWSLambda (3) are the top 2, the rest is summed as other.
+    breakdown = parse_cost_and_usage_lambda.compute_cost_breakdown(df, top_n=2)
+    assert breakdown == {
+        "2024-01": {"AmazonEC2": 1.0, "AWSLambda": 3.0, "other": 2.0},
+        "2024-02": {"AmazonEC2": 7.0, "other": 0.5},
+    }
+
+    assert parse_cost_and_usage_lambda.compute_cost_breakdown(df.iloc[0:0]) == {}
+
+
+def test_compute_cost_breakdown_categorical_product_codes():
+    # Dictionary encoded parquet columns are read as categoricals, which can not be
+    # filled or relabeled with a value ("other") that is not one of their categories.
+    df = pd.DataFrame(
+        {
+            parse_cost_and_usage_lambda.COST_COL: [1.0, 2.0, 3.0, 0.5],
+            parse_cost_and_usage_lambda.START_DATE_COL: pd.to_datetime(
+                ["2024-01-31", "2024-01-01", "2024-02-01", "2024-02-29"]
+            ),
+            parse_cost_and_usage_lambda.PRODUCT_CODE_COL: pd.Categorical(
+                ["AmazonEC2", "AmazonS3", "AmazonEC2", None]
+            ),
+        }
+    )
+
+    breakdown = parse_cost_and_usage_lambda.compute_cost_breakdown(df, top_n=1)
+    assert breakdown == {
+        "2024-01": {"AmazonEC2": 1.0, "other": 2.0},
+        "2024-02": {"AmazonEC2": 3.0, "other": 0.5},
+    }
+
+
+def test_put_to_portal(portal_params):
+    with patch.object(parse_cost_and_usage_lambda, "http") as mock_http, patch.object(
+        parse_cost_and_usage_lambda.time, "sleep"
+    ) as mock_sleep:
+        # Throttled and unavailable responses are retried
+        mock_http.request.side_effect = [
+            _response(429),
+            urllib3.exceptions.ReadTimeoutError(None, None, "timed out"),
+            _response(503),
+            _response(200),
+        ]
+        parse_cost_and_usage_lambda.update_portal(123.456)
+
+        assert mock_http.request.call_count == 4
+        assert mock_sleep.call_count == 3
+        for call in mock_sleep.call_args_list:
+            assert (
+                0
+                <= call[0][0]
+                <= parse_cost_and_usage_lambda.PORTAL_BACKOFF_MAX_SECONDS
+            )
+
+        method, uri = mock_http.request.call_args[0]
+        assert method == "PUT"
+        assert (
+            uri
+            == "https://portal.example.org/api/workspaces/test-workspace-id/total-usage"
+        )
+        assert mock_http.request.call_args[1]["body"] == b'{"total-usage": 123.46}'
+        assert mock_http.request.call_args[1]["headers"]["x-api-key"] == "testKey"
+
+        # Client errors are not retried
+        mock_http.reset_mock()
+        mock_http.request.side_effect = [_response(400)]
+        with pytest.raises(Exception):
+            parse_cost_and_usage_lambda.update_portal(1)
+        assert mock_http.request.call_count == 1
+
+        # Give up (and fail the invocation) after PORTAL_MAX_ATTEMPTS
+        mock_http.reset_mock()
+        mock_http.request.side_effect = None
+        mock_http.request.return_value = _response(500)
+        with pytest.raises(Exception):
+            parse_cost_and_usage_lambda.update_portal(1)
+        assert (
+            mock_http.request.call_count
+            == parse_cost_and_usage_lambda.PORTAL_MAX_ATTEMPTS
+        )
+
+
+def test_update_portal_cost_breakdown_best_effort(cur_bucket, portal_params):
+    write_cur_dataset(cur_bucket, num_rows=100, months=1)
+
+    def portal(method, uri, **kwargs):
+        # A portal deployed before the cost-breakdown endpoint
+        return _response(404 if uri.endswith("/cost-breakdown") else 200)
+
+    with patch.object(parse_cost_and_usage_lambda, "http") as mock_http:
+        mock_http.request.side_effect = portal
+        # Does not fail (and retry) the invocation
+        parse_cost_and_usage_lambda.handler({}, None)
+
+    uris = [call[0][1] for call in mock_http.request.call_args_list]
+    assert [uri.rsplit("/", 1)[1] for uri in uris] == ["total-usage", "cost-breakdown"]
+
+
+def test_get_ssm_params_cached(portal_params):
+    names = list(portal_params)
+
+    with patch.object(
+        parse_cost_and_usage_lambda.boto3,
+        "client",
+        wraps=parse_cost_and_usage_lambda.boto3.client,
+    ) as mock_client:
+        assert parse_cost_and_usage_lambda._get_ssm_params(names) == list(
+            portal_params.values()
+        )
+        assert (
+            parse_cost_and_usage_lambda._get_ssm_params(names[::-1])
+            == list(portal_params.values())[::-1]
+        )
+        assert mock_client.call_count == 1
+
+    with pytest.raises(ValueError):
+        parse_cost_and_usage_lambda._get_ssm_params(["/brh/does-not-exist"])